@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# CHECKPOINT.PY - Checkpoints to resume chip processing
+#
+
+from __future__ import print_function
+
+__authors__ = 'David Nidever <dnidever@noao.edu>'
+__version__ = '20261018'  # yyyymmdd
+
+import os
+import json
+import zlib
+from glob import glob
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+# Chip attributes that are saved with each checkpoint
+STATE = ['sexiter','sexiterdone','subiter','apcorr','seeing','sexcatfile',
+         '_fwhm','_sexmaglim','_daomaglim','_nsn5first']
+
+# The SExtractor catalog kept in memory by the chip
+SEXCATFILE = 'flux_sexcat.ckpt.fits'
+
+
+def checksum(filename,blocksize=2**22):
+    """ CRC32 checksum of a file."""
+    crc = 0
+    with open(filename,'rb') as f:
+        while True:
+            buf = f.read(blocksize)
+            if len(buf)==0: break
+            crc = zlib.crc32(buf,crc)
+    return '{:08x}'.format(crc & 0xffffffff)
+
+
+def fileinfo(filename,last=None):
+    """ Size, modification time, inode and checksum of a file.  The checksum
+        is reused from the last info if the file was not touched since."""
+    st = os.stat(filename)
+    info = {'size':st.st_size,'mtime':st.st_mtime_ns,'ino':st.st_ino}
+    if last is not None and all([last.get(k)==info[k] for k in ['size','mtime','ino']]):
+        info['crc'] = last['crc']
+    else:
+        info['crc'] = checksum(filename)
+    return info
+
+
+def artifacts(directory):
+    """ The chip working files that later stages read back in."""
+    files = []
+    for f in sorted(glob(os.path.join(directory,'flux*'))):
+        base = os.path.basename(f)
+        # flux.fits is rewritten from the exposure, logs and the daoread
+        #  caches are not needed
+        if base=='flux.fits' or base.endswith('.log') or base.endswith('.npz'):
+            continue
+        if os.path.islink(f) or os.path.isfile(f)==False:
+            continue
+        files.append(os.path.abspath(f))
+    return files
+
+
+def _tojson(obj):
+    if isinstance(obj,np.generic):
+        return obj.item()
+    return str(obj)
+
+
+class ChipCheckpoint:
+    """
+    Manifest of the completed processing stages of a chip.  It is rewritten
+    after every stage and records the chip state (sexiter, meta, etc.) and
+    the checksums of the working files so a rerun can pick up where the
+    last one stopped.
+
+    Parameters
+    ----------
+    filename : str
+       The manifest (JSON) filename.
+    directory : str
+       The chip working directory.
+    logger : logging object, optional
+       Logger to use.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        ckpt = ChipCheckpoint('chip01.ckpt.json','chip01')
+        if ckpt.load() and len(ckpt.verify())==0:
+            ckpt.restore(chip)
+
+    """
+
+    def __init__(self,filename,directory,logger=None):
+        self.filename = os.path.abspath(filename)
+        self.dir = os.path.abspath(directory)
+        self.logger = logger
+        self.reset()
+
+    def __repr__(self):
+        return "ChipCheckpoint("+str(len(self.stages))+" stages)"
+
+    def reset(self):
+        """ Forget all completed stages."""
+        self.stages = []        # [name,iter] of the completed stages
+        self.state = {}
+        self.meta = None
+        self.files = {}         # absolute filename -> size, mtime, inode and checksum
+        self.complete = False
+
+    def load(self):
+        """ Read the manifest.  Returns False if there is none."""
+        if os.path.exists(self.filename)==False:
+            return False
+        try:
+            with open(self.filename,'r') as f:
+                man = json.load(f)
+        except:
+            if self.logger is not None:
+                self.logger.warning('Could not read checkpoint '+self.filename)
+            return False
+        self.stages = [list(s) for s in man['stages']]
+        self.state = man['state']
+        self.meta = man['meta']
+        self.files = man['files']
+        self.complete = man['complete']
+        return True
+
+    def write(self):
+        """ Write the manifest, atomically."""
+        man = {'dir':self.dir,'stages':self.stages,'state':self.state,'meta':self.meta,
+               'files':self.files,'complete':self.complete}
+        tmpfile = self.filename+'.tmp'
+        with open(tmpfile,'w') as f:
+            json.dump(man,f,indent=1,default=_tojson)
+        os.replace(tmpfile,self.filename)
+
+    def done(self,name,it):
+        """ Was this stage already completed?"""
+        return [name,it] in self.stages
+
+    def save(self,chip,name,it=None):
+        """ Record a completed stage of the chip."""
+        if it is None: it=chip.sexiter
+        if [name,it] not in self.stages:
+            self.stages.append([name,it])
+        self.state = {k:getattr(chip,k,None) for k in STATE}
+        self.meta = chip.meta.tostring(sep='\n',endcard=False,padding=False)
+        # runsex() is the only stage that changes the catalog
+        if name=='runsex' and chip.sexcat is not None:
+            chip.sexcat.write(os.path.join(self.dir,SEXCATFILE),overwrite=True)
+        self.files = {f:fileinfo(f,self.files.get(f)) for f in artifacts(self.dir)}
+        self.write()
+
+    def finish(self,files):
+        """ The chip is done, only the final files need to be kept track of."""
+        self.stages.append(['complete',0])
+        self.files = {os.path.abspath(f):fileinfo(f) for f in files}
+        self.complete = True
+        self.write()
+
+    def verify(self):
+        """ Returns the recorded files that are missing or were changed."""
+        bad = []
+        for f,info in self.files.items():
+            if os.path.exists(f)==False:
+                bad.append(f)
+                continue
+            st = os.stat(f)
+            if st.st_size!=info['size']:
+                bad.append(f)
+            elif st.st_mtime_ns!=info['mtime'] or st.st_ino!=info['ino']:
+                if checksum(f)!=info['crc']:
+                    bad.append(f)
+        return bad
+
+    def restore(self,chip):
+        """ Put the saved state back into the chip."""
+        for k,v in self.state.items():
+            setattr(chip,k,v)
+        if self.meta is not None:
+            chip.meta = fits.Header.fromstring(self.meta,sep='\n')
+        sexcatfile = os.path.join(self.dir,SEXCATFILE)
+        if os.path.exists(sexcatfile):
+            chip.sexcat = Table.read(sexcatfile)
+        if self.logger is not None:
+            self.logger.info('Resuming from checkpoint, '+str(len(self.stages))+' stages done, sexiter='+
+                             str(chip.sexiter))
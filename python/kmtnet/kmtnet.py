@@ -30,11 +30,14 @@ import struct
 import subprocess
 import sys
 import time
+import traceback
 import warnings
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import requests
 from dlnpyutils import utils as dln,coords
 import prometheus as pm
-from . import phot,utils
+from . import phot,utils,timing,checkpoint
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -53,11 +56,105 @@ warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 #-------------------------------------------------
 
 
+# Class to read chips out of a multi-extension exposure file
+class ChipExtractor:
+
+    def __init__(self,filename):
+        self.filename = filename
+        self._hdulist = None
+        self._head0 = None
+        self._headers = {}
+
+    def __repr__(self):
+        return "ChipExtractor("+self.filename+")"
+
+    def __getstate__(self):
+        # Don't pickle the open file, each process opens its own
+        state = self.__dict__.copy()
+        state['_hdulist'] = None
+        return state
+
+    def __len__(self):
+        return len(self.hdulist)
+
+    @property
+    def hdulist(self):
+        # Open the file once with memory mapping
+        if self._hdulist is None:
+            self._hdulist = fits.open(self.filename,memmap=True)
+        return self._hdulist
+
+    @property
+    def head0(self):
+        # Primary header
+        if self._head0 is None:
+            self._head0 = self.hdulist[0].header.copy()
+        return self._head0
+
+    def header(self,extension):
+        """ Extension header merged with the primary header."""
+        if extension not in self._headers:
+            head = self.hdulist[extension].header.copy()
+            head.extend(self.head0,unique=True)  # add PDU info
+            self._headers[extension] = head
+        return self._headers[extension].copy()
+
+    def data(self,extension):
+        """ Memory-mapped image data for an extension."""
+        return self.hdulist[extension].data
+
+    def writeto(self,extension,filename):
+        """ Write a chip to its own FITS file."""
+        if os.path.exists(filename):
+            os.remove(filename)
+        fits.writeto(filename,self.data(extension),header=self.header(extension),output_verify='warn')
+
+    def close(self):
+        if self._hdulist is not None:
+            self._hdulist.close()
+        self._hdulist = None
+
+
+# Class to hold the in-memory images of a chip
+class ChipImages:
+
+    def __init__(self,flux,wt,mask,header,files=None):
+        self.flux = flux
+        self.wt = wt
+        self.mask = mask
+        self.header = header
+        # Filenames to use if the images need to go to disk
+        self.files = {'flux':'flux.fits','wt':'wt.fits','mask':'mask.fits'}
+        if files is not None:
+            self.files.update(files)
+        self._written = {'flux':False,'wt':False,'mask':False}
+        # Grown SExtractor flag images, by filter size
+        self.grown = {}
+
+    def __repr__(self):
+        return "ChipImages("+str(self.flux.shape)+")"
+
+    def file(self,kind):
+        """ Write an image to its file (only once) and return the filename."""
+        filename = self.files[kind]
+        if self._written[kind] and os.path.exists(filename):
+            return filename
+        if os.path.exists(filename): os.remove(filename)
+        if kind=='flux':
+            fits.writeto(filename,self.flux,header=self.header,output_verify='warn')
+        else:
+            fits.writeto(filename,getattr(self,kind))
+        self._written[kind] = True
+        return filename
+
+
 # Class to represent an exposure to process
 class Exposure:
 
     # Initialize Exposure object
-    def __init__(self,filename,host):
+    def __init__(self,filename,host,fwhmmode='full',daosession=False,alstiles=1,resume=False,
+                 compression='gz',complevel=None,psfworkers=1,psfstop='fixed',psfcutout=False,
+                 apphot='daophot',scratch=None):
         filename = os.path.abspath(filename)
         # Check that the files exist
         if os.path.exists(filename) is False:
@@ -65,7 +162,7 @@ class Exposure:
             return
         #self.delete = delete  # delete original files
         # Setting up the object properties
-        self.origfilename = filename
+        self.origfilename = os.path.abspath(filename)
         self.host = host
         self.filename = None      # working files in temp dir
         base = os.path.basename(filename)
@@ -75,18 +172,32 @@ class Exposure:
         self.logger = None
         self.origdir = None
         self.workdir = None     # the temporary working directory
+        self.statedir = None    # checkpoints and keep/ files, on the shared tmproot
         self.keepdir = None     # where to keep the final files before bundling
         self.outdir = None
         self.chip = None
+        self.timingrows = []      # stage timing of all the chips
+        self.fwhmmode = fwhmmode  # initial FWHM estimate, 'full', 'tiled' or 'sex'
+        self.daosession = daosession  # use one persistent DAOPHOT process per chip
+        self.alstiles = alstiles      # run ALLSTAR on alstiles x alstiles tiles in parallel
+        self.psfworkers = psfworkers  # fit the PSF analytic functions in parallel
+        self.psfstop = psfstop        # end the PSF iterations with the 'fixed' or 'predict' rule
+        self.psfcutout = psfcutout    # PSF cleaning iterations on a mosaic of PSF star stamps
+        self.apphot = apphot          # aperture photometry with 'daophot' or the 'native' code
+        self.scratch = scratch        # where to put the working directory, see utils.scratchroots()
+        self.resume = resume          # pick up from the checkpoints of an earlier run
+        self.compression = compression  # tar file compression, 'gz', 'bz2', 'xz' or 'zst'
+        self.complevel = complevel      # tar file compression level
+        self.bundler = None             # bundles the final chip files as they finish
+        # Reads the chips directly from the original file
+        self.extractor = ChipExtractor(filename)
 
         # Get number of extensions
-        hdulist = fits.open(filename)
-        nhdu = len(hdulist)
-        hdulist.close()
+        nhdu = len(self.extractor)
         self.nexten = nhdu
         self.nchips = nhdu-1
         # Get night
-        head0 = fits.getheader(filename,0)
+        head0 = self.extractor.head0
         dateobs = head0.get("DATE-OBS")
         night = dateobs[0:4]+dateobs[5:7]+dateobs[8:10]
         self.night = night
@@ -95,26 +206,30 @@ class Exposure:
         self.outdir = os.path.join('/home/x51j468/kmtnet/',self.night,self.base)
         
     # Setup
-    def setup(self):
-        basedir,tmproot = utils.getdirs(self.host)
-        print("dirs, setup = ",basedir,tmproot)
-        # Prepare temporary directory
-        tmpcntr = 1
-        tmpdir = os.path.join(tmproot,self.base+"."+str(tmpcntr))
+    def setup(self,nworkers=1):
+        basedir = utils.getdirs(self.host)[0]
+        # Put the working directory on /dev/shm or node-local disk if there is room
+        #  for the files of the chips that are processed at the same time
+        head1 = self.extractor.header(1)
+        nchips = max(min(nworkers if nworkers is not None else 1,self.nchips),1)
+        need = utils.workingset(head1['NAXIS1'],head1['NAXIS2'],nchips=nchips)
+        # The checkpoints and keep/ files always go on the shared tmproot so
+        #  the run can be resumed on another node
+        kind,tmpdir,statedir = utils.tempdirs(self.base,self.host,need,self.scratch,self.resume)
+        print("dirs, setup = ",basedir,os.path.dirname(tmpdir))
+        print("{:s} scratch, {:.1f} GB predicted for {:d} chips".format(kind,need/1e9,nchips))
+        if self.resume and os.path.exists(statedir):
+            print("resuming in state dir = ",statedir)
         print("temp dir = ",tmpdir)
-        while (os.path.exists(tmpdir)):
-            tmpcntr = tmpcntr+1
-            tmpdir = os.path.join(tmproot,self.base+"."+str(tmpcntr))
-            if tmpcntr > 20:
-                print("Temporary Directory counter getting too high. Exiting")
-                sys.exit()
-        if os.path.exists(tmpdir)==False:
-            os.makedirs(tmpdir)
+        for d in [tmpdir,statedir]:
+            if os.path.exists(d)==False:
+                os.makedirs(d)
         origdir = os.getcwd()
         self.origdir = origdir
         os.chdir(tmpdir)
         self.workdir = tmpdir
-        self.keepdir = os.path.join(tmpdir,'keep')
+        self.statedir = statedir
+        self.keepdir = os.path.join(statedir,'keep')
         if os.path.exists(self.keepdir)==False:
             os.makedirs(self.keepdir)
         
@@ -134,15 +249,20 @@ class Exposure:
         self.logger.info("Setting up in temporary directory "+tmpdir)
         self.logger.info("Starting logfile at "+self.logfile)
 
-        # Copy over images from zeus1:/mss or Download images from Astro Data Archive
+        # Bundle the final chip files as the chips finish
+        self.bundler = utils.MeasBundler(self.keepdir,self.base,compression=self.compression,
+                                         level=self.complevel,logger=self.logger)
+
+        # The chips are read directly from the original file with memory
+        #  mapping, just link to it instead of copying the whole exposure
         filename = "bigfile.fits"
-        shutil.copyfile(self.origfilename,os.path.join(tmpdir,os.path.basename(self.origfilename)))
         self.logger.info("  "+self.origfilename)
-        if (os.path.basename(self.origfilename) != filename):
-            os.symlink(os.path.basename(self.origfilename),filename)
+        if os.path.lexists(filename): os.remove(filename)
+        os.symlink(self.origfilename,filename)
 
         # Set local working filenames
-        self.filename = filename
+        #  use the absolute path so chips can be processed in subdirectories
+        self.filename = os.path.join(tmpdir,filename)
         
         # Make final output directory
         if not os.path.exists(self.outdir):
@@ -161,18 +281,19 @@ class Exposure:
             self.logger.warning("Local working filenames not set.  Make sure to run setup() first")
             return(False)
         try:
-            flux,fhead = fits.getdata(self.filename,extension,header=True)
-            fhead0 = fits.getheader(self.filename,0)  # add PDU info
-            fhead.extend(fhead0,unique=True)
+            flux = self.extractor.data(extension)
+            fhead = self.extractor.header(extension)  # includes PDU info
         except:
             self.logger.error("No extension "+str(extension))
             return(False)
-        # Write the data to the appropriate files
+        # Create the chip object
+        #  the chip file is only written when SExtractor/DAOPHOT need it
         if os.path.exists(filename):
             os.remove(filename)
-        fits.writeto(filename,flux,header=fhead,output_verify='warn')
-        # Create the chip object
-        self.chip = Chip(filename,self.base,self.host)
+        self.chip = Chip(filename,self.base,self.host,data=flux,header=fhead,
+                         fwhmmode=self.fwhmmode,daosession=self.daosession,alstiles=self.alstiles,
+                         psfworkers=self.psfworkers,psfstop=self.psfstop,psfcutout=self.psfcutout,
+                         apphot=self.apphot,seed=False,logger=self.logger)
         self.chip.meta['ccdnum'] = extension
         self.chip._ccdnum = extension
         self.chip.bigextension = extension
@@ -180,67 +301,208 @@ class Exposure:
         self.chip.keepdir = self.keepdir
         # Add logger information
         self.chip.logger = self.logger
+        # Stage timing
+        self.chip.timer = timing.StageTimer(chip=extension,logger=self.logger)
+        # Stage checkpoints
+        self.chip.checkpoint = self.chipcheckpoint(extension)
+        if self.resume and self.chip.checkpoint.load():
+            bad = self.chip.checkpoint.verify()
+            if len(bad)>0:
+                self.logger.warning(str(len(bad))+" files changed since the last checkpoint ("+
+                                    ", ".join([os.path.basename(f) for f in bad])+").  Starting chip over")
+                self.chip.checkpoint.reset()
+        # Initial FWHM, after the timer and the checkpoint are set up so it is
+        #  timed and not redone when resuming
+        self.chip.runstage('seedfwhm',self.chip.seedfwhm,self.fwhmmode)
         return True
 
+    # Checkpoint manifest of a chip
+    def chipcheckpoint(self,extension):
+        filename = os.path.join(self.statedir,'chip{:02d}.ckpt.json'.format(extension))
+        return checkpoint.ChipCheckpoint(filename,os.getcwd(),logger=self.logger)
+
+    # Check if a chip was completed by an earlier run
+    def chipdone(self,extension):
+        if self.resume==False:
+            return False
+        ckpt = self.chipcheckpoint(extension)
+        if ckpt.load()==False or ckpt.complete==False:
+            return False
+        bad = ckpt.verify()
+        if len(bad)>0:
+            self.logger.warning("Chip "+str(extension)+" final files are missing or changed, redoing it")
+            return False
+        return True
+
+    # Process a single chip
+    def processchip(self,extension):
+        t0 = time.time()
+        self.logger.info(" ")
+        self.logger.info("=== Processing subimage "+str(extension)+" ===")
+        # Already done by an earlier run
+        if self.chipdone(extension):
+            self.logger.info("Chip "+str(extension)+" already completed")
+            return True
+        # Load the chip
+        bl = self.loadchip(extension)
+        if bl==True:
+            self.logger.info("CCDNUM = "+str(self.chip.ccdnum))
+            try:
+                with self.chip.timer.stage('total'):
+                    # Process it
+                    self.chip.process()
+                    # Clean up
+                    self.chip.cleanup()
+            finally:
+                self.timingrows += self.chip.timer.rows
+            # Only the final files are needed now
+            keepfiles = glob(os.path.join(self.keepdir,self.base+"_"+str(self.chip.ccdnum)+".*"))
+            self.chip.checkpoint.finish(keepfiles)
+        self.logger.info("dt = "+str(time.time()-t0)+" seconds")
+        return bl
+
+    # Add the final files of a chip to the exposure bundles
+    def bundlechip(self,extension):
+        if self.bundler is None:
+            return
+        try:
+            self.bundler.addchip(extension)
+        except:
+            self.logger.error("Problem bundling chip "+str(extension))
+            self.logger.error(traceback.format_exc())
+
     # Process all chips
-    def process(self):
+    def process(self,nworkers=1):
         self.logger.info("-------------------------------------------------")
         self.logger.info("Processing ALL extension images")
         self.logger.info("-------------------------------------------------")
 
+        # Process the chips in parallel
+        if nworkers is not None and nworkers>1 and self.nchips>1:
+            self.processparallel(nworkers)
+            return
+
         # LOOP through the HDUs/chips
         #----------------------------
         for i in range(1,self.nexten):
-            t0 = time.time()
-            self.logger.info(" ")
-            self.logger.info("=== Processing subimage "+str(i)+" ===")
-            # Load the chip
-            bl = self.loadchip(i)
-            self.logger.info("CCDNUM = "+str(self.chip.ccdnum))
-            if bl==True:
-                # Process it
-                self.chip.process()
-                # Clean up
-                self.chip.cleanup()
-            self.logger.info("dt = "+str(time.time()-t0)+" seconds")
-            if 2==1:
-                chiptimes = Table.read(basedir+'lists/nsc_dr3_chiptimes.fits')
-                chiptimes.add_row([(str(self.filename).strip().split('/')[-1]).split('.')[0],i,
-                                   int(self.chip.ccdnum),int(nsrc),int(t1_check-t0)])
-                chiptimes = Table(np.unique(chiptimes))
-                chiptimes.write(basedir+'lists/nsc_dr3_chiptimes.fits',overwrite=True)
+            self.processchip(i)
+            self.bundlechip(i)
+
+    # Process the chips in parallel
+    def processparallel(self,nworkers):
+        nworkers = min(nworkers,self.nchips)
+        self.logger.info("Processing "+str(self.nchips)+" chips with "+str(nworkers)+" workers")
+        # Each chip gets its own subdirectory so the DAOPHOT/SExtractor
+        #  working files do not collide
+        extensions = list(range(1,self.nexten))
+        chipdirs = [os.path.join(self.workdir,'chip{:02d}'.format(i)) for i in extensions]
+        results = {}
+        nbundled = 0
+        with ProcessPoolExecutor(max_workers=nworkers) as executor:
+            futures = {executor.submit(_processchip_worker,self,i,d):i for i,d in zip(extensions,chipdirs)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except:
+                    self.logger.error("Problem processing chip "+str(i))
+                    self.logger.error(traceback.format_exc())
+                    results[i] = (False,os.path.join(chipdirs[i-1],'chip{:02d}.log'.format(i)),[])
+                # Bundle the chips in order while the others are still running
+                while nbundled<len(extensions) and extensions[nbundled] in results:
+                    self.bundlechip(extensions[nbundled])
+                    nbundled += 1
+        # Append the chip log messages to the exposure logfile in chip order
+        for handler in self.logger.handlers:
+            handler.flush()
+        for i in extensions:
+            chiplogfile = results[i][1]
+            if os.path.exists(chiplogfile):
+                with open(chiplogfile,'r') as f:
+                    lines = f.read()
+                with open(os.path.join(self.workdir,self.logfile),'a') as f:
+                    f.write(lines)
+            if results[i][0]==False:
+                self.logger.warning("Chip "+str(i)+" was not processed successfully")
+            self.timingrows += results[i][2]
+
+    # Write the stage timing table
+    def writetiming(self,outfile=None):
+        if outfile is None:
+            outfile = os.path.join(self.outdir,self.base+'_timing.fits')
+        timer = timing.StageTimer()
+        timer.rows = self.timingrows
+        tab = timer.table()
+        tab.meta['EXPOSURE'] = self.base
+        tab.write(outfile,overwrite=True)
+        self.logger.info('Timing information written to '+outfile)
 
     # Teardown
     def teardown(self):
+        self.extractor.close()
         # Move the final log file
         shutil.move(self.logfile,os.path.join(self.keepdir,self.base+".log"))
-        # Bundle files in the "keep" directory
-        utils.concatmeas(self.keepdir,self.base)
+        # Finish the bundles of the files in the "keep" directory
+        self.bundler.close()
         # Move the final bundled files
-        finalfiles = [os.path.join(self.keepdir,self.base+f) for f in ['_meas.fits','.tgz','.log']]
+        finalfiles = [os.path.join(self.keepdir,self.base+f) for f in
+                      ['_meas.fits',utils.tarext(self.compression),'.log']]
         for f in finalfiles:
             if os.path.exists(f):
                 self.logger.info('Moving '+f+' to '+self.outdir)
                 shutil.move(f,os.path.join(self.outdir,os.path.basename(f)))
             else:
                 self.logger.info(f+'not found')
+        self.writetiming()
         # Delete files and temporary directory
         self.logger.info("Deleting files and temporary directory.")
-        self.logger.info('Removing '+self.workdir)
-        shutil.rmtree(self.workdir)
+        for d in np.unique([self.workdir,self.statedir]):
+            self.logger.info('Removing '+d)
+            shutil.rmtree(d)
         # CD back to original directory
         os.chdir(self.origdir)
 
     # RUN all steps to process this exposure
-    def run(self):
-        self.setup()
-        self.process()
+    def run(self,nworkers=1):
+        self.setup(nworkers=nworkers)
+        self.process(nworkers=nworkers)
         self.teardown()
 
+
+# Process a single chip of an exposure in its own subdirectory
+def _processchip_worker(exp,extension,chipdir):
+    """ Process one chip in a worker process.  Returns the status, the chip logfile and timing."""
+    if os.path.exists(chipdir)==False:
+        os.makedirs(chipdir)
+    os.chdir(chipdir)
+    # Send the logging for this chip to its own logfile, it gets
+    #  added to the exposure logfile once all the chips are done
+    chiplogfile = os.path.join(chipdir,'chip{:02d}.log'.format(extension))
+    logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
+    rootLogger = logging.getLogger()
+    for handler in list(rootLogger.handlers):
+        rootLogger.removeHandler(handler)
+    fileHandler = logging.FileHandler(chiplogfile)
+    fileHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(fileHandler)
+    rootLogger.setLevel(logging.NOTSET)
+    exp.logger = rootLogger
+    try:
+        bl = exp.processchip(extension)
+    except:
+        exp.logger.error("Problem processing chip "+str(extension))
+        exp.logger.error(traceback.format_exc())
+        bl = False
+    fileHandler.close()
+    rootLogger.removeHandler(fileHandler)
+    return bl,chiplogfile,exp.timingrows
+
 # Class to represent a single chip of an exposure
 class Chip:
 
-    def __init__(self,filename,bigbase,host):
+    def __init__(self,filename,bigbase,host,data=None,header=None,fwhmmode='full',daosession=False,
+                 alstiles=1,psfworkers=1,psfstop='fixed',psfcutout=False,
+                 apphot='daophot',seed=True,logger=None):
         self.filename = filename
         self.bigbase = bigbase
         self.host = host
@@ -252,10 +514,14 @@ class Chip:
         self.dir = os.path.abspath(os.path.dirname(filename))
         self.base = base
         self.keepdir = None
-        header = fits.getheader(filename)
+        # Load the image, unless it was passed in
+        if data is None:
+            im,header = fits.getdata(filename,header=True)
+        else:
+            im = data
+        fhead = header.copy()
         self.meta = phot.makemeta(header=header)        
-        # Make wt and mask files
-        im,head = fits.getdata(filename,header=True)
+        # Make wt and mask images, kept in memory
         # Saturated pixels
         self.meta['saturate'] = 60000
         badpix = (im>60000)
@@ -264,13 +530,14 @@ class Chip:
         noise = np.maximum(noise,1)
         wt = 1/noise**2
         wt[badpix] = 0
-        fits.writeto('wt.fits',wt)
         self.wtfile = 'wt.fits'
         # Create mask image
         mask = np.zeros(im.shape,np.int16)
         mask[badpix] = 1
-        fits.writeto('mask.fits',mask)
         self.maskfile = 'mask.fits'
+        # The files are only written if a program needs them
+        self.images = ChipImages(im,wt,mask,fhead,files={'flux':self.filename,'wt':self.wtfile,
+                                                         'mask':self.maskfile})
         self.sexfile = self.dir+"/"+self.base+"_sex.fits"
         self.daofile = self.dir+"/"+self.base+"_dao.fits"
         self.sexcatfile = None
@@ -295,19 +562,119 @@ class Chip:
         self._sexmaglim = None    # set by runsex()
         self.sexiter = 1          #ktedit:sex2; to keep track of which SExtractor run we're on
         # Logger
-        self.logger = None
-        # Estimate FWHM=
-        im,head = fits.getdata(self.filename,header=True)
-        im = pm.ccddata.CCDData(im,header=head)
-        objects = pm.detection.detect(im,nsigma=10)
-        objects = pm.aperture.aperphot(im,objects)
-        fwhmpix = pm.utils.estimatefwhm(objects)
-        fwhmarcsec = fwhmpix*self.meta['pixscale']
-        self._fwhm = fwhmarcsec
-        self.meta['fwhm'] = fwhmarcsec
+        self.logger = logger
+        # Persistent DAOPHOT session, started when it's first needed
+        self.daosession = daosession
+        self._session = None
+        # Number of ALLSTAR tiles in X and Y
+        self.alstiles = alstiles
+        # Number of PSF analytic functions to fit at the same time
+        self.psfworkers = psfworkers
+        # Rule to end the PSF iterations, 'fixed' or 'predict'
+        self.psfstop = psfstop
+        # Run the PSF cleaning iterations on a mosaic of PSF star stamps
+        self.psfcutout = psfcutout
+        # Aperture photometry with DAOPHOT PHOTOMETRY ('daophot') or phot.aperphot ('native')
+        self.apphot = apphot
+        # Stage timing, set by the Exposure
+        self.timer = None
+        # Stage checkpoints, set by the Exposure
+        self.checkpoint = None
+        self.sexiterdone = False  # no more SExtractor iterations needed
+        self._nsn5first = None    # number of S/N>=5 sources in the first iteration
+        # Estimate FWHM, the Exposure does it later as a timed and checkpointed stage
+        self._fwhm = None
+        self.fwhmmode = fwhmmode
+        if seed:
+            self.seedfwhm(fwhmmode)
         
     def __repr__(self):
         return "Chip object"        
+
+    def stage(self,name):
+        """ Time a processing stage, if there is a timer."""
+        if self.timer is None:
+            return contextlib.nullcontext()
+        return self.timer.stage(name,iter=self.sexiter)
+
+    def runstage(self,name,func,*args,**kwargs):
+        """ Run a processing stage, unless an earlier run already completed it."""
+        if self.checkpoint is not None and self.checkpoint.done(name,self.sexiter):
+            self.logger.info(name+" (iteration "+str(self.sexiter)+") already done")
+            return
+        with self.stage(name):
+            func(*args,**kwargs)
+        if self.checkpoint is not None:
+            self.checkpoint.save(self,name)
+
+    @property
+    def session(self):
+        # Not using a persistent DAOPHOT session
+        if self.daosession==False:
+            return None
+        if self._session is None:
+            self._session = phot.DaophotSession(bindir=self.bindir,logger=self.logger)
+        return self._session
+
+    def closesession(self):
+        if self._session is not None:
+            self.logger.info("DAOPHOT session ran "+str(self._session.ncommands)+" commands")
+            self._session.close()
+        self._session = None
+
+    # Initial FWHM estimate
+    #----------------------
+    def seedfwhm(self,mode='full',ntiles=3,tilesize=1024,fwhm0=2.0):
+        """
+        Initial FWHM estimate (arcsec) used for the first SExtractor run.
+        mode='full' runs detection over the whole image, 'tiled' only uses
+        ntiles x ntiles subregions of size tilesize spread over the chip, and
+        'sex' uses fwhm0 (or the header seeing) until the first SExtractor
+        catalog is available.
+        """
+        logger = self.logger
+        if logger is None: logger=dln.basiclogger('phot')
+        t0 = time.time()
+        if mode=='full':
+            im = pm.ccddata.CCDData(self.images.flux,header=self.images.header)
+            objects = pm.detection.detect(im,nsigma=10)
+            objects = pm.aperture.aperphot(im,objects)
+            fwhmpix = pm.utils.estimatefwhm(objects)
+            fwhm = fwhmpix*self.meta['pixscale']
+        elif mode=='tiled':
+            ny,nx = self.images.flux.shape
+            tsize = np.minimum(tilesize,np.minimum(nx,ny)//ntiles)
+            # Tile centers evenly spaced in the chip
+            xcen = ((np.arange(ntiles)+0.5)*nx/ntiles).astype(int)
+            ycen = ((np.arange(ntiles)+0.5)*ny/ntiles).astype(int)
+            objlist = []
+            for yc in ycen:
+                for xc in xcen:
+                    x0 = np.maximum(xc-tsize//2,0)
+                    y0 = np.maximum(yc-tsize//2,0)
+                    tim = np.array(self.images.flux[y0:y0+tsize,x0:x0+tsize])
+                    tim = pm.ccddata.CCDData(tim,header=self.images.header)
+                    objects = pm.detection.detect(tim,nsigma=10)
+                    if objects is None or len(objects)==0: continue
+                    objects = pm.aperture.aperphot(tim,objects)
+                    objlist.append(objects)
+            if len(objlist)>0:
+                objects = vstack(objlist)
+                fwhmpix = pm.utils.estimatefwhm(objects)
+                fwhm = fwhmpix*self.meta['pixscale']
+            else:
+                logger.warning('No sources detected in FWHM tiles, using '+str(fwhm0)+' arcsec')
+                fwhm = fwhm0
+        elif mode=='sex':
+            # Placeholder, runsex() replaces it with the SExtractor FWHM
+            fwhm = self.meta.get('SEEING')
+            if fwhm is None: fwhm=fwhm0
+        else:
+            raise Exception("fwhmmode "+str(mode)+" not supported.  Use 'full', 'tiled' or 'sex'")
+        self._fwhm = fwhm
+        self.meta['fwhm'] = fwhm
+        logger.info('Initial FWHM = %5.2f arcsec (%s, %.2f sec)' % (fwhm,mode,time.time()-t0))
+        return fwhm
         
     @property
     def rdnoise(self):
@@ -425,15 +792,7 @@ class Chip:
         # We have it already, just return it
         if self._fwhm is not None:
             return self._fwhm
-        from prometheus import prometheus as pm
-        im,head = fits.getdata(self.filename,header=True)
-        im = pm.ccddata.CCDData(im,header=head)
-        objects = pm.detection.detect(im,nsigma=10)
-        objects = pm.aperture.aperphot(im,objects)
-        fwhm = pm.utils.estimatefwhm(objects)
-        self._fwhm = fwhm
-        self.meta['fwhm'] = fwhm
-        return self._fwhm
+        return self.seedfwhm('full')
 
     @property
     def maglim(self):
@@ -464,7 +823,7 @@ class Chip:
     #---------------------
     def runsex(self,dthresh=1.1,bindir="~/bin/",outfile=None):
         if self.sexiter==1: 
-            infile = self.filename
+            infile = self.images.file('flux')
             meta = self.meta
             sexcatfile = "flux_sex.cat.fits"
             offset = 0
@@ -481,6 +840,7 @@ class Chip:
         basedir, tmpdir = utils.getdirs(self.host)
         configdir = basedir+"config/"
         sexcat, maglim = phot.runsex(infile,self.wtfile,self.maskfile,meta,sexcatfile,configdir,
+                                     wt=self.images.wt,mask=self.images.mask,maskcache=self.images.grown,
                                      offset=offset,sexiter=self.sexiter,dthresh=dthresh,
                                      logger=self.logger,bindir=self.bindir) #ktedit:sex2
         sexcat.add_column(np.repeat(self.sexiter,len(sexcat)),name="NDET_ITER") # keep track of what SExtractor iteration each source is from
@@ -501,28 +861,20 @@ class Chip:
             # Set the FWHM as well
             fwhm = phot.sexfwhm(sexcat,logger=self.logger)
             self.meta['FWHM'] = fwhm
+            self._fwhm = fwhm
         # --If 2nd+ SExtractor iteration, compare sources with
         # those from previous iteration and combine catalogs 
         else: 
             sexcat = vstack([self.sexcat,sexcat])
             # lastsex -> newsexcat, restsex -> prevsexcat   
-            newsexcat = sexcat[sexcat['NDET_ITER']==self.sexiter]
-            prevsexcat = sexcat[sexcat['NDET_ITER']==(self.sexiter-1)]
-            for newsource in newsexcat:
-                dpix = 2
-                prevsexcat_close = prevsexcat[(prevsexcat['X_IMAGE']<(newsource['X_IMAGE']+dpix)) & 
-                                              (prevsexcat['X_IMAGE']>(newsource['X_IMAGE']-dpix)) & 
-                                              (prevsexcat['Y_IMAGE']<(newsource['Y_IMAGE']+dpix)) & 
-                                              (prevsexcat['Y_IMAGE']>(newsource['Y_IMAGE']-dpix))]
-                if len(prevsexcat_close)>0:
-                    for oldsource in prevsexcat_close:
-                        d_btwn_centers = np.sqrt((newsource['X_IMAGE']-oldsource['X_IMAGE'])**2 + 
-                                                 (newsource['Y_IMAGE']-oldsource['Y_IMAGE'])**2)
-                        if d_btwn_centers <= dpix:
-                            old_repeat_index = int(np.where(sexcat['NUMBER']==oldsource['NUMBER'])[0])
-                            new_repeat_index = int(np.where(sexcat['NUMBER']==newsource['NUMBER'])[0])
-                            sexcat[old_repeat_index]['REPEAT'] = 1
-                            sexcat[new_repeat_index]['REPEAT'] = 2
+            newind, = np.where(sexcat['NDET_ITER']==self.sexiter)
+            prevind, = np.where(sexcat['NDET_ITER']==(self.sexiter-1))
+            dpix = 2
+            ind1,ind2 = phot.repeatmatch(sexcat['X_IMAGE'][newind],sexcat['Y_IMAGE'][newind],
+                                         sexcat['X_IMAGE'][prevind],sexcat['Y_IMAGE'][prevind],dpix=dpix)
+            if len(ind1)>0:
+                sexcat['REPEAT'][prevind[ind2]] = 1
+                sexcat['REPEAT'][newind[ind1]] = 2
             self.sexcat = sexcat[sexcat['REPEAT']!=1]
 
     # Determine FWHM using SE catalog
@@ -549,14 +901,17 @@ class Chip:
         
     # Make image ready for DAOPHOT
     def mkdaoim(self):
-        phot.mkdaoim(self.filename,self.wtfile,self.maskfile,self.meta,self.daofile,logger=self.logger)
+        phot.mkdaoim(self.filename,self.wtfile,self.maskfile,self.meta,self.daofile,
+                     flux=self.images.flux,wt=self.images.wt,mask=self.images.mask,
+                     header=self.images.header,logger=self.logger)
 
     # DAOPHOT detection
     #----------------------
     def daofind(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        cat = phot.daofind(self.daofile,outfile=daobase+".coo",logger=self.logger,bindir=self.bindir)
+        cat = phot.daofind(self.daofile,outfile=daobase+".coo",logger=self.logger,bindir=self.bindir,
+                           session=self.session)
 
     # DAOPHOT aperture photometry
     #----------------------------
@@ -570,8 +925,12 @@ class Chip:
         else:
             coofile = daobase+str(self.sexiter)+".coo"
             outfile = daobase+str(self.sexiter)+".ap"
-        apcat, maglim = phot.daoaperphot(imfile,coofile,outfile=outfile,optfile=daobase+".opt",
-                                         logger=self.logger,bindir=self.bindir)
+        if self.apphot=='native':
+            apcat, maglim = phot.aperphot(imfile,coofile,outfile=outfile,optfile=daobase+".opt",
+                                          logger=self.logger)
+        else:
+            apcat, maglim = phot.daoaperphot(imfile,coofile,outfile=outfile,optfile=daobase+".opt",
+                                             logger=self.logger,bindir=self.bindir,session=self.session)
         if self.sexiter==1: self._daomaglim = maglim
 
     # Pick PSF stars using DAOPHOT
@@ -581,7 +940,7 @@ class Chip:
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         if maglim is None: maglim=self.maglim
         psfcat = phot.daopickpsf(self.daofile,daobase+".ap",maglim,daobase+".lst",nstars,
-                                 logger=self.logger,bindir=self.bindir)
+                                 logger=self.logger,bindir=self.bindir,session=self.session)
 
     # Run DAOPHOT PSF
     #-------------------
@@ -589,7 +948,7 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         psfcat = phot.daopsf(self.daofile,daobase+".lst",outfile=daobase+".psf",
-                             verbose=verbose,logger=self.logger,bindir=self.bindir)
+                             verbose=verbose,logger=self.logger,bindir=self.bindir,session=self.session)
 
     # Subtract neighbors of PSF stars
     #--------------------------------
@@ -597,14 +956,16 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         psfcat = phot.subpsfnei(self.daofile,daobase+".lst",daobase+".nei",
-                                daobase+"a.fits",logger=self.logger,bindir=self.bindir)
+                                daobase+"a.fits",logger=self.logger,bindir=self.bindir,session=self.session)
 
     # Create DAOPHOT PSF
     #-------------------
     def createpsf(self,listfile=None,apfile=None,doiter=True,maxiter=5,minstars=6,subneighbors=True,verbose=False):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        subit = phot.createpsf(daobase+".fits",daobase+".ap",daobase+".lst",meta=self.meta,logger=self.logger)
+        subit = phot.createpsf(daobase+".fits",daobase+".ap",daobase+".lst",meta=self.meta,logger=self.logger,
+                               session=self.session,bindir=self.bindir,psfworkers=self.psfworkers,
+                               psfstop=self.psfstop,psfcutout=self.psfcutout)
         self.subiter=subit
         
     # Run ALLSTAR
@@ -624,7 +985,7 @@ class Chip:
             outfile = daobase+str(self.sexiter)+".als"
         alscat = phot.allstar(imfile,daobase+".psf",apfile=apfile,subfile=subfile,
                               outfile=outfile,optfile=daobase+".als.opt",meta=meta,
-                              logger=self.logger,bindir=self.bindir) #ktedit:sex2
+                              logger=self.logger,bindir=self.bindir,ntiles=self.alstiles) #ktedit:sex2
 
 
     # Combine total + new SExtractor & ALLSTAR catalog files #ktedit:sex2; this function is new
@@ -659,15 +1020,17 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         apcorr = phot.apcor(daobase+"a.fits",daobase+".lst",daobase+".psf",self.meta,
-                            optfile=daobase+'.opt',alsoptfile=daobase+".als.opt",logger=self.logger)
+                            optfile=daobase+'.opt',alsoptfile=daobase+".als.opt",logger=self.logger,
+                            session=self.session,apphot=self.apphot)
         self.apcorr = apcorr
         self.meta['apcor'] = (apcorr,"Aperture correction in mags")
 
     # Combine SE and DAOPHOT catalogs
     #--------------------------------
-    def finalcat(self,outfile=None,both=True,sexdetect=True):
+    def finalcat(self,outfile=None,both=True,sexdetect=True,dcr=1.0):
         # both       Only keep sources that have BOTH SE and ALLSTAR information
         # sexdetect  SE catalog was used for DAOPHOT detection list
+        # dcr        Matching radius (pixels) if the DAOPHOT detection list was used
         self.logger.info("--  Creating final combined catalog --")
 
         daobase = os.path.basename(self.daofile)
@@ -675,85 +1038,37 @@ class Chip:
         if outfile is None: outfile=self.base+".cat.fits"
 
         # Check that we have the SE and ALS information
-        if (self.sexcat is None) | (os.path.exists(daobase+".als") is None):
+        if (self.sexcat is None) | (os.path.exists(daobase+".als")==False):
             self.logger.warning("SE catalog or ALS catalog NOT found")
             return
 
         # Load ALS catalog
-        als = Table(phot.daoread(daobase+".als")) 
-        nals = len(als)
-        # Apply aperture correction
+        als = phot.daoread(daobase+".als",cache=True)
+        # Need the aperture correction
         if self.apcorr is None:
             self.logger.error("No aperture correction available")
             return
-        als['MAG'] -= self.apcorr
-
-        # Just add columns to the SE catalog
-        ncat = len(self.sexcat)
-        newcat = self.sexcat.copy()
-        alsnames = ['X','Y','MAG','ERR','SKY','ITER','CHI','SHARP']
-        newnames = ['XPSF','YPSF','MAGPSF','ERRPSF','SKY','ITER',
-                    'CHI','SHARP','RAPSF','DECPSF']
-        newtypes = ['float64','float64','float','float','float','float',
-                    'float','float','float64','float64']
-        nan = float('nan')
-        newvals = [nan, nan, nan, nan ,nan, nan, nan, nan, nan, nan]
-        # DAOPHOT detection list used, need ALS ID
-        if not sexdetect:
-            alsnames = ['ID']+alsnames
-            newnames = ['ALSID']+newnames
-            newtypes = ['int32']+newtypes
-            newvals = [-1]+newvals
-        newcols = []
-        for n,t,v in zip(newnames,newtypes,newvals):
-            col = Column(name=n,length=ncat,dtype=t)
-            col[:] = v
-            newcols.append(col)
-        newcat.add_columns(newcols)
-        # Match up with IDs if SE list used by DAOPHOT
-        if sexdetect:
-            mid, ind1, ind2 = np.intersect1d(newcat["NUMBER"],als["ID"],return_indices=True)
-            for id1,id2 in zip(newnames,alsnames):
-                newcat[id1][ind1] = als[id2][ind2]
-            # Only keep sources that have SE+ALLSTAR information
-            #  trim out ones that don't have ALS
-            if (both is True) & (nals<ncat):
-                newcat = newcat[ind1]
-            #self.logger.info("newcat has "+str(len(newcat))+" lines") #ktedit:sex2
-
-        # Match up with coordinates, DAOPHOT detection list used
-        else:
-            print("Need to match up with coordinates")
-            # Only keep sources that have SE+ALLSTAR information
-            #  trim out ones that don't have ALS
-            if (both is True) & (nals<ncat): newcat = newcat[ind1]
-
-        # Add RA, DEC
-        r,d = self.wcs.all_pix2world(newcat["XPSF"],newcat["YPSF"],1)
-        newcat['RAPSF'] = r
-        newcat['DECPSF'] = d        
-        #self.logger.info("length of final catalog = "+str(len(newcat))) #ktedit:sex2
-
-        # Write to file
+
+        # Add the ALLSTAR columns to the SE catalog
+        cat = phot.mergecat(self.sexcat,als,self.apcorr,wcs=self.wcs,both=both,
+                            sexdetect=sexdetect,dcr=dcr,logger=self.logger)
+        #self.logger.info("length of final catalog = "+str(len(cat))) #ktedit:sex2
+
+        # Write to file, meta in PDU header and the table in extension 1
         self.logger.info("Final catalog = "+outfile)
-        fits.writeto(outfile,None,self.meta,overwrite=True)  # meta in PDU header
-        #  append the table in extension 1
-        hdulist = fits.open(outfile)
-        hdu = fits.table_to_hdu(newcat)
-        hdulist.append(hdu)
-        hdulist.writeto(outfile,overwrite=True)
-        hdulist.close()
-        #newcat.write(outfile,overwrite=True)
-        #fits.append(outfile,0,self.meta)  # meta is header of 2nd extension
+        phot.writecat(outfile,cat,self.meta,template=self.sexcat)
 
 
     # Process a single chip
     #----------------------
     def process(self):
 
-        # Set up SE iteration
-        sexiter_endflag = 0
-        while (sexiter_endflag==0):
+        # Pick up where an earlier run stopped
+        if self.checkpoint is not None and len(self.checkpoint.stages)>0:
+            self.checkpoint.restore(self)
+
+        # SE iterations
+        while (self.sexiterdone==False):
 
             # For every iteration, run Source Extractor
             self.logger.info("-- SExtractor run "+str(self.sexiter)+" --")
@@ -764,7 +1079,7 @@ class Chip:
             else:
                 sex_dt = 1.1
 
-            self.runsex(dthresh=sex_dt,bindir=self.bindir)
+            self.runstage('runsex',self.runsex,dthresh=sex_dt,bindir=self.bindir)
 
             # Get the info for this iteration's catalog
             nowcat = self.sexcat[self.sexcat['NDET_ITER']==self.sexiter]  # cat for current SE iteration
@@ -772,16 +1087,15 @@ class Chip:
             self.logger.info(str(len(nowcat))+" new sources detected")
             nowcat_sn5 = nowcat[1/nowcat['MAGERR_AUTO']>=5]               # select only the entries with SN>=5
             if self.sexiter==1: 
-                ogcat = nowcat                                            # to check the current cat against the first one
-                ogcat_sn5 = nowcat_sn5
+                self._nsn5first = len(nowcat_sn5)                         # to check the current cat against the first one
 
             # Perform aperture photometry and PSF fitting with DAOPHOT
             self.logger.info("-- Getting ready to run DAOPHOT --")
 
             # for first iteration only, make DAO-ready files
             if self.sexiter==1:
-                self.mkopt()
-                self.mkdaoim()
+                self.runstage('mkopt',self.mkopt)
+                self.runstage('mkdaoim',self.mkdaoim)
             
             # Convert SE cat to DAO format
             #self.daodetect()
@@ -791,19 +1105,21 @@ class Chip:
                 sdao_ofile = "flux_dao.coo"          # select aperphot output filename
             else:
                 sdao_ofile = "flux_dao"+str(self.sexiter)+".coo"
-            self.sextodao(outfile=sdao_ofile)
+            self.runstage('sextodao',self.sextodao,outfile=sdao_ofile)
 
-            self.daoaperphot()
+            self.runstage('daoaperphot',self.daoaperphot)
 
             # For first iteration only, fit PSF 
             if self.sexiter==1:
-                self.daopickpsf()   
-                self.createpsf()
+                self.runstage('daopickpsf',self.daopickpsf)
+                self.runstage('createpsf',self.createpsf)
 
             # Combine SE cats, run ALLSTAR, combine ALLSTAR cats
-            if self.sexiter>1: self.combine_cats(type="sexcat")           
-            self.allstar()
-            if self.sexiter>1: self.combine_cats(type="alscat")                      
+            if self.sexiter>1:
+                self.runstage('combine_sexcat',self.combine_cats,type="sexcat")
+            self.runstage('allstar',self.allstar)
+            if self.sexiter>1:
+                self.runstage('combine_alscat',self.combine_cats,type="alscat")
 
             # Check to see if we've run enough SExtractor iterations
             # Requirements to end:
@@ -811,13 +1127,15 @@ class Chip:
             # - median S/N of latest SE cat <=5
             # - #sources for which S/N>=5 latest cat is less than 25% #sources (also S/N>=5) in first cat
             if (self.sexiter>2 and (self.sexiter==4 or (np.median(1/nowcat['MAGERR_AUTO'])<=5) or
-                                    (len(nowcat_sn5)<(.25*len(ogcat_sn5))))):
-                sexiter_endflag = 1
+                                    (len(nowcat_sn5)<(.25*self._nsn5first)))):
+                self.sexiterdone = True
             self.sexiter += 1
+            if self.checkpoint is not None:
+                self.checkpoint.save(self,'iteration',self.sexiter-1)
 
         # Get aperture correction, create final cat from SE + ALLSTAR cats
-        self.getapcor()
-        self.finalcat()
+        self.runstage('getapcor',self.getapcor)
+        self.runstage('finalcat',self.finalcat)
 
         # David's notes:------------------------------------------------------------------------------------
 
@@ -836,6 +1154,8 @@ class Chip:
     # Clean up the files
     #--------------------
     def cleanup(self):
+        # Stop the DAOPHOT session
+        self.closesession()
         # Move files we want to keep to temporary "keep" subdirectory
         self.logger.info("Copying final files to 'keep' directory "+self.keepdir)
         base = os.path.basename(self.filename)
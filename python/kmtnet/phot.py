@@ -26,12 +26,20 @@ import logging
 #from scipy.signal import convolve2d
 from dlnpyutils.utils import *
 from scipy.ndimage.filters import convolve
+from scipy.spatial import cKDTree
+from scipy.optimize import least_squares
 import astropy.stats
 import struct
 import tempfile
+import threading
 import time
 import traceback
+import re
+import itertools
+import glob
+from concurrent.futures import ThreadPoolExecutor
 from .slurm_funcs import *
+from . import timing
 
 pd.set_option('display.max_columns',None)
 
@@ -311,8 +319,86 @@ def aperswrite(filename=None,apertures=None):
     f.close()
 
 
+# Fixed-width columns of DAOPHOT files
+def daocols(lines,lengths,dtypes):
+    '''
+    Slice fixed-width columns out of all the lines of a DAOPHOT file at once.
+    Blank fields are returned as 0.
+
+    Parameters
+    ----------
+    lines : list
+          The list of lines (without the header).
+    lengths : list or array
+            The widths of the columns.
+    dtypes : list
+           The data types of the columns.
+
+    Returns
+    -------
+    cols : list
+         The list of column arrays.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        idcol,x,y = daocols(lines[3:],[7,9,9],[int,float,float])
+
+    '''
+
+    lengths = np.array(lengths)
+    width = np.sum(lengths)
+    # Pad all lines to the same width and read them as one buffer
+    text = ''.join([l[0:width].ljust(width) for l in lines]).encode('ascii',errors='replace')
+    sdtype = np.dtype([('c'+str(i),'S'+str(n)) for i,n in enumerate(lengths)])
+    arr = np.frombuffer(text,dtype=sdtype)
+    cols = []
+    for i,dt in enumerate(dtypes):
+        col = arr['c'+str(i)]
+        blank = (col==b' '*lengths[i])
+        if np.sum(blank)>0:
+            col = col.copy()
+            col[blank] = b'0'
+        cols.append(col.astype(dt))
+    return cols
+
+
+# Cache of parsed DAOPHOT files
+#-------------------------------
+def daocachekey(fil):
+    """ Key for the daoread cache, changes when the file is rewritten."""
+    st = os.stat(fil)
+    return np.array([os.path.abspath(fil),str(st.st_size),str(st.st_ino),str(st.st_mtime_ns)])
+
+def daocacheread(fil):
+    """ Load the cached catalog of a DAOPHOT file, None if it's missing or stale."""
+    cachefile = fil+'.npz'
+    if os.path.exists(cachefile) is False:
+        return None
+    try:
+        with np.load(cachefile,allow_pickle=False) as data:
+            if np.array_equal(data['key'],daocachekey(fil)) is False:
+                return None
+            return data['cat']
+    except:
+        return None
+
+def daocachewrite(fil,cat):
+    """ Write the cache file for a DAOPHOT file."""
+    cachefile = fil+'.npz'
+    tid,tfile = tempfile.mkstemp(prefix=os.path.basename(cachefile),dir=os.path.dirname(os.path.abspath(fil)))
+    try:
+        with os.fdopen(tid,'wb') as f:
+            np.savez(f,cat=cat,key=daocachekey(fil))
+        os.replace(tfile,cachefile)
+    except:
+        if os.path.exists(tfile): os.remove(tfile)
+
+
 # Read DAOPHOT files
-def daoread(fil):
+def daoread(fil,cache=False):
     '''
     This program reads in DAOPHOT-style files and return an astropy table.
     The supported types are .coo, .lst, .ap (in development), and .als.
@@ -321,6 +407,11 @@ def daoread(fil):
     ----------
     fil : str
         The filename of the DAOPHOT catalog file.
+    cache : bool, optional
+          Keep the parsed catalog in a binary sidecar file (`fil` + ".npz") and use it
+          on later reads.  The cache is keyed on the file path, size, inode and
+          modification time, so it is not used once the file is rewritten.
+          Default is False.
 
     Returns
     -------
@@ -346,10 +437,15 @@ def daoread(fil):
     if os.path.exists(fil) is False:
         print(fil+" NOT found")
         return None
+    # Use the cached catalog
+    if cache:
+        cat = daocacheread(fil)
+        if cat is not None:
+            return Table(cat)
     lines = readlines(fil)
     nstars = len(lines)-3
     if nstars == 0:
-        print("No stars in "+file)
+        print("No stars in "+fil)
         return None
     # Check header
     line2 = lines[1]
@@ -365,18 +461,11 @@ def daoread(fil):
     if len(arr1)==0: arr1 = lines[4].split()
     ncols = len(arr1)
 
+    cat = None
     # NL = 1  coo file
     if (nl==1) & (ncols==7):
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('SHARP',float),('ROUND',float),('ROUND2',float)])
-        cat = np.zeros(nstars,dtype=dtype)
         lengths = np.array([7,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            for j in range(len(names)):
-                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
     # NL = 1  tot file
     elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is True):
         # NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
@@ -385,28 +474,11 @@ def daoread(fil):
         #     11  454.570   37.310  13.9710   0.0084  164.683   14.040  -0.0690        6
         #     36  287.280   93.860  14.5110   0.0126  165.018   14.580  -0.0690        6
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('MAGFAP',float),('APCORR',float),('FINALAP',int)])
-        cat = np.zeros(nstars,dtype=dtype)
         lengths = np.array([7,9,9,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            for j in range(len(names)):
-                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
-
     # NL = 1  als file
     elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is False):
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('ITER',float),('CHI',float),('SHARP',float)])
-        cat = np.zeros(nstars,dtype=dtype)
         lengths = np.array([7,9,9,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            for j in range(len(names)):
-                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
     # NL = 2  aperture photometry
     elif nl==2:
         #
@@ -420,61 +492,47 @@ def daoread(fil):
         #                   Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.
         ncols = len(lines[4].split())
         naper = ncols-3   # apertures
-        nstars = int((numlines(fil)-3.0)/3.0)  # stars
+        nstars = int((len(lines)-3.0)/3.0)  # stars
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('SKY',float),('SKYSIG',float),('SKYSKEW',float),('MAG',float,naper),('ERR',float,naper)])
         cat = np.zeros(nstars,dtype=dtype)
-        # for line 1
+        # line 1
+        # ID, X, Y, Mag1, Mag2, etc.. 
         lengths1 = np.concatenate([np.array([7,9,9]),np.zeros(naper,dtype=int)+9])
-        dtype1 = np.concatenate([np.array([7,9,9]),np.zeros(naper,dtype=int)+9])
-        lo1 = np.concatenate((np.array([0]), np.cumsum(lengths1[0:-1])))
-        hi1 = lo1+lengths1
-        names1 = ['ID','X','Y']+['MAG'+f for f in (np.arange(naper)+1).astype(str)]
-        # for line 2
+        cols1 = daocols(lines[4:nstars*3+4:3],lengths1,[int,float,float]+naper*[float])
+        cat['ID'] = cols1[0]
+        cat['X'] = cols1[1]
+        cat['Y'] = cols1[2]
+        cat['MAG'] = np.vstack(cols1[3:]).T
+        # line 2
+        # Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.  
         lengths2 = np.concatenate([np.array([14,6,6]),np.zeros(naper,dtype=int)+9])
-        lo2 = np.concatenate((np.array([0]), np.cumsum(lengths2[0:-1])))
-        hi2 = lo2+lengths2
-        names1 = ['SKY','SKYSIG','SKYSKEW']+['ERR'+f for f in (np.arange(naper)+1).astype(str)]
-        for i in range(nstars):
-            # line 1
-            # ID, X, Y, Mag1, Mag2, etc.. 
-            line1 = lines[i*3+4]
-            cat[i]['ID'] = int(line1[lo1[0]:hi1[0]])
-            cat[i]['X'] = float(line1[lo1[1]:hi1[1]])
-            cat[i]['Y'] = float(line1[lo1[2]:hi1[2]])
-            mag = np.zeros(naper,dtype=float)
-            for j in range(naper):
-                mag[j] = np.array(line1[lo1[j+3]:hi1[j+3]],dtype=float)
-            cat[i]['MAG'] = mag
-            # line 2
-            # Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.  
-            line2 = lines[i*3+5]
-            cat[i]['SKY'] = float(line2[lo2[0]:hi2[0]])
-            cat[i]['SKYSIG'] = float(line2[lo2[1]:hi2[1]])
-            cat[i]['SKYSKEW'] = float(line2[lo2[2]:hi2[2]])
-            err = np.zeros(naper,dtype=float)
-            for j in range(naper):
-                err[j] = np.array(line2[lo2[j+3]:hi2[j+3]],dtype=float)
-            cat[i]['ERR'] = err
+        cols2 = daocols(lines[5:nstars*3+5:3],lengths2,(naper+3)*[float])
+        cat['SKY'] = cols2[0]
+        cat['SKYSIG'] = cols2[1]
+        cat['SKYSKEW'] = cols2[2]
+        cat['ERR'] = np.vstack(cols2[3:]).T
     # NL = 3  list
     elif nl==3:
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float)])
-        cat = np.zeros(nstars,dtype=dtype)
-        lengths = np.array([7,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            nline1 = len(line1)
-            for j in range(len(names)):
-                # someimtes lst files are missing the SKY column
-                if hi[j]<=nline1:
-                    cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
-                else:
-                    print('Warning: cannot read column '+names[j]+' for line '+str(i+1))
+        lengths = np.array([7,9,9,9,9,9])
+        # someimtes lst files are missing the SKY column
+        hi = np.cumsum(lengths)
+        nline = np.array([len(l) for l in lines[3:]])
+        for i in np.where(nline<hi[-1])[0]:
+            for j in np.where(hi>nline[i])[0]:
+                print('Warning: cannot read column '+dtype.names[j]+' for line '+str(i+1))
     else:
         print("Cannot load this file")
         return None
+    # Slice all the columns at once
+    if cat is None:
+        cat = np.zeros(nstars,dtype=dtype)
+        cols = daocols(lines[3:],lengths,[dtype[n] for n in dtype.names])
+        for n,col in zip(dtype.names,cols):
+            cat[n] = col
+    # Save to the cache
+    if cache:
+        daocachewrite(fil,cat)
     # Return as astropy Table
     return Table(cat)
 
@@ -563,6 +621,49 @@ def makemeta(fluxfile=None,header=None):
     return meta
 
 
+# Write table rows with a fixed format
+def writerows(f,fmt,cols,chunksize=50000):
+    '''
+    Write rows of columns to an open file with a %-format, in chunks of
+    lines at a time.  This is much faster than looping over table rows.
+
+    Parameters
+    ----------
+    f : file object
+      The file to write to.
+    fmt : str
+        The %-format of one line (including the newline).
+    cols : list
+         The columns (arrays), or constants that are the same for every row.
+    chunksize : int, optional
+              The number of lines to write at a time.  Default is 50000.
+
+    Returns
+    -------
+    Nothing is returned.  The lines are written to `f`.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        writerows(f,"%7d %8.2f %8.2f\\n",[cat["NUMBER"],cat["X_IMAGE"],0.0])
+
+    '''
+    nrows = None
+    for c in cols:
+        if np.ndim(c)>0:
+            nrows = len(c)
+            break
+    if nrows is None or nrows==0:
+        return
+    for lo in range(0,nrows,chunksize):
+        hi = np.minimum(lo+chunksize,nrows)
+        # tolist() gives python numbers, which format the same as the numpy scalars
+        chunk = [np.asarray(c)[lo:hi].tolist() if np.ndim(c)>0 else itertools.repeat(c) for c in cols]
+        f.write(''.join([fmt % r for r in zip(*chunk)]))
+
+
 # Write SE catalog in DAO format
 def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=None,
              saturate=None,rdnoise=None,gain=None,lowbad=None,thresh=None,logger=None):
@@ -674,9 +775,8 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         f.write("\n")
         #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
         # Write the data
-        for e in cat:
-            f.write("%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f\n" %
-                    (e["NUMBER"],e["X_IMAGE"],e["Y_IMAGE"],e["MAG_AUTO"],0.6,0.0,0.0))
+        writerows(f,"%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f\n",
+                  [cat["NUMBER"],cat["X_IMAGE"],cat["Y_IMAGE"],cat["MAG_AUTO"],0.6,0.0,0.0])
         f.close()
 
     # "lst" file from PICKPSF
@@ -696,9 +796,9 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         f.write("\n")
         #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
         # Write the data
-        for e in cat:
-            f.write("%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n" %
-                    (e["NUMBER"],e["X_IMAGE"]+1,e["Y_IMAGE"]+1,e["MAG_AUTO"],e["MAGERR_AUTO"],0.3))
+        writerows(f,"%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n",
+                  [cat["NUMBER"],np.asarray(cat["X_IMAGE"])+1,np.asarray(cat["Y_IMAGE"])+1,
+                   cat["MAG_AUTO"],cat["MAGERR_AUTO"],0.3])
         f.close()
 
     # "ap" file from PHOTOMETRY
@@ -723,9 +823,9 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         f.write("\n")
         #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
         # Write the data
-        for e in cat:
-            f.write("%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n" %
-                    (e["NUMBER"],e["X_IMAGE"]+1,e["Y_IMAGE"]+1,e["MAG_AUTO"],e["MAGERR_AUTO"],1500.0,1,1.0,0.0))
+        writerows(f,"%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n",
+                  [cat["NUMBER"],np.asarray(cat["X_IMAGE"])+1,np.asarray(cat["Y_IMAGE"])+1,
+                   cat["MAG_AUTO"],cat["MAGERR_AUTO"],1500.0,1,1.0,0.0])
         f.close()
 
     # Not supported
@@ -734,10 +834,176 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         return
 
 
+# SExtractor configuration
+#-------------------------
+class SexConfig:
+    '''
+    The SExtractor configuration template (default.config) of a config directory.
+    It is only parsed once per process, use SexConfig.get(configdir).  write()
+    fills in the values for one run in a single pass over the template lines,
+    and link() hard-links (or symlinks) the support files into the working
+    directory instead of copying them.
+
+    Parameters
+    ----------
+    configdir : str
+              The directory that contains the Source Extractor configuration files.
+              default.config, default.conv, default.nnw, default.param
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        sexconfig = SexConfig.get("/data/config/")
+        sexconfig.link()
+        sexconfig.write("default.config",outfile="cat.fits",flagimage="mask.fits",
+                        weightimage="wt.fits",meta=meta,dthresh=1.1)
+
+    '''
+
+    # Parameters set for each run, lines starting with these are replaced
+    keys = ['CATALOG_NAME','FLAG_IMAGE','WEIGHT_IMAGE','SATUR_LEVEL','GAIN','CHECKIMAGE_TYPE',
+            'CHECKIMAGE_NAME','DETECT_THRESH','ANALYSIS_THRESH','SEEING_FWHM','PHOT_APERTURES']
+    support = ['default.conv','default.nnw','default.param']
+    _cache = {}
+
+    def __init__(self,configdir):
+        self.configdir = configdir
+        self.configfile = os.path.join(configdir,'default.config')
+        self.lines = readlines(self.configfile)
+        # Find the lines to replace, and the filter
+        regex = re.compile('^('+'|'.join(self.keys)+')')
+        self.linekeys = []
+        self.filter_name = ''
+        for l in self.lines:
+            m = regex.match(l)
+            self.linekeys.append(m.group(1) if m is not None else None)
+            if l.startswith('FILTER_NAME'):
+                self.filter_name = (l.split())[1]
+        self._kernel = None
+
+    def __repr__(self):
+        return "SexConfig("+self.configfile+")"
+
+    @classmethod
+    def get(cls,configdir):
+        """ Get the (cached) configuration for a config directory."""
+        configfile = os.path.join(configdir,'default.config')
+        key = (os.path.abspath(configfile),os.stat(configfile).st_mtime_ns)
+        if key not in cls._cache:
+            cls._cache[key] = cls(configdir)
+        return cls._cache[key]
+
+    def link(self,outdir='.'):
+        """ Link the support files into the working directory."""
+        for f in self.support:
+            src = os.path.abspath(os.path.join(self.configdir,f))
+            dst = os.path.join(outdir,f)
+            if os.path.lexists(dst):
+                if os.path.exists(dst) and os.path.samefile(src,dst): continue
+                os.remove(dst)
+            try:
+                os.link(src,dst)
+            except OSError:
+                os.symlink(src,dst)   # different filesystem
+
+    def kernel(self):
+        """ The filter kernel used to grow the mask, two pixels larger than the filter."""
+        if self._kernel is None and self.filter_name!='':
+            with open(os.path.join(self.configdir,self.filter_name),'r') as f:
+                f.readline()
+                shape = f.readline().split(' ')[1]
+            self._kernel = np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
+        return self._kernel
+
+    def render(self,outfile,flagimage,weightimage,meta,sexiter=1,dthresh=2.0,
+               apertures=[0.5,1.0,2.0,3.0,4.0],overrides=None):
+        """ The configuration lines for one run.  apertures are radii in arcsec,
+            overrides is a dictionary of other parameters to set."""
+        aper_world = np.array(apertures) * 2  # radius->diameter
+        aper_pix = aper_world / meta["pixscale"]
+        vals = {'CATALOG_NAME':"CATALOG_NAME     "+outfile+"         # name of the output catalog\n",
+                'FLAG_IMAGE':"FLAG_IMAGE     "+flagimage+"         # filename for an input FLAG-image\n",
+                'WEIGHT_IMAGE':"WEIGHT_IMAGE     "+weightimage+"  # Weight image name\n",
+                'SATUR_LEVEL':"SATUR_LEVEL     "+str(meta["saturate"])+"         # level (in ADUs) at which arises saturation\n",
+                'GAIN':"GAIN            "+str(meta["gain"])+"            # detector gain in e-/ADU.\n",
+                'CHECKIMAGE_TYPE':"CHECKIMAGE_TYPE SEGMENTATION",
+                'CHECKIMAGE_NAME':"CHECKIMAGE_NAME seg_"+str(sexiter)+".fits",
+                'DETECT_THRESH':"DETECT_THRESH   "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2",
+                'ANALYSIS_THRESH':"ANALYSIS_THRESH "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2",
+                'SEEING_FWHM':"SEEING_FWHM     "+str(meta["fwhm"])+"            # stellar FWHM in arcsec\n",
+                'PHOT_APERTURES':"PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"}
+        lines = [l if k is None else vals[k] for l,k in zip(self.lines,self.linekeys)]
+        if overrides is not None:
+            for i,l in enumerate(lines):
+                words = l.split()
+                if len(words)>0 and words[0] in overrides:
+                    lines[i] = words[0]+"  "+str(overrides[words[0]])
+        return [line + '\n' for line in lines]
+
+    def write(self,filename='default.config',**kwargs):
+        """ Write the configuration file for one run, see render()."""
+        lines = self.render(**kwargs)
+        if os.path.exists(filename): os.remove(filename)
+        with open(filename,'w') as fo:
+            fo.writelines(lines)
+        return filename
+
+
+# Grow masked regions
+#--------------------
+def growmask(mask,shape):
+    '''
+    Binary dilation of the masked (>0) pixels with a box of size `shape`.
+    This gives the same result as convolve(mask,np.ones(shape),mode="reflect")>0
+    for non-negative masks, but the box is separable so it is done with
+    shifted ORs of boolean arrays along each axis.
+
+    Parameters
+    ----------
+    mask : numpy array
+         The 2D mask image.
+    shape : tuple
+          The box size (ny,nx).
+
+    Returns
+    -------
+    grown : numpy boolean array
+          Pixels within the box of a masked pixel.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        grown = growmask(mask,(5,5))
+
+    '''
+    grown = (mask > 0)
+    for axis,size in enumerate(shape):
+        if size<=1: continue
+        # Same box position as ndimage.convolve, also for even sizes
+        lo = (size-1)//2
+        hi = size-1-lo
+        n = grown.shape[axis]
+        pad = [(0,0)]*grown.ndim
+        pad[axis] = (lo,hi)
+        padded = np.pad(grown,pad,mode='symmetric')   # ndimage "reflect"
+        out = np.zeros_like(grown)
+        for k in range(size):
+            sl = [slice(None)]*grown.ndim
+            sl[axis] = slice(k,k+n)
+            out |= padded[tuple(sl)]
+        grown = out
+    return grown
+
+
 # Run Source Extractor
 #---------------------
 def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,configdir=None,
-           offset=0,sexiter=1,dthresh=2.0,logfile=None,logger=None,bindir=None): #ktedit:sex2
+           offset=0,sexiter=1,dthresh=2.0,logfile=None,logger=None,bindir=None,
+           wt=None,mask=None,maskcache=None): #ktedit:sex2
     '''
     Run Source Extractor on an exposure.  The program is configured to work with files
     created by the NOAO Community Pipeline.
@@ -767,6 +1033,12 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    wt : numpy array, optional
+       The weight image already in memory.  If this is input then `wtfile` is not read.
+    mask : numpy array, optional
+         The mask image already in memory.  If this is input then `maskfile` is not read.
+    maskcache : dict, optional
+              Dictionary to keep the grown mask in for the next runs on the same image.
 
     Returns
     -------
@@ -813,8 +1085,8 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
         return
 
     # Check that necessary files exist
-    for f in [fluxfile,wtfile,maskfile]:
-        if os.path.exists(f) is False:
+    for f,arr in zip([fluxfile,wtfile,maskfile],[None,wt,mask]):
+        if arr is None and os.path.exists(f) is False:
             logger.warning(f+" NOT found")
             return None
 
@@ -829,38 +1101,36 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     smaskfile = sexbase+".mask.fits"
 
     if os.path.exists(outfile): os.remove(outfile)
-    if os.path.exists(sfluxfile): os.remove(sfluxfile)
+    if os.path.lexists(sfluxfile): os.remove(sfluxfile)
     if os.path.exists(swtfile): os.remove(swtfile)
     if os.path.exists(smaskfile): os.remove(smaskfile)
     if os.path.exists(logfile): os.remove(logfile)
 
-    # Load the data
-    flux,fhead = fits.getdata(fluxfile,header=True)
-    wt,whead = fits.getdata(wtfile,header=True)
-    mask,mhead = fits.getdata(maskfile,header=True)
+    # Load the data, unless it is already in memory
+    #  the flux image is only needed by SExtractor itself
+    if wt is None:
+        wt,whead = fits.getdata(wtfile,header=True)
+    else:
+        whead = None
+    if mask is None:
+        mask,mhead = fits.getdata(maskfile,header=True)
+    else:
+        mhead = None
 
     # 3a) Make subimages for flux, weight, mask
 
     # Mask out bad pixels in WEIGHT image
     #  set wt=0 for mask>0 pixels
-    wt[ (mask>0) | (wt<0) ] = 0   # CP sets bad pixels to wt=0 or sometimes negative
+    #  don't modify the input array in place
+    wt = np.where((mask>0) | (wt<0), 0, wt)   # CP sets bad pixels to wt=0 or sometimes negative
 
     # Write out the files
-    shutil.copy(fluxfile,sfluxfile)
+    os.symlink(os.path.abspath(fluxfile),sfluxfile)
     fits.writeto(swtfile,wt,header=whead,output_verify='warn')
 
 
     # 3b) Make SExtractor config files
-    # Copy the default files
-    shutil.copyfile(configdir+"default.conv","default.conv")
-    shutil.copyfile(configdir+"default.nnw","default.nnw")
-    shutil.copyfile(configdir+"default.param","default.param")
-
-    # Read in configuration file and modify for this image
-    lines = readlines(configdir+'default.config')
-
-    # Gain, saturation, pixscale
-
+    #  the template is only read once per process
     # Things to change
     # SATUR_LEVEL     59000.00         # level (in ADUs) at which arises saturation
     # GAIN            43.52             # detector gain in e-/ADU.
@@ -870,102 +1140,27 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     # CHECKIMAGE_NAME segment.fits
     # DETECT_THRESH    1.1 originally, will be changed depending on density/fwhm #ktedit:sex2
     # ANALYSIS_THRESH   same as DETECT_THRESH                                    #ktedit:sex2
-    
-    filter_name = ''
-    cnt = 0
-    for l in lines:
-        # CATALOG_NAME
-        m = re.search('^CATALOG_NAME',l)
-        if m != None:
-            lines[cnt] = "CATALOG_NAME     "+outfile+"         # name of the output catalog\n"
-        # FLAG_IMAGE
-        m = re.search('^FLAG_IMAGE',l)
-        if m != None:
-            lines[cnt] = "FLAG_IMAGE     "+smaskfile+"         # filename for an input FLAG-image\n"
-        # WEIGHT_IMAGE
-        m = re.search('^WEIGHT_IMAGE',l)
-        if m != None:
-            lines[cnt] = "WEIGHT_IMAGE     "+swtfile+"  # Weight image name\n"
-        # SATUR_LEVEL
-        m = re.search('^SATUR_LEVEL',l)
-        if m != None:
-            lines[cnt] = "SATUR_LEVEL     "+str(meta["saturate"])+"         # level (in ADUs) at which arises saturation\n"
-        # Gain
-        m = re.search('^GAIN',l)
-        if m != None:
-            lines[cnt] = "GAIN            "+str(meta["gain"])+"            # detector gain in e-/ADU.\n"
-       
-        #-----------------------------------------------------------#ktedit:sex2 T
-        # Check_image                                               #ktedit:sex2 (for visual analysis purposes)
-        m = re.search('^CHECKIMAGE_TYPE',l)
-        if m != None:
-            lines[cnt] = "CHECKIMAGE_TYPE SEGMENTATION"
-        # Check_image name 
-        m = re.search('^CHECKIMAGE_NAME',l)
-        if m != None:
-            lines[cnt] = "CHECKIMAGE_NAME seg_"+str(sexiter)+".fits"
-        
-        # DETECT_THRESH                                             #ktedit:sex2 (may be changed after first sexiteration)
-        m = re.search('^DETECT_THRESH',l)
-        if m != None:
-            lines[cnt] = "DETECT_THRESH   "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2"
-        # ANALYSIS_THRESH
-        m = re.search('^ANALYSIS_THRESH',l)
-        if m != None:
-            lines[cnt] = "ANALYSIS_THRESH "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2"
-        #-----------------------------------------------------------#ktedit:sex2 B        
-
-        # SEEING_FWHM
-        m = re.search('^SEEING_FWHM',l)
-        if m != None:
-            lines[cnt] = "SEEING_FWHM     "+str(meta["fwhm"])+"            # stellar FWHM in arcsec\n"
-        # PHOT_APERTURES, aperture diameters in pixels
-        m = re.search('^PHOT_APERTURES',l)
-        if m != None:
-            aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
-            aper_pix = aper_world / meta["pixscale"]
-            lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"            
-        # Filter name
-        m = re.search('^FILTER_NAME',l)
-        if m != None:
-            filter_name = (l.split())[1]
-        cnt = cnt+1
-
-    # Add newlines
-    lines = [line + '\n' for line in lines]
-    # Write out the new config file
-    if os.path.exists("default.config"):
-        os.remove("default.config")
-    fo = open('default.config', 'w')
-    fo.writelines(lines)
-    fo.close()
+    sexconfig = SexConfig.get(configdir)
+    sexconfig.link()
+    sexconfig.write("default.config",outfile=outfile,flagimage=smaskfile,weightimage=swtfile,
+                    meta=meta,sexiter=sexiter,dthresh=dthresh)
+    filter_name = sexconfig.filter_name
 
     # Convolve the mask file with the convolution kernel to "grow" the regions
     # around bad pixels the SE already does to the weight map
     if (filter_name != ''):
-        # Load the filter array
-        f = open(filter_name,'r')
-        linenum = 0
-        for line in f:
-            if (linenum == 1):
-                shape = line.split(' ')[1]
-                # Make it two pixels larger
-                filter = np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
-                #filter = np.zeros(np.array(shape.split('x'),dtype='i'),dtype='f')
-            #if (linenum > 1):
-            #    linedata = np.array(line.split(' '),dtype='f')
-            #    filter[:,linenum-2] = linedata
-            linenum += 1
-        f.close()
-        # Normalize the filter array
-        #filter /= np.sum(filter)
-        # Convolve with mask
-        #filter = np.ones(np.array(shape.split('x'),dtype='i'),dtype='i')
-        #mask2 = convolve2d(mask,filter,mode="same",boundary="symm")
-        mask2 = convolve(mask,filter,mode="reflect")
-        bad = ((mask == 0) & (mask2 > 0))
-        newmask = np.copy(mask)
-        newmask[bad] = 1     # mask out the neighboring pixels
+        # Filter array, two pixels larger (cached)
+        filter = sexconfig.kernel()
+        # The mask doesn't change between iterations, only grow it once
+        if maskcache is not None and filter.shape in maskcache:
+            newmask = maskcache[filter.shape]
+        else:
+            # Dilate the mask with the filter box, same as convolve(mask,filter,mode="reflect")>0
+            bad = ((mask == 0) & growmask(mask,filter.shape))
+            newmask = np.copy(mask)
+            newmask[bad] = 1     # mask out the neighboring pixels
+            if maskcache is not None:
+                maskcache[filter.shape] = newmask
         # Write new mask
         fits.writeto(smaskfile,newmask,header=mhead,output_verify='warn')
 
@@ -973,7 +1168,7 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     try:
         # Save the SExtractor info to a logfile
         sf = open(logfile,'w')
-        retcode = subprocess.call([bindir+"sex",sfluxfile,"-c","default.config"],stdout=sf,
+        retcode = timing.call([bindir+"sex",sfluxfile,"-c","default.config"],stdout=sf,
                                   stderr=subprocess.STDOUT)
         sf.close()
         if retcode < 0:
@@ -1017,9 +1212,9 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
         maglim = None
 
     # Delete temporary files
-    if os.path.exists(sfluxfile): os.remove(sfluxfile)
+    if os.path.lexists(sfluxfile): os.remove(sfluxfile)
     if os.path.exists(smaskfile): os.remove(smaskfile)
-    if os.path.exists(smaskfile): os.remove(swtfile)
+    if os.path.exists(swtfile): os.remove(swtfile)
     #os.remove("default.conv")
     
     return cat,maglim
@@ -1078,6 +1273,66 @@ def sexfwhm(cat=None,logger=None):
     return medfwhm
 
 
+# Find repeat detections between two catalogs
+#--------------------------------------------
+def repeatmatch(x1,y1,x2,y2,dpix=2):
+    '''
+    Find all pairs of sources in two catalogs that are within `dpix` pixels
+    of each other.  This is used to find sources that were detected in
+    multiple SExtractor iterations.  A pair matches if |dx|<dpix, |dy|<dpix
+    and sqrt(dx^2+dy^2)<=dpix.
+
+    Parameters
+    ----------
+    x1 : numpy array
+       X coordinates of the first catalog.
+    y1 : numpy array
+       Y coordinates of the first catalog.
+    x2 : numpy array
+       X coordinates of the second catalog.
+    y2 : numpy array
+       Y coordinates of the second catalog.
+    dpix : float
+         The matching radius in pixels.  Default is 2.
+
+    Returns
+    -------
+    ind1 : numpy array
+         Indices into the first catalog of the matched pairs.
+    ind2 : numpy array
+         Indices into the second catalog of the matched pairs.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        ind1,ind2 = repeatmatch(x1,y1,x2,y2,dpix=2)
+
+    '''
+
+    x1 = np.asarray(x1,float)
+    y1 = np.asarray(y1,float)
+    x2 = np.asarray(x2,float)
+    y2 = np.asarray(y2,float)
+    if len(x1)==0 or len(x2)==0:
+        return np.zeros(0,int),np.zeros(0,int)
+    # Candidate pairs with a KD-tree, slightly larger radius for roundoff
+    tree1 = cKDTree(np.vstack((x1,y1)).T)
+    tree2 = cKDTree(np.vstack((x2,y2)).T)
+    neighbors = tree1.query_ball_tree(tree2,dpix*(1+1e-6))
+    nmatch = np.array([len(n) for n in neighbors])
+    if np.sum(nmatch)==0:
+        return np.zeros(0,int),np.zeros(0,int)
+    ind1 = np.repeat(np.arange(len(x1)),nmatch)
+    ind2 = np.concatenate([n for n in neighbors if len(n)>0]).astype(int)
+    # Apply the exact cuts
+    dx = x1[ind1]-x2[ind2]
+    dy = y1[ind1]-y2[ind2]
+    gd = ((np.abs(dx)<dpix) & (np.abs(dy)<dpix) & (np.sqrt(dx**2+dy**2)<=dpix))
+    return ind1[gd],ind2[gd]
+
+
 # Pick PSF candidates using SE catalog
 #-------------------------------------
 def sexpickpsf(cat=None,fwhm=None,meta=None,outfile=None,nstars=100,logger=None):
@@ -1401,7 +1656,8 @@ def mkopt(base=None,meta=None,VA=1,LO=7.0,TH=3.5,LS=0.2,HS=1.0,LR=-1.0,HR=1.0,
 
 
 # Make image ready for DAOPHOT
-def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logger=None):
+def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logger=None,
+            flux=None,wt=None,mask=None,header=None):
     '''
     This constructs a FITS image that is prepared for DAOPHOT.
     This program was designed for exposures from the NOAO Community Pipeline.
@@ -1418,6 +1674,14 @@ def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logge
          The meta-data dictionary for the exposure.
     outfile : str
             The name of the output FITS file.
+    flux : numpy array, optional
+         The flux image already in memory.  Requires `header`.
+    wt : numpy array, optional
+       The weight image already in memory.
+    mask : numpy array, optional
+         The mask image already in memory.
+    header : astropy header, optional
+           The header of the flux image in memory.
 
     Returns
     -------
@@ -1452,15 +1716,21 @@ def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logge
         return
 
     # Check that necessary files exist
-    for f in [fluxfile,wtfile,maskfile]:
-        if os.path.exists(f) is False:
+    for f,arr in zip([fluxfile,wtfile,maskfile],[flux,wt,mask]):
+        if arr is None and os.path.exists(f) is False:
             logger.warning(f+" NOT found")
             return None
 
-    # Load the FITS files
-    flux,fhead = fits.getdata(fluxfile,header=True)
-    wt,whead = fits.getdata(wtfile,header=True)
-    mask,mhead = fits.getdata(maskfile,header=True)
+    # Load the FITS files, unless they are already in memory
+    #  copy the flux and header since they get modified below
+    if flux is None or header is None:
+        flux,fhead = fits.getdata(fluxfile,header=True)
+    else:
+        flux = np.array(flux)
+        fhead = header.copy()
+        fhead['BITPIX'] = fits.DTYPE2BITPIX[flux.dtype.name]
+    if mask is None:
+        mask,mhead = fits.getdata(maskfile,header=True)
 
     # Set bad pixels to saturation value
     bdpix = (mask > 0.0)
@@ -1482,9 +1752,228 @@ def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logge
     fits.writeto(outfile,flux,fhead,overwrite=True)
 
 
+# Persistent DAOPHOT session
+#---------------------------
+class DaophotSession:
+    '''
+    Keep one DAOPHOT process running, e.g. for all the DAOPHOT steps of a chip.
+    Commands are sent over stdin and the output is read until DAOPHOT is back
+    at the "Command:" prompt.  The options and the ATTACHed image are only sent
+    again when they change, so the PSF iterations don't restart DAOPHOT or
+    reload the image every time.
+
+    Note that OPTIONS only changes the values that are in the option file, the
+    others keep their values from earlier in the session.
+
+    Parameters
+    ----------
+    bindir : str, optional
+           The path to the directory with the daophot command.
+    timeout : float, optional
+            The maximum time in seconds to wait for one command.  Default is 3600.
+    idle : float, optional
+         How long the output needs to be quiet after the prompt before
+         a command is considered done.  Default is 0.02 sec.
+    stall : float, optional
+          How long DAOPHOT can sit at a prompt other than "Command:" (e.g. an
+          overwrite question or a missing file) before the session is killed.
+          The answers are not echoed back, so it is only a stall if there are
+          more prompts than answers sent or a prompt was repeated, otherwise
+          DAOPHOT is busy with the last answer.  None to only use `timeout`.
+          Default is 10 sec.
+    logger : logging object
+           The logger to use for the logging information.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        with DaophotSession() as session:
+            cat = daofind("image.fits",session=session)
+            apcat, maglim = daoaperphot("image.fits","image.coo",session=session)
+
+    '''
+
+    prompt = 'Command:'
+
+    def __init__(self,bindir=None,timeout=3600,idle=0.02,stall=10.0,logger=None):
+        if bindir is None: bindir=""
+        if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+        self.bindir = bindir
+        self.timeout = timeout
+        self.idle = idle
+        self.stall = stall
+        self.logger = logger
+        self.proc = None
+        self.ncommands = 0
+        self._buffer = ''
+        self._eof = False
+        self._lastread = 0.0
+        self._nanswers = 0
+        self._cond = threading.Condition()
+        self._reader = None
+        self._optlines = None
+        self._imkey = None
+        self._imlinks = []
+
+    def __repr__(self):
+        return "DaophotSession(running="+str(self.running)+", ncommands="+str(self.ncommands)+")"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    @property
+    def running(self):
+        return (self.proc is not None) and (self.proc.poll() is None)
+
+    def start(self):
+        """ Start DAOPHOT, if it is not running already."""
+        if self.running: return
+        # Let the reader of a killed DAOPHOT finish first
+        if self._reader is not None:
+            self._reader.join()
+        env = os.environ.copy()
+        env['GFORTRAN_UNBUFFERED_PRECONNECTED'] = 'y'   # so the prompts get to the pipe
+        self.logger.info("Starting DAOPHOT session")
+        self.proc = subprocess.Popen([self.bindir+"daophot"],stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,env=env,bufsize=0)
+        self._buffer = ''
+        self._eof = False
+        self._optlines = None
+        self._imkey = None
+        self._reader = threading.Thread(target=self._read,daemon=True)
+        self._reader.start()
+        self._nanswers = 0
+        self._wait()   # the startup output
+
+    def _read(self):
+        # Collect the DAOPHOT output in the background
+        fd = self.proc.stdout.fileno()
+        while True:
+            try:
+                chunk = os.read(fd,65536)
+            except OSError:
+                chunk = b''
+            with self._cond:
+                if len(chunk)==0:
+                    self._eof = True
+                    self._cond.notify_all()
+                    return
+                self._buffer += chunk.decode(errors='replace')
+                self._lastread = time.time()
+                self._cond.notify_all()
+
+    def _wait(self):
+        # Wait until DAOPHOT is back at the prompt and the output is quiet
+        t0 = time.time()
+        with self._cond:
+            while True:
+                if self._buffer.rstrip().endswith(self.prompt):
+                    nbuffer = len(self._buffer)
+                    self._cond.wait(self.idle)
+                    if len(self._buffer)==nbuffer:
+                        out = self._buffer
+                        self._buffer = ''
+                        return out
+                    continue
+                if self._eof:
+                    out = self._buffer
+                    self._buffer = ''
+                    self.logger.error(out)
+                    raise Exception("DAOPHOT session ended unexpectedly")
+                # Stuck at some other prompt, the prompts don't end with a newline.
+                #  The answers are not echoed, so DAOPHOT can also be busy after the
+                #  last prompt if it got an answer for every prompt.
+                lines = self._buffer.split('\n')
+                lastline = lines[-1].strip()
+                if self.stall is not None and (lastline.endswith(':') or lastline.endswith('?')) and \
+                   time.time()-np.maximum(self._lastread,t0) > self.stall:
+                    nprompts = len([l for l in lines if l.rstrip().endswith(':') or l.rstrip().endswith('?')])
+                    # asked again, maybe on the same line as the first answer's output
+                    repeat = lastline in self._buffer[0:len(self._buffer)-len(lines[-1])]
+                    stuck = nprompts>self._nanswers or repeat
+                else:
+                    stuck = False
+                if stuck:
+                    out = self._buffer
+                    self._buffer = ''
+                    self.logger.error(out)
+                    self.kill()
+                    raise Exception("DAOPHOT is waiting at the prompt '"+lastline.strip()+"'")
+                if time.time()-t0 > self.timeout:
+                    out = self._buffer
+                    self._buffer = ''
+                    self.logger.error(out)
+                    self.kill()
+                    raise Exception("DAOPHOT session timed out")
+                self._cond.wait(1.0 if self.stall is None else np.minimum(1.0,self.stall))
+
+    def command(self,lines,logfile=None):
+        """ Run one DAOPHOT command, lines are the command and its answers."""
+        self.start()
+        with timing.substage("daophot "+lines[0].split()[0]):
+            self._nanswers = len(lines)-1   # the first line answers "Command:"
+            self.proc.stdin.write(("\n".join(lines)+"\n").encode())
+            self.proc.stdin.flush()
+            out = self._wait()
+        self.ncommands += 1
+        # Append the output to the logfile
+        if logfile is not None:
+            f = open(logfile,'a')
+            f.write(out)
+            f.close()
+        return out
+
+    def options(self,optfile,logfile=None):
+        """ Load the option file, only if it changed."""
+        optlines = readlines(optfile)
+        if self.running and optlines==self._optlines: return
+        self.command(["OPTIONS",optfile,""],logfile)
+        self._optlines = optlines
+
+    def attach(self,imfile,logfile=None):
+        """ ATTACH the image, only if it is not attached already."""
+        st = os.stat(imfile)
+        imkey = (os.path.realpath(imfile),st.st_ino,st.st_mtime_ns,st.st_size)
+        if self.running and imkey==self._imkey: return
+        # Make temporary short filename so DAOPHOT can handle it
+        tid,tfile = tempfile.mkstemp(prefix="tses",dir=".")
+        os.close(tid)   # close open file
+        timfile = os.path.basename(tfile)+".fits"
+        os.symlink(imfile,timfile)
+        self._imlinks += [tfile,timfile]
+        self.command(["ATTACH "+timfile],logfile)
+        self._imkey = imkey
+
+    def kill(self):
+        """ Kill a stuck DAOPHOT, the next command starts a new one."""
+        self.proc.kill()
+        self.proc.wait()
+
+    def close(self):
+        """ Exit DAOPHOT and remove the temporary links."""
+        if self.running:
+            try:
+                self.proc.stdin.write(b"EXIT\n")
+                self.proc.stdin.close()
+                self.proc.wait(timeout=60)
+            except:
+                self.proc.kill()
+        self.proc = None
+        self._optlines = None
+        self._imkey = None
+        for f in self._imlinks:
+            if os.path.lexists(f): os.remove(f)
+        self._imlinks = []
+
+
 # DAOPHOT FIND detection
 #-----------------------
-def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindir=None):
+def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT FIND on an image.
 
@@ -1506,6 +1995,8 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+            Run the command in this DAOPHOT session instead of starting a new daophot.
 
     Returns
     -------
@@ -1559,41 +2050,47 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
     os.symlink(imfile,timfile)
     os.symlink(optfile,toptfile)
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "FIND\n" \
-            "1,1\n" \
-            ""+toutfile+"\n" \
-            "y\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
-
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT detection failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()        
-        raise Exception("DAOPHOT failed")
+    if session is None:
+        # Lines for the DAOPHOT script
+        lines = "#!/bin/sh\n" \
+                ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
+                "OPTIONS\n" \
+                ""+toptfile+"\n" \
+                "\n" \
+                "ATTACH "+timfile+"\n" \
+                "FIND\n" \
+                "1,1\n" \
+                ""+toutfile+"\n" \
+                "y\n" \
+                "EXIT\n" \
+                "EXIT\n" \
+                "END_DAOPHOT\n"
+        # Write the script
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
+
+        # Run the script
+        try:
+            retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT detection failed:"+str(e))
+            logger.error(e)
+            traceback.print_exc()        
+            raise Exception("DAOPHOT failed")
+    else:
+        # Run in the DAOPHOT session
+        session.options(toptfile,logfile)
+        session.attach(imfile,logfile)
+        session.command(["FIND","1,1",toutfile,"y"],logfile)
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1627,17 +2124,17 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
         raise Exception("Output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Load and return the catalog
     logger.info("Output file = "+outfile)
-    return daoread(outfile)
+    return daoread(outfile,cache=True)
 
 
 # DAOPHOT aperture photometry
 #----------------------------
 def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=None,
-                apersfile=None,logfile=None,logger=None,bindir=None):
+                apersfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT aperture photometry on an image.
 
@@ -1667,6 +2164,8 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+            Run the command in this DAOPHOT session instead of starting a new daophot.
 
     Returns
     -------
@@ -1751,27 +2250,6 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     #f.write("OS = %7.4f\n" % apertures[nap-1])
     #f.close()
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "PHOTOMETRY\n" \
-            ""+tapersfile+"\n" \
-            " \n" \
-            ""+tcoofile+"\n" \
-            ""+toutfile+"\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
-
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
@@ -1785,18 +2263,45 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     else:
         movedpsf = False
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT aperture photometry failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()        
-        raise Exception("DAOPHOT failed")
+    if session is None:
+        # Lines for the DAOPHOT script
+        lines = "#!/bin/sh\n" \
+                ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
+                "OPTIONS\n" \
+                ""+toptfile+"\n" \
+                "\n" \
+                "ATTACH "+timfile+"\n" \
+                "PHOTOMETRY\n" \
+                ""+tapersfile+"\n" \
+                " \n" \
+                ""+tcoofile+"\n" \
+                ""+toutfile+"\n" \
+                "EXIT\n" \
+                "EXIT\n" \
+                "END_DAOPHOT\n"
+        # Write the script
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
+
+        # Run the script
+        try:
+            retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT aperture photometry failed:"+str(e))
+            logger.error(e)
+            traceback.print_exc()        
+            raise Exception("DAOPHOT failed")
+    else:
+        # Run in the DAOPHOT session
+        session.options(toptfile,logfile)
+        session.attach(imfile,logfile)
+        session.command(["PHOTOMETRY",tapersfile," ",tcoofile,toutfile],logfile)
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1824,52 +2329,166 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
         raise Exception("Output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Move PSF file back
     if movedpsf is True: os.rename(psftemp,base+".psf")
 
     # Return the catalog
     logger.info("Output file = "+outfile)
-    return daoread(outfile), maglim
+    return daoread(outfile,cache=True), maglim
+
+
+# Exact overlap of a circle and rectangles
+#-----------------------------------------
+def circoverlap(x,y,r):
+    """ Signed area of the circle of radius r around the origin that is between 0 and x and 0 and y."""
+    ax = np.minimum(np.abs(x),r)
+    ay = np.minimum(np.abs(y),r)
+    # X where the circle is at height ay
+    xc = np.sqrt(np.maximum(r**2-ay**2,0.0))
+    xm = np.minimum(ax,xc)
+    def carea(t):
+        # area under the circle from 0 to t
+        return 0.5*(t*np.sqrt(np.maximum(r**2-t**2,0.0))+r**2*np.arcsin(np.clip(t/r,-1.0,1.0)))
+    return np.sign(x)*np.sign(y)*(ay*xm+carea(ax)-carea(xm))
+
+
+# Sky with the DAOPHOT MMM algorithm
+#-----------------------------------
+def skymmm(sky,highbad=None,minsky=20,maxiter=30):
+    '''
+    Mode, sigma and skew of the sky values of many sources at once, with the
+    mean-median-mode algorithm of the DAOPHOT MMM routine.  The values are
+    clipped iteratively around the mode, and the mode is 3*median-2*mean when the
+    median is below the mean (otherwise the mean).
+
+    Parameters
+    ----------
+    sky : numpy array
+        The sky values, one row per source with NaN for unused elements.
+    highbad : float, optional
+           Values above this are not used.
+    minsky : int, optional
+           The minimum number of sky values.  Sources with fewer get a sigma of -1.
+           Default is 20.
+    maxiter : int, optional
+           The maximum number of clipping iterations.  Default is 30.
 
+    Returns
+    -------
+    skymod : numpy array
+        The sky mode of each source.
+    sigma : numpy array
+        The standard deviation of the sky values, -1 when it failed.
+    skew : numpy array
+        The skew of the sky values.
+    nsky : numpy array
+        The number of sky values that were used.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        skymod,sigma,skew,nsky = skymmm(skyvalues)
 
-# Pick PSF stars using DAOPHOT
-#-----------------------------
-def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
-               optfile=None,logfile=None,logger=None,bindir=None):
     '''
-    This runs DAOPHOT aperture photometry on an image.
+    sky = np.atleast_2d(np.array(sky,float))
+    if highbad is not None:
+        sky[sky>highbad] = np.nan
+    s = np.sort(sky,axis=1)   # NaNs go to the end
+    n,m = s.shape
+    rows = np.arange(n)
+    ntot = np.sum(np.isfinite(s),axis=1)
+    ok = (ntot>=np.maximum(minsky,1))
+    nt = np.maximum(ntot,1)
+    # Median of all values, the sums are relative to it
+    skymid = 0.5*(s[rows,(nt-1)//2]+s[rows,nt//2])
+    d = np.where(np.isfinite(s),s-skymid[:,None],0.0)
+    cs = np.zeros((n,m+1))
+    cs[:,1:] = np.cumsum(d,axis=1)
+    cs2 = np.zeros((n,m+1))
+    cs2[:,1:] = np.cumsum(d**2,axis=1)
+    def stats(lo,hi):
+        cnt = np.maximum(hi-lo,1)
+        mean = (cs[rows,hi]-cs[rows,lo])/cnt
+        sigma = np.sqrt(np.maximum((cs2[rows,hi]-cs2[rows,lo])/cnt-mean**2,0.0))
+        med = 0.5*(s[rows,np.minimum(lo+(cnt-1)//2,m-1)]+s[rows,np.minimum(lo+cnt//2,m-1)])
+        return mean+skymid,sigma,med
+    # First cut symmetric around the median
+    cut = np.minimum(skymid-s[:,0],s[rows,nt-1]-skymid)
+    lo = np.sum(s<(skymid-cut)[:,None],axis=1)
+    hi = np.sum(s<=(skymid+cut)[:,None],axis=1)
+    skymn,sigma,skymed = stats(lo,hi)
+    skymod = np.where(skymed<skymn,3.0*skymed-2.0*skymn,skymn)
+    # Clip around the mode until nothing changes
+    active = ok.copy()
+    for niter in range(maxiter):
+        if np.sum(active)==0:
+            break
+        r = np.log10(np.maximum(hi-lo,2))
+        r = np.maximum(2.0,(-0.1042*r+1.1695)*r+0.8895)
+        cut = r*sigma+0.5*np.abs(skymn-skymod)
+        newlo = np.sum(s<(skymod-cut)[:,None],axis=1)
+        newhi = np.sum(s<=(skymod+cut)[:,None],axis=1)
+        active &= ((newlo!=lo) | (newhi!=hi)) & (newhi-newlo>=np.maximum(minsky,1))
+        lo = np.where(active,newlo,lo)
+        hi = np.where(active,newhi,hi)
+        skymn,sigma,skymed = stats(lo,hi)
+        skymod = np.where(skymed<skymn,3.0*skymed-2.0*skymn,skymn)
+    skew = (skymn-skymod)/np.maximum(sigma,1.0)
+    sigma = np.where(ok,sigma,-1.0)
+    return skymod,sigma,skew,np.where(ok,hi-lo,0)
+
+
+# Aperture photometry
+#--------------------
+def aperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=None,
+             apersfile=None,logfile=None,logger=None,nworkers=1,batchsize=256):
+    '''
+    Aperture photometry of an image in Python, as an alternative to DAOPHOT PHOTOMETRY
+    (daoaperphot).  The apertures are circles with the exact overlap with the pixels,
+    the sky is the MMM mode of the pixels in the sky annulus (see skymmm), and the
+    magnitudes and errors are computed as in DAOPHOT (zero point of 25, and 99.999 when
+    an aperture has a bad pixel or is off the image).  The sources are done in batches,
+    sorted by position so each batch only uses part of the image.
 
     Parameters
     ----------
     imfile : str
            The filename of the DAOPHOT-ready FITS image.
-    catfile : str
-           The catalog file from which to pick PSF stars.  This is normally the .ap file.
-    maglim : float
-           The magnitude limit for this image.  
-    nstars : int, optional, default = 100
-           The number of PSF stars to pick.  
-    optfile : str, optional
-            The option file for `imfile`.  By default it is assumed that this is
-            the base name of `imfile` with a ".opt" suffix.
+    coofile : str, optional
+            The filename of the catalog of sources for which to obtain aperture photometry.
+            By default it is assumed that this is the base name of `imfile` with a ".coo" suffix.
+    apertures : list or array, optional
+             The list of aperture to use.  The last two are used as the inner and outer sky radius.
+             The default apertures are: apertures = [3.0, 6.0803, 9.7377, 15.5952, 19.7360, 40.0, 50.0]
     outfile : str, optional
             The output filename of the aperture photometry catalog.  By default this is
-            the base name of `imfile` with a ".lst" suffix.
+            the base name of `imfile` with a ".ap" suffix.
+    optfile : str, optional
+            The option file for `imfile`, for the gain.  By default it is assumed that
+            this is the base name of `imfile` with a ".opt" suffix.
+    apersfile : str, optional
+              The file that will constrain the apertures used.
     logfile : str, optional
-            The name of the logfile to constrain the output of the DAOPHOT FIND
-            run.  By default this is the base name of `imfile` with a ".lst.log" suffix.
+            The name of the logfile.  By default this is the base name of `imfile`
+            with a ".ap.log" suffix.
     logger : logging object
            The logger to use for the loggin information.
-    bindir : str, optional
-           The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
-           you keep your SE command in
+    nworkers : int, optional
+           The number of batches to do at the same time.  Default is 1.
+    batchsize : int, optional
+           The number of sources in a batch.  Default is 256.
 
     Returns
     -------
     cat : astropy table
-        The list of PSF stars.
+        The aperture photometry catalog, in the same format as from daoaperphot().
+    maglim : float
+        The magnitude limit of the exposure, the median first aperture magnitude
+        of the sources with errors of 0.15-0.25 mag (S/N of about 5).
 
     The output catalog and logfile will also be created.
 
@@ -1878,34 +2497,227 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
 
     .. code-block:: python
 
-        psfcat = daopickpsf("image.fits","image.coo",19.5,nstars=100)
+        cat, maglim = aperphot("image.fits","image.coo",nworkers=4)
 
     '''
 
     if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
-    logger.info("-- Running DAOPHOT PICKPSF -- ")
-
-    if bindir is None: bindir=""  # /home/x25h971/bin/ is for Katie on Tempest, for example
+    logger.info("-- Running aperture photometry --")
 
     # Make sure we have the image file name
     if imfile is None:
         logger.warning("No image filename input")
         return None
-    # Make sure we have the catalog file name
-    if catfile is None:
-        logger.warning("No catalog filename input")
-        return None
 
     # Set up filenames, make sure they don't exist
     base = os.path.basename(imfile)
     base = os.path.splitext(os.path.splitext(base)[0])[0]
     if optfile is None: optfile = base+".opt"
-    if outfile is None: outfile = base+".lst"
-    if logfile is None: logfile = base+".lst.log"
-    scriptfile = base+".pickpsf.sh"
-    for f in [outfile,logfile,scriptfile]:
-        if os.path.exists(f): os.remove(f)
-
+    if coofile is None: coofile = base+".coo"
+    if outfile is None: outfile = base+".ap"
+    if logfile is None: logfile = base+".ap.log"
+    if apersfile is None: apersfile = base+".apers"
+    for f in [outfile,apersfile,logfile]:
+        if os.path.exists(f): os.remove(f)
+
+    # Check that necessary files exist
+    for f in [imfile,optfile,coofile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return None
+
+    logger.info("coofile = "+coofile)
+
+    # Apertures, the last two are the inner and outer sky radii
+    if apertures is None:
+        apertures = [3.000, 6.0803, 9.7377, 15.5952, 19.7360, 40.0000, 50.0000]
+    aperswrite(apersfile,apertures)
+    rap = np.array(apertures[0:-2],float)
+    rin,rout = float(apertures[-2]),float(apertures[-1])
+    naper = len(rap)
+
+    # Good data range from the coordinate file header, the gain from the option file
+    cooheader = readlines(coofile)[0:2]
+    hvals = cooheader[1].split()
+    lobad,hibad = float(hvals[3]),float(hvals[4])
+    gain = optvalue(optfile,'GA')
+    if gain is None: gain=float(hvals[7])
+    coocat = daoread(coofile)
+    nstars = len(coocat)
+    x = np.array(coocat['X'],float)
+    y = np.array(coocat['Y'],float)
+
+    im = fits.getdata(imfile).astype(float)
+    ny,nx = im.shape
+    # Bad pixels are NaN
+    im[(im<lobad) | (im>hibad)] = np.nan
+
+    # Cut out stamps around the sources, DAOPHOT coordinates are 1-based
+    def stamps(ind,h):
+        ix0 = np.round(x[ind]).astype(int)-1-h
+        iy0 = np.round(y[ind]).astype(int)-1-h
+        xind = ix0[:,None]+np.arange(2*h+1)
+        yind = iy0[:,None]+np.arange(2*h+1)
+        data = im[np.clip(yind,0,ny-1)[:,:,None],np.clip(xind,0,nx-1)[:,None,:]]
+        offim = (yind<0)[:,:,None] | (yind>=ny)[:,:,None] | (xind<0)[:,None,:] | (xind>=nx)[:,None,:]
+        data[offim] = np.nan
+        return data,ix0,iy0
+
+    mag = np.zeros((nstars,naper))+99.999
+    err = np.zeros((nstars,naper))+9.9999
+    sky = np.zeros(nstars)
+    skysig = np.zeros(nstars)-1.0
+    skyskew = np.zeros(nstars)
+
+    def dobatch(ind):
+        # Sky in the annulus, using the pixel centers
+        hs = int(np.ceil(rout))
+        data,ix0,iy0 = stamps(ind,hs)
+        dx = (ix0[:,None]+np.arange(2*hs+1)+1)-x[ind][:,None]
+        dy = (iy0[:,None]+np.arange(2*hs+1)+1)-y[ind][:,None]
+        rsq = dy[:,:,None]**2+dx[:,None,:]**2
+        data[(rsq<rin**2) | (rsq>rout**2)] = np.nan
+        # only the pixels that can be in the annulus of any source
+        k = np.arange(2*hs+1)-hs
+        ksq = (k[:,None]**2+k[None,:]**2).ravel()
+        near = (ksq>=np.maximum(rin-1,0)**2) & (ksq<=(rout+1)**2)
+        skymod,sigma,skew,nsky = skymmm(data.reshape(len(ind),-1)[:,near])
+        sky[ind],skysig[ind],skyskew[ind] = skymod,sigma,skew
+        # Apertures, exact overlap with the pixels from the pixel corners
+        ha = int(np.ceil(np.max(rap)))+1
+        data,ix0,iy0 = stamps(ind,ha)
+        ex = (ix0[:,None]+np.arange(2*ha+2)+0.5)-x[ind][:,None]
+        ey = (iy0[:,None]+np.arange(2*ha+2)+0.5)-y[ind][:,None]
+        bad = np.isnan(data)
+        data[bad] = 0.0
+        skyvar = sigma**2
+        for i,r in enumerate(rap):
+            g = circoverlap(ex[:,None,:],ey[:,:,None],r)
+            w = g[:,1:,1:]-g[:,:-1,1:]-g[:,1:,:-1]+g[:,:-1,:-1]
+            area = np.sum(w,axis=(1,2))
+            flux = np.sum(w*data,axis=(1,2))-skymod*area
+            gd = (np.sum((w>1e-10) & bad,axis=(1,2))==0) & (sigma>=0) & (flux>0)
+            error = 1.0857*np.sqrt(area*skyvar+np.maximum(flux,0)/gain+skyvar/np.maximum(nsky,1)*area**2)/ \
+                    np.where(gd,flux,1.0)
+            mag[ind[gd],i] = 25.0-2.5*np.log10(flux[gd])
+            err[ind[gd],i] = np.minimum(error[gd],9.9999)
+
+    # Batches of sources close together on the image
+    order = np.lexsort((x,np.floor(y/256)))
+    batches = [order[i:i+batchsize] for i in range(0,nstars,batchsize)]
+    t0 = time.time()
+    if nworkers>1:
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            list(executor.map(dobatch,batches))
+    else:
+        for b in batches:
+            dobatch(b)
+    logger.info(str(nstars)+" sources in "+str(len(batches))+" batches took {:.2f} sec".format(time.time()-t0))
+
+    # Write the .ap file, same format as DAOPHOT PHOTOMETRY
+    head1 = "%3d%6d%6d%8.1f%8.1f%8.2f%8.2f%8.2f%8.2f%8.2f\n" % \
+            tuple([2]+[int(v) for v in hvals[1:3]]+[float(v) for v in hvals[3:6]]+
+                  [rap[0]]+[float(v) for v in hvals[7:10]])
+    fmt = "\n%7d%9.3f%9.3f"+naper*"%9.3f"+"\n%14.3f%6.2f%6.2f%8.4f"+(naper-1)*"%9.4f"+"\n"
+    f = open(outfile,'w')
+    f.write(cooheader[0]+"\n")
+    f.write(head1)
+    f.write("\n")
+    writerows(f,fmt,[coocat['ID'],x,y]+[mag[:,i] for i in range(naper)]+
+              [sky,np.clip(skysig,-9.99,99.99),np.clip(skyskew,-9.99,99.99)]+[err[:,i] for i in range(naper)])
+    f.close()
+
+    # Magnitude limit, sources with S/N of about 5
+    maglim = None
+    sn5 = (err[:,0]>=0.15) & (err[:,0]<=0.25)
+    f = open(logfile,'w')
+    f.write("Aperture photometry of "+str(nstars)+" sources in "+imfile+"\n")
+    if np.sum(sn5)>=3:
+        maglim = float(np.median(mag[sn5,0]))
+        line = "Estimated magnitude limit (Aperture 1): {:5.2f} +- {:4.2f} per star.".format(maglim,np.std(mag[sn5,0]))
+        f.write(line+"\n")
+        logger.info(line)
+    f.close()
+
+    # Return the catalog
+    logger.info("Output file = "+outfile)
+    return daoread(outfile,cache=True), maglim
+
+
+# Pick PSF stars using DAOPHOT
+#-----------------------------
+def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
+               optfile=None,logfile=None,logger=None,bindir=None,session=None):
+    '''
+    This runs DAOPHOT aperture photometry on an image.
+
+    Parameters
+    ----------
+    imfile : str
+           The filename of the DAOPHOT-ready FITS image.
+    catfile : str
+           The catalog file from which to pick PSF stars.  This is normally the .ap file.
+    maglim : float
+           The magnitude limit for this image.  
+    nstars : int, optional, default = 100
+           The number of PSF stars to pick.  
+    optfile : str, optional
+            The option file for `imfile`.  By default it is assumed that this is
+            the base name of `imfile` with a ".opt" suffix.
+    outfile : str, optional
+            The output filename of the aperture photometry catalog.  By default this is
+            the base name of `imfile` with a ".lst" suffix.
+    logfile : str, optional
+            The name of the logfile to constrain the output of the DAOPHOT FIND
+            run.  By default this is the base name of `imfile` with a ".lst.log" suffix.
+    logger : logging object
+           The logger to use for the loggin information.
+    bindir : str, optional
+           The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
+           you keep your SE command in
+    session : DaophotSession, optional
+            Run the command in this DAOPHOT session instead of starting a new daophot.
+
+    Returns
+    -------
+    cat : astropy table
+        The list of PSF stars.
+
+    The output catalog and logfile will also be created.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        psfcat = daopickpsf("image.fits","image.coo",19.5,nstars=100)
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Running DAOPHOT PICKPSF -- ")
+
+    if bindir is None: bindir=""  # /home/x25h971/bin/ is for Katie on Tempest, for example
+
+    # Make sure we have the image file name
+    if imfile is None:
+        logger.warning("No image filename input")
+        return None
+    # Make sure we have the catalog file name
+    if catfile is None:
+        logger.warning("No catalog filename input")
+        return None
+
+    # Set up filenames, make sure they don't exist
+    base = os.path.basename(imfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    if optfile is None: optfile = base+".opt"
+    if outfile is None: outfile = base+".lst"
+    if logfile is None: logfile = base+".lst.log"
+    scriptfile = base+".pickpsf.sh"
+    for f in [outfile,logfile,scriptfile]:
+        if os.path.exists(f): os.remove(f)
+
     # Check that necessary files exist
     for f in [imfile,catfile,optfile]:
         if os.path.exists(f) is False:
@@ -1930,41 +2742,47 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
     if numlines(tcatfile)<200:
         usemaglim = maglim
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "PICKPSF\n" \
-            ""+tcatfile+"\n" \
-            ""+str(nstars)+","+str(usemaglim)+"\n" \
-            ""+toutfile+"\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
-
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT PICKPSF failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()
-        raise Exception("DAOPHOT failed")
+    if session is None:
+        # Lines for the DAOPHOT script
+        lines = "#!/bin/sh\n" \
+                ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
+                "OPTIONS\n" \
+                ""+toptfile+"\n" \
+                "\n" \
+                "ATTACH "+timfile+"\n" \
+                "PICKPSF\n" \
+                ""+tcatfile+"\n" \
+                ""+str(nstars)+","+str(usemaglim)+"\n" \
+                ""+toutfile+"\n" \
+                "EXIT\n" \
+                "EXIT\n" \
+                "END_DAOPHOT\n"
+        # Write the script
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
+
+        # Run the script
+        try:
+            retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT PICKPSF failed:"+str(e))
+            logger.error(e)
+            traceback.print_exc()
+            raise Exception("DAOPHOT failed")
+    else:
+        # Run in the DAOPHOT session
+        session.options(toptfile,logfile)
+        session.attach(imfile,logfile)
+        session.command(["PICKPSF",tcatfile,str(nstars)+","+str(usemaglim),toutfile],logfile)
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1985,17 +2803,17 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
         raise Exception("DAOPHOT failed")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Return the catalog
     logger.info("Output file = "+outfile)
-    return daoread(outfile)
+    return daoread(outfile,cache=True)
 
 
 # Run DAOPHOT PSF
 #-------------------
 def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfile=None,
-           logfile=None,verbose=False,logger=None,bindir=None):
+           logfile=None,verbose=False,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT PSF to create a .psf file.
 
@@ -2027,6 +2845,8 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+            Run the command in this DAOPHOT session instead of starting a new daophot.
 
     Returns
     -------
@@ -2098,42 +2918,48 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
     os.symlink(listfile,tlistfile)
     os.symlink(apfile,tapfile)
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "PSF\n" \
-            ""+tapfile+"\n" \
-            ""+tlistfile+"\n" \
-            ""+toutfile+"\n" \
-            "\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
-
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT PSF failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()
-        raise Exception("DAOPHOT failed")
+    if session is None:
+        # Lines for the DAOPHOT script
+        lines = "#!/bin/sh\n" \
+                ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
+                "OPTIONS\n" \
+                ""+toptfile+"\n" \
+                "\n" \
+                "ATTACH "+timfile+"\n" \
+                "PSF\n" \
+                ""+tapfile+"\n" \
+                ""+tlistfile+"\n" \
+                ""+toutfile+"\n" \
+                "\n" \
+                "EXIT\n" \
+                "EXIT\n" \
+                "END_DAOPHOT\n"
+        # Write the script
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
+
+        # Run the script
+        try:
+            retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT PSF failed:"+str(e))
+            logger.error(e)
+            traceback.print_exc()
+            raise Exception("DAOPHOT failed")
+    else:
+        # Run in the DAOPHOT session
+        session.options(toptfile,logfile)
+        session.attach(imfile,logfile)
+        session.command(["PSF",tapfile,tlistfile,toutfile,""],logfile)
 
     # Check if it failed to converage
     if os.path.exists(logfile):
@@ -2179,7 +3005,216 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
         raise Exception("DAOPHOT output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
+
+    # Return the parameter and profile error information
+    logger.info("Output file = "+outfile)
+    return pararr, parchi, profs
+
+
+# Get an option value
+#--------------------
+def optvalue(optfile,name):
+    """ Get the value of an option (e.g. 'AN') from a DAOPHOT option file."""
+    for line in readlines(optfile):
+        if '=' in line and line.split('=')[0].strip().upper()==name.upper():
+            return float(line.split('=')[1])
+    return None
+
+
+# Run DAOPHOT PSF in one trial directory
+#---------------------------------------
+def psftrial(trialdir,bindir=""):
+    """ Run DAOPHOT PSF in a trial directory with t.fits, t.opt, t.ap and t.lst inputs."""
+    scriptfile = os.path.join(trialdir,"t.psf.sh")
+    lines = "#!/bin/sh\n" \
+            ""+bindir+"daophot << END_DAOPHOT >> t.psf.log\n" \
+            "OPTIONS\n" \
+            "t.opt\n" \
+            "\n" \
+            "ATTACH t.fits\n" \
+            "PSF\n" \
+            "t.ap\n" \
+            "t.lst\n" \
+            "t.psf\n" \
+            "\n" \
+            "EXIT\n" \
+            "EXIT\n" \
+            "END_DAOPHOT\n"
+    f = open(scriptfile,'w')
+    f.writelines(lines)
+    f.close()
+    os.chmod(scriptfile,509)
+    retcode = timing.call(["./t.psf.sh"],stderr=subprocess.STDOUT,shell=False,cwd=trialdir)
+    return retcode
+
+
+# Run DAOPHOT PSF with several analytic functions in parallel
+#-------------------------------------------------------------
+def daopsf_multi(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfile=None,
+                 logfile=None,ans=None,nworkers=None,logger=None,bindir=None):
+    '''
+    Run DAOPHOT PSF with several analytic functions at the same time and keep the best one.
+
+    This does the same as AN=-N in the option file, where DAOPHOT tries the analytic
+    functions one after the other, but every function is fit by its own DAOPHOT in its
+    own subdirectory and the one with the lowest chi is kept.  The output files are the
+    same as from daopsf().
+
+    Parameters
+    ----------
+    imfile : str
+           The filename of the DAOPHOT-ready FITS image.
+    listfile : str
+           The filename of the list of PSF stars.
+    apfile : str, optional
+           The filename of the aperture photometry file.  By default it is assumed
+           that this is the base name of `imfile` with a ".ap" suffix.
+    optfile : str, optional
+            The option file for `imfile`.  By default it is assumed that this is
+            the base name of `imfile` with a ".opt" suffix.
+    neifile : str, optional
+            The output PSF stars and neighbors file.  By default this is the base name of `imfile`
+            with a ".nei" suffix.
+    outfile : str, optional
+            The output PSF filename.  By default this is the base name of `imfile` with a
+            ".psf" suffix.
+    logfile : str, optional
+            The logfile of the best analytic function.  By default this is the base name of
+            `imfile` with a ".psf.log" suffix.
+    ans : list, optional
+           The analytic functions to try (1=GAUSSIAN ... 7=PENNY2).  Default is all of them.
+    nworkers : int, optional
+           The number of functions to fit at the same time.  Default is all of them.
+    logger : logging object
+           The logger to use for the loggin information.
+    bindir : str, optional
+           The path to the directory with the daophot command.
+
+    Returns
+    -------
+    pararr : list
+           A list of lists giving the parameters for the PSF fit of the best function.
+    parchi : list
+           The array of chi values for the PSF fit of the best function.
+    profs : structured  numpy array
+          The catalog of PSF star profiles giving ID, CHI and FLAG.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        pararr, parchi, profs = daopsf_multi("image.fits","image.lst",nworkers=7)
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Running DAOPHOT PSF with analytic functions in parallel -- ")
+
+    if bindir is None: bindir=""  # /home/x25h971/bin/ is for Katie on Tempest, for example
+    if bindir != "": bindir=os.path.abspath(os.path.expanduser(bindir))+"/"  # PSF runs in the trial directories
+
+    # Make sure we have the image file name
+    if imfile is None:
+        logger.warning("No image filename input")
+        return None,None,None
+    # Make sure we have the list file name
+    if listfile is None:
+        logger.warning("No list filename input")
+        return None,None,None
+
+    logger.info("Input file = "+imfile)
+
+    # Set up filenames, make sure they don't exist
+    base = os.path.basename(imfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    if optfile is None: optfile = base+".opt"
+    if apfile is None: apfile = base+".ap"
+    if outfile is None: outfile = base+".psf"
+    if logfile is None: logfile = base+".psf.log"
+    if neifile is None: neifile = base+".nei"
+    for f in [outfile,neifile,logfile]:
+        if os.path.exists(f): os.remove(f)
+
+    # Check that necessary files exist
+    for f in [imfile,listfile,optfile,apfile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return None,None,None
+
+    psfnames = ["GAUSSIAN","MOFFAT15","MOFFAT25","MOFFAT35",
+                "LORENTZ","PENNY1","PENNY2"]
+    if ans is None: ans=list(range(1,len(psfnames)+1))
+
+    # Set up a directory for each analytic function
+    optlines = readlines(optfile)
+    trialdir = base+"_psftrials"
+    if os.path.exists(trialdir): shutil.rmtree(trialdir)
+    os.makedirs(trialdir)
+    trials = []
+    for an in ans:
+        tdir = os.path.join(trialdir,"an"+str(an))
+        os.makedirs(tdir)
+        os.symlink(os.path.abspath(imfile),os.path.join(tdir,"t.fits"))
+        os.symlink(os.path.abspath(apfile),os.path.join(tdir,"t.ap"))
+        os.symlink(os.path.abspath(listfile),os.path.join(tdir,"t.lst"))
+        topt = [line if line.split('=')[0].strip()!='AN' else "AN = {:8.2f}".format(an) for line in optlines]
+        writelines(os.path.join(tdir,"t.opt"),topt)
+        trials.append({'an':an,'name':psfnames[an-1],'dir':tdir})
+
+    # Run DAOPHOT PSF for all the functions in parallel
+    if nworkers is None: nworkers=len(trials)
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        retcodes = list(executor.map(lambda t: psftrial(t['dir'],bindir),trials))
+    logger.info("DAOPHOT PSF with "+str(len(trials))+" functions took {:.2f} sec".format(time.time()-t0))
+
+    # Get the results
+    best = None
+    for trial,retcode in zip(trials,retcodes):
+        tdir = trial['dir']
+        tlogfile = os.path.join(tdir,"t.psf.log")
+        tpsffile = os.path.join(tdir,"t.psf")
+        if retcode<0:
+            logger.error(trial['name']+" child was terminated by signal"+str(-retcode))
+            continue
+        if os.path.exists(tlogfile)==False or os.path.exists(tpsffile)==False or \
+           os.path.getsize(tpsffile)==0:
+            logger.info("  {:9s} failed".format(trial['name']))
+            continue
+        plines = readlines(tlogfile)
+        bad = grep(plines,'Failed to converge',index=True)
+        l1 = grep(plines,"Chi    Parameters",index=True)
+        l2 = grep(plines,"Profile errors",index=True)
+        l3 = grep(plines,"File with PSF stars and neighbors",index=True)
+        if (len(bad)>0 and len(grep(plines,'>> ',index=True))==0) or len(l1)==0 or len(l2)==0:
+            logger.info("  {:9s} failed to converge".format(trial['name']))
+            continue
+        pararr, parchi = parsepars(plines[l1[0]+1:l2[0]-1])
+        profs = parseprofs(plines[l2[0]+1:l3[0]-1])
+        trial['chi'] = np.min(parchi)
+        trial['result'] = (pararr,parchi,profs)
+        logger.info("  {:9s} chi = {:.4f}".format(trial['name'],trial['chi']))
+        if best is None or trial['chi']<best['chi']:
+            best = trial
+
+    # All of them failed
+    if best is None:
+        logger.error("DAOPHOT PSF failed to converge")
+        shutil.rmtree(trialdir)
+        return None,None,None
+
+    # Keep the best one
+    logger.info("Best analytic function is "+best['name'])
+    shutil.move(os.path.join(best['dir'],"t.psf"),outfile)
+    if os.path.exists(os.path.join(best['dir'],"t.nei")):
+        shutil.move(os.path.join(best['dir'],"t.nei"),neifile)
+    shutil.move(os.path.join(best['dir'],"t.psf.log"),logfile)
+    shutil.rmtree(trialdir)
+    pararr, parchi, profs = best['result']
+    logger.info("Chi = "+str(best['chi']))
+    logger.info(str(len(profs))+" PSF stars used")
 
     # Return the parameter and profile error information
     logger.info("Output file = "+outfile)
@@ -2189,7 +3224,7 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
 # Subtract neighbors of PSF stars
 #--------------------------------
 def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,psffile=None,
-              nstfile=None,grpfile=None,logfile=None,logger=None,bindir=None):
+              nstfile=None,grpfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This subtracts neighbors of PSF stars so that an improved PSF can be made.
 
@@ -2225,6 +3260,8 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+            Run the command in this DAOPHOT session instead of starting a new daophot.
 
     Returns
     -------
@@ -2296,71 +3333,515 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
     os.symlink(photfile,tphotfile)
     os.symlink(psffile,tpsffile)
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "GROUP\n" \
-            ""+tphotfile+"\n" \
-            ""+tpsffile+"\n" \
-            "5.\n" \
-            ""+tgrpfile+"\n" \
-            "NSTAR\n" \
-            ""+tpsffile+"\n" \
-            ""+tgrpfile+"\n" \
-            ""+tnstfile+"\n" \
-            "SUBSTAR\n" \
-            ""+tpsffile+"\n" \
-            ""+tnstfile+"\n" \
-            "y\n" \
-            ""+tlistfile+"\n" \
-            ""+toutfile+"\n" \
-            "\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    # Copy option file to daophot.opt
+    if os.path.exists("daophot.opt") is False:
+        shutil.copyfile(base+".opt","daophot.opt")
+
+    if session is None:
+        # Lines for the DAOPHOT script
+        lines = "#!/bin/sh\n" \
+                ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
+                "OPTIONS\n" \
+                ""+toptfile+"\n" \
+                "\n" \
+                "ATTACH "+timfile+"\n" \
+                "GROUP\n" \
+                ""+tphotfile+"\n" \
+                ""+tpsffile+"\n" \
+                "5.\n" \
+                ""+tgrpfile+"\n" \
+                "NSTAR\n" \
+                ""+tpsffile+"\n" \
+                ""+tgrpfile+"\n" \
+                ""+tnstfile+"\n" \
+                "SUBSTAR\n" \
+                ""+tpsffile+"\n" \
+                ""+tnstfile+"\n" \
+                "y\n" \
+                ""+tlistfile+"\n" \
+                ""+toutfile+"\n" \
+                "\n" \
+                "EXIT\n" \
+                "END_DAOPHOT\n"
+        # Write the script
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
+
+        # Run the script
+        try:
+            retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("PSF star neighbor subtracting failed:"+str(e))
+            logger.error(e)
+            traceback.print_exc()
+            raise Exception("PSF subtraction failed")
+    else:
+        # Run in the DAOPHOT session
+        session.options(toptfile,logfile)
+        session.attach(imfile,logfile)
+        session.command(["GROUP",tphotfile,tpsffile,"5.",tgrpfile],logfile)
+        session.command(["NSTAR",tpsffile,tgrpfile,tnstfile],logfile)
+        session.command(["SUBSTAR",tpsffile,tnstfile,"y",tlistfile,toutfile,""],logfile)
+
+    # Check that the output file exists
+    if os.path.exists(toutfile):
+        # Move output file to the final filename
+        os.rename(toutfile,outfile)
+        os.rename(tnstfile,nstfile)
+        os.rename(tgrpfile,grpfile)
+        # Remove the temporary links
+        for f in [tfile,timfile,toptfile,tlistfile,tphotfile]: os.remove(f)
+    else:
+        logger.error("Output file "+outfile+" NOT Found")
+        raise Exception("PSF subtraction failed")
+
+    # Delete the script
+    if os.path.exists(scriptfile): os.remove(scriptfile)
+
+    # Print final output filename
+    logger.info("Output file = "+outfile)
+
+
+# Keep track of the convergence of the PSF iterations
+#----------------------------------------------------
+class PSFConvergence:
+    '''
+    Keep track of the DAOPHOT PSF fits in createpsf() and predict when more
+    iterations will not change the PSF anymore.
+
+    Every fit is recorded with its chi, the profile SIG values of the PSF stars
+    and the number of stars that are rejected after it.  A loop of fits (the star
+    rejection passes of one cleaning iteration, or the fits on the neighbor-subtracted
+    images) is predicted to be converged when
+
+      1) the chi values change geometrically and the extrapolated remaining change
+         is below `dchi`, or
+      2) the median change of the SIG of the stars in both of the last two fits is
+         below `dsig`, and at most a fraction `frej` of the stars is rejected.
+
+    Parameters
+    ----------
+    dchi : float, optional
+         Remaining chi change below which the PSF is converged.  Default is 0.002.
+    dsig : float, optional
+         Median change of the star SIG values below which the PSF is converged.
+           Default is 0.002.
+    frej : float, optional
+         Largest fraction of rejected stars for the SIG criterion.  Default is 0.05.
+    mode : str, optional
+         'fixed' only records the prediction and the loops stop with the fixed chi
+           threshold as before, 'predict' also stops them when the prediction says
+           they are converged.  Default is 'fixed'.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        conv = PSFConvergence(mode='predict')
+        conv.add(subiter,niter,'reject',chi,profs,nrej)
+        if conv.done('reject'):
+            ...
+
+    '''
+
+    def __init__(self,dchi=0.002,dsig=0.002,frej=0.05,mode='fixed'):
+        if mode not in ['fixed','predict']:
+            raise Exception("PSF stopping mode must be 'fixed' or 'predict'")
+        self.dchi = dchi
+        self.dsig = dsig
+        self.frej = frej
+        self.mode = mode
+        self.rows = []
+        self.stop = None     # rule that ended the cleaning iterations
+
+    def __repr__(self):
+        return "PSFConvergence("+str(len(self.rows))+" fits, mode="+self.mode+")"
+
+    def loop(self,kind):
+        """ The fits of the current loop of this kind."""
+        rows = [r for r in self.rows if r['kind']==kind]
+        # The star rejection passes start over in every cleaning iteration
+        if kind=='reject' and len(rows)>0:
+            rows = [r for r in rows if r['subiter']==rows[-1]['subiter']]
+        return rows
+
+    def add(self,subiter,niter,kind,chi,profs,nrej=0,wall=0.0):
+        """ Record a PSF fit."""
+        good = (profs['FLAG']!='saturated')
+        sigs = dict(zip(profs['ID'][good].tolist(),profs['SIG'][good].tolist()))
+        dsig = np.nan
+        last = self.loop(kind)
+        if len(last)>0:
+            common = [i for i in sigs if i in last[-1]['sigs']]
+            if len(common)>0:
+                dsig = np.median(np.abs([sigs[i]-last[-1]['sigs'][i] for i in common]))
+        meansig = np.mean(profs['SIG'][good]) if np.sum(good)>0 else np.nan
+        row = {'fit':len(self.rows)+1,'subiter':subiter,'niter':niter,'kind':kind,'chi':float(chi),
+               'meansig':float(meansig),'nstars':len(profs),'nrej':int(nrej),'dsig':float(dsig),
+               'wall':float(wall),'converged':False,'sigs':sigs}
+        self.rows.append(row)
+        return row
+
+    def converged(self,kind):
+        """ Do the fits of the current loop say that it is converged?"""
+        rows = self.loop(kind)
+        if len(rows)<2:
+            return False
+        # Extrapolate the chi changes as a geometric series
+        if len(rows)>=3:
+            d1 = rows[-2]['chi']-rows[-3]['chi']
+            d2 = rows[-1]['chi']-rows[-2]['chi']
+            if d1!=0:
+                ratio = d2/d1
+                if ratio>=0 and ratio<1 and np.abs(d2)*ratio/(1-ratio)<self.dchi:
+                    return True
+        # The star profiles did not change
+        last = rows[-1]
+        if np.isfinite(last['dsig']) and last['dsig']<self.dsig and last['nrej']<=self.frej*last['nstars']:
+            return True
+        return False
+
+    def done(self,kind):
+        """ Record the prediction for the last fit.  True if the loop should stop now."""
+        rows = self.loop(kind)
+        if len(rows)==0:
+            return False
+        rows[-1]['converged'] = self.converged(kind)
+        return rows[-1]['converged'] and self.mode=='predict'
+
+    def table(self):
+        """ The fit history as a table."""
+        names = ['fit','subiter','niter','kind','chi','meansig','nstars','nrej','dsig','wall','converged']
+        if len(self.rows)==0:
+            return Table(names=names,dtype=[int,int,int,str,float,float,int,int,float,float,bool])
+        return Table(rows=[[r[n] for n in names] for r in self.rows],names=names)
+
+    def tometa(self,meta):
+        """ Put the fit history in the meta-data header."""
+        meta['PSFNFIT'] = (len(self.rows),"Number of DAOPHOT PSF fits")
+        meta['PSFSTOP'] = (str(self.stop),"Rule that ended the PSF cleaning iterations")
+        meta['PSFMODE'] = (self.mode,"PSF stopping mode")
+        for r in self.rows:
+            meta['HISTORY'] = "PSF fit {:d} sub={:d} iter={:d} {:s} chi={:.4f} sig={:.4f} nrej={:d} conv={:s}".format(
+                r['fit'],r['subiter'],r['niter'],r['kind'],r['chi'],r['meansig'],r['nrej'],
+                'T' if r['converged'] else 'F')
+
+
+# Mosaic of PSF star stamps
+#---------------------------
+class PSFMosaic:
+    '''
+    A compact mosaic of stamps around the PSF stars, so the PSF star cleaning and
+    neighbor subtraction iterations don't have to read and write the whole image.
+
+    Every PSF star gets a stamp of +/-radius pixels and stamps that overlap on the
+    image are merged into one box.  The boxes are placed in the mosaic near their
+    image position scaled down by `scale` (pushed to the right if they would
+    overlap), so the spatial variations of the PSF keep roughly the same form.
+    The pixels between the boxes are set to the bad pixel value of mkdaoim().
+    Sources keep their IDs in the mosaic, and the DAOPHOT files only keep the
+    sources in the boxes.
+
+    Parameters
+    ----------
+    imfile : str
+           The filename of the DAOPHOT-ready FITS image.
+    listfile : str
+           The filename of the list of PSF stars.
+    radius : int
+           The half-size of the stamps in pixels.
+    gap : int, optional
+           The number of bad pixels between the boxes.  Default is 3.
+    scale : float, optional
+           The scale of the box positions.  By default the mosaic is about twice
+           as wide as all the boxes put together.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        mos = PSFMosaic("image.fits","image.lst",30)
+        mos.writeimage("mos.fits")
+        mos.writefile("image.ap","mos.ap")
+
+    '''
+
+    def __init__(self,imfile,listfile,radius,gap=3,scale=None):
+        self.imfile = imfile
+        self.radius = int(np.ceil(radius))
+        self.gap = int(gap)
+        head = fits.getheader(imfile)
+        self.imnx,self.imny = head['NAXIS1'],head['NAXIS2']
+        # Stamps around the PSF stars, 0-based with exclusive upper edges
+        lstcat = daoread(listfile)
+        xc = np.round(np.array(lstcat['X'])-1).astype(int)
+        yc = np.round(np.array(lstcat['Y'])-1).astype(int)
+        boxes = [[max(x-self.radius,0),min(x+self.radius+1,self.imnx),
+                  max(y-self.radius,0),min(y+self.radius+1,self.imny)] for x,y in zip(xc,yc)]
+        # Merge overlapping stamps
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i+1,len(boxes)):
+                    b1,b2 = boxes[i],boxes[j]
+                    if b1[0]<b2[1] and b2[0]<b1[1] and b1[2]<b2[3] and b2[2]<b1[3]:
+                        boxes[i] = [min(b1[0],b2[0]),max(b1[1],b2[1]),min(b1[2],b2[2]),max(b1[3],b2[3])]
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged: break
+        self.boxes = np.array(boxes,int).reshape(-1,4)
+        nbox = len(self.boxes)
+        bnx = self.boxes[:,1]-self.boxes[:,0]
+        bny = self.boxes[:,3]-self.boxes[:,2]
+        if scale is None:
+            scale = 2*np.sqrt(np.sum((bnx+self.gap)*(bny+self.gap)))/np.maximum(self.imnx,self.imny)
+        self.scale = float(np.minimum(scale,1.0))
+        # Place the boxes in the mosaic, the lowest ones first
+        mx0 = np.zeros(nbox,int)
+        my0 = np.zeros(nbox,int)
+        placed = []
+        for i in np.argsort(self.boxes[:,2],kind='stable'):
+            x0 = int(np.round(self.scale*0.5*(self.boxes[i,0]+self.boxes[i,1])-0.5*bnx[i]))+self.gap
+            y0 = int(np.round(self.scale*0.5*(self.boxes[i,2]+self.boxes[i,3])-0.5*bny[i]))+self.gap
+            x0,y0 = max(x0,self.gap),max(y0,self.gap)
+            moved = True
+            while moved:
+                moved = False
+                for k in placed:
+                    if x0<mx0[k]+bnx[k]+self.gap and mx0[k]<x0+bnx[i]+self.gap and \
+                       y0<my0[k]+bny[k]+self.gap and my0[k]<y0+bny[i]+self.gap:
+                        x0 = mx0[k]+bnx[k]+self.gap
+                        moved = True
+            mx0[i],my0[i] = x0,y0
+            placed.append(i)
+        self.mx0 = mx0
+        self.my0 = my0
+        self.nx = int(np.max(mx0+bnx))+self.gap if nbox>0 else 1
+        self.ny = int(np.max(my0+bny))+self.gap if nbox>0 else 1
+
+    def __repr__(self):
+        return "PSFMosaic("+str(len(self.boxes))+" boxes, "+str(self.nx)+"x"+str(self.ny)+")"
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def box(self,x,y):
+        """ Index of the box that each (1-based) image position is in, -1 if none."""
+        x = np.atleast_1d(np.array(x,float))-1
+        y = np.atleast_1d(np.array(y,float))-1
+        ind = np.zeros(len(x),int)-1
+        for i,b in enumerate(self.boxes):
+            inside = (x>=b[0]) & (x<b[1]-1) & (y>=b[2]) & (y<b[3]-1)
+            ind[inside & (ind<0)] = i
+        return ind
+
+    def tomosaic(self,x,y):
+        """ Convert image positions to mosaic positions, NaN outside of the boxes."""
+        ind = self.box(x,y)
+        x = np.atleast_1d(np.array(x,float))
+        y = np.atleast_1d(np.array(y,float))
+        good = (ind>=0)
+        mx = np.zeros(len(x))+np.nan
+        my = np.zeros(len(y))+np.nan
+        mx[good] = x[good]-self.boxes[ind[good],0]+self.mx0[ind[good]]
+        my[good] = y[good]-self.boxes[ind[good],2]+self.my0[ind[good]]
+        return mx,my
+
+    def mosaic(self,im):
+        """ Cut the boxes out of an image and put them in the mosaic."""
+        mos = np.zeros((self.ny,self.nx),im.dtype)+np.array(6e4,im.dtype)
+        for b,x0,y0 in zip(self.boxes,self.mx0,self.my0):
+            mos[y0:y0+b[3]-b[2],x0:x0+b[1]-b[0]] = im[b[2]:b[3],b[0]:b[1]]
+        return mos
+
+    def paste(self,mos,im):
+        """ Put the boxes of a mosaic back into an image."""
+        for b,x0,y0 in zip(self.boxes,self.mx0,self.my0):
+            im[b[2]:b[3],b[0]:b[1]] = mos[y0:y0+b[3]-b[2],x0:x0+b[1]-b[0]]
+        return im
+
+    def writeimage(self,outfile):
+        """ Write the mosaic of the image."""
+        im,head = fits.getdata(self.imfile,header=True,memmap=True)
+        fits.writeto(outfile,self.mosaic(im),head,overwrite=True)
+
+    def writefile(self,infile,outfile):
+        """ Write a DAOPHOT file (.lst, .nei or .ap) with the mosaic positions of the sources in the boxes."""
+        lines = readlines(infile)
+        cat = daoread(infile)
+        # The .ap files have a blank line and two lines per source
+        nper = 3 if (len(lines)>3 and lines[3].strip()=='') else 1
+        first = 1 if nper==3 else 0
+        mx,my = self.tomosaic(cat['X'],cat['Y'])
+        outlines = lines[0:3]
+        outlines[1] = daoheadsize(outlines[1],self.nx,self.ny)
+        for k in np.where(np.isfinite(mx))[0]:
+            slines = lines[3+k*nper:3+(k+1)*nper]
+            line = slines[first]
+            slines[first] = line[0:7]+'{:9.3f}'.format(mx[k])+'{:9.3f}'.format(my[k])+line[25:]
+            outlines += slines
+        writelines(outfile,outlines,overwrite=True)
+        return len(outlines[3:])//nper
+
+
+# Create the DAOPHOT PSF with the cleaning iterations on a mosaic
+#----------------------------------------------------------------
+def createpsf_cutout(imfile=None,apfile=None,listfile=None,psffile=None,optfile=None,
+                     subfile=None,radius=None,meta=None,logger=None,session=None,
+                     bindir=None,**kwargs):
+    '''
+    Create a DAOPHOT PSF for an image with the PSF star cleaning and neighbor
+    subtraction iterations of createpsf() run on a mosaic of stamps around the
+    PSF stars (see PSFMosaic), instead of on the whole image.  Afterwards the
+    neighbor-subtracted stamps are put back into the image, and the final PSF
+    is fit on that image with the remaining PSF stars, so the spatial variations
+    of the PSF are for the real image positions.
+
+    Parameters
+    ----------
+    imfile : str
+           The filename of the DAOPHOT-ready FITS image.
+    apfile : str, optional
+           The filename of the photometry file (normally the .ap aperture photometry file).
+           By default it is assumed that this is the base name of `imfile` with a ".ap" suffix.
+    listfile : str, optional
+           The filename that will contain the final list of PSF stars.  By default this is the
+           base name of `imfile` with a ".lst" suffix.
+    psffile : str, optional
+           The name of the PSF file.  By default it is assumed that this is the base name of
+           `imfile` with a ".psf" suffix.
+    optfile : str, optional
+            The option file for `imfile`.  By default it is assumed that this is
+            the base name of `imfile` with a ".opt" suffix.
+    subfile : str, optional
+            The FITS filename for the image with the neighbors subtracted.  By default this is
+            the base name of `imfile` with a "a.fits" suffix.
+    radius : int, optional
+           The half-size of the stamps.  By default this is the PSF radius plus three
+           times the fitting radius, so that the neighbors in the .nei file are fit with
+           all of their pixels.
+    meta : str, optional
+           The meta-data dictionary for this image.
+    logger : logging object
+           The logger to use for the loggin information.
+    session : DaophotSession, optional
+            Run the DAOPHOT commands in this DAOPHOT session.
+    bindir : str, optional
+           The path to the directory with the daophot command.
+    **kwargs
+           The other createpsf() parameters for the cleaning iterations.
+
+    Returns
+    -------
+    subiter is returned, as by createpsf().
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        createpsf_cutout("image.fits","image.ap","image.lst","image.psf")
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Creating PSF Iteratively on a mosaic of PSF star stamps --")
+
+    # Make sure we have the image file name
+    if imfile is None:
+        logger.warning("No image filename input")
+        return
+
+    # Set up filenames
+    base = os.path.basename(imfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    if optfile is None: optfile = base+".opt"
+    if listfile is None: listfile = base+".lst"
+    if apfile is None: apfile = base+".ap"
+    if psffile is None: psffile = base+".psf"
+    if subfile is None: subfile = base+"a.fits"
+    if os.path.exists(subfile): os.remove(subfile)
 
-    # Copy option file to daophot.opt
-    if os.path.exists("daophot.opt") is False:
-        shutil.copyfile(base+".opt","daophot.opt")
+    # Check that necessary files exist
+    for f in [imfile,optfile,listfile,apfile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("PSF star neighbor subtracting failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()
-        raise Exception("PSF subtraction failed")
+    # Make the mosaic and its DAOPHOT files
+    #  the mosaic files have their own base name, so createpsf() finds them
+    mbase = base+"_psfmos"
+    if radius is None:
+        radius = optvalue(optfile,'PS')+3*optvalue(optfile,'FI')+1
+    mos = PSFMosaic(imfile,listfile,radius)
+    mos.writeimage(mbase+".fits")
+    nap = mos.writefile(apfile,mbase+".ap")
+    mos.writefile(listfile,mbase+".lst")
+    shutil.copyfile(optfile,mbase+".opt")
+    logger.info(str(len(mos))+" PSF star boxes in a "+str(mos.nx)+"x"+str(mos.ny)+" mosaic with "+
+                str(nap)+" sources")
+
+    # Cleaning iterations on the mosaic
+    subiter = createpsf(mbase+".fits",mbase+".ap",mbase+".lst",mbase+".psf",meta=meta,
+                        logger=logger,session=session,bindir=bindir,**kwargs)
+    if subiter is None:
+        raise Exception("Failure in createpsf on the mosaic")
+
+    # Keep the analytic function that was picked
+    opttable = readlines(optfile)
+    opttable[14] = readlines(mbase+".opt")[14]
+    writelines(optfile,opttable,overwrite=True)
+
+    # Final list of PSF stars
+    if os.path.exists(listfile+".orig"): os.remove(listfile+".orig")
+    shutil.copy(listfile,listfile+".orig")
+    listlines = readlines(listfile)
+    lstcat = daoread(listfile)
+    keep = np.isin(lstcat['ID'],daoread(mbase+".lst")['ID'])
+    writelines(listfile,listlines[0:3]+[l for l,k in zip(listlines[3:],keep) if k],overwrite=True)
+    logger.info("Final list of PSF stars in "+listfile+".  Original list in "+listfile+".orig")
 
-    # Check that the output file exists
-    if os.path.exists(toutfile):
-        # Move output file to the final filename
-        os.rename(toutfile,outfile)
-        os.rename(tnstfile,nstfile)
-        os.rename(tgrpfile,grpfile)
-        # Remove the temporary links
-        for f in [tfile,timfile,toptfile,tlistfile,tphotfile]: os.remove(f)
-    else:
-        logger.error("Output file "+outfile+" NOT Found")
-        raise Exception("PSF subtraction failed")
+    # Put the neighbor-subtracted boxes into the image
+    im,head = fits.getdata(imfile,header=True)
+    mos.paste(fits.getdata(mbase+"a.fits"),im)
+    fits.writeto(subfile,im,head,overwrite=True)
+    del im
 
-    # Delete the script
-    os.remove(scriptfile)
+    # Final PSF on the subtracted image
+    logger.info("Final DAOPSF run (on subtracted image)")
+    os.rename(imfile,"temp_"+imfile)
+    os.rename(subfile,imfile)
+    try:
+        pararr, parchi, profs = daopsf(imfile,listfile,apfile,optfile=optfile,outfile=psffile,
+                                       logger=logger,bindir=bindir,session=session)
+    finally:
+        os.rename(imfile,subfile)
+        os.rename("temp_"+imfile,imfile)
+    if pararr is None:
+        raise Exception("Failure in DAOPSF")
+    chi = np.min(parchi)
+
+    # Remove the mosaic files, except for the subtracted mosaics
+    for f in glob.glob(mbase+".*")+glob.glob("temp_"+mbase+".*"):
+        os.remove(f)
 
-    # Print final output filename
-    logger.info("Output file = "+outfile)
+    # Put information in meta
+    if meta is not None:
+        meta['PSFCHI'] = (chi,"Final PSF Chi value")
+        meta['PSFSTARS'] = (len(profs),"Number of PSF stars")
+        meta['PSFMOS'] = (str(mos.nx)+"x"+str(mos.ny),"Size of the PSF star mosaic")
+
+    return subiter
 
 
 # Create DAOPHOT PSF
@@ -2368,7 +3849,8 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
 def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,maxiter=5,
               minstars=6,nsigrej=2,subneighbors=True,subfile=None,optfile=None,neifile=None,
               nstfile=None,grpfile=None,meta=None,logfile=None,verbose=False,logger=None,
-              submaxit=5,subminit=2):#ktedit:cpsf
+              submaxit=5,subminit=2,session=None,bindir=None,psfworkers=1,psfstop='fixed',
+              psfcutout=False):#ktedit:cpsf
     '''
     Iteratively create a DAOPHOT PSF for an image.
 
@@ -2423,6 +3905,20 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
            The maximum number of times to iterate the entire flag & neighbor subtraction process
     subminit : int, optional, default = 2 #ktedit:cpsf
            The minimum number of times to iterate the entire flag & neighbor subtraction process
+    session : DaophotSession, optional
+            Run the DAOPHOT commands in this DAOPHOT session.
+    bindir : str, optional
+           The path to the directory with the daophot command.
+    psfworkers : int, optional, default = 1
+           When the option file has AN<0 (search the analytic functions), fit up to this
+           many analytic functions at the same time with daopsf_multi().
+    psfstop : str, optional, default = 'fixed'
+           How to end the iterations.  'fixed' stops when chi changes by less than 0.002
+           (the convergence prediction of PSFConvergence is only recorded), 'predict' also
+           stops when PSFConvergence predicts that more iterations won't change the PSF.
+    psfcutout : bool, optional, default = False
+           Run the cleaning iterations on a mosaic of stamps around the PSF stars instead
+           of on the whole image, see createpsf_cutout().
 
     Returns
     -------
@@ -2446,6 +3942,14 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
         logger.warning("No image filename input")
         return
 
+    # Cleaning iterations on a mosaic of the PSF stars
+    if psfcutout:
+        return createpsf_cutout(imfile,apfile,listfile,psffile,optfile=optfile,subfile=subfile,
+                                meta=meta,logger=logger,session=session,bindir=bindir,doiter=doiter,
+                                maxiter=maxiter,minstars=minstars,nsigrej=nsigrej,
+                                subneighbors=subneighbors,verbose=verbose,submaxit=submaxit,
+                                subminit=subminit,psfworkers=psfworkers,psfstop=psfstop)
+
     # Set up filenames, make sure they don't exist
     base = os.path.basename(imfile)
     base = os.path.splitext(os.path.splitext(base)[0])[0]
@@ -2476,6 +3980,20 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
     if os.path.exists(listfile+".orig"): os.remove(listfile+".orig")
     shutil.copy(listfile,listfile+".orig")
 
+    # Run DAOPHOT PSF, search the analytic functions in parallel if AN<0
+    #  every fit is timed on its own
+    def runpsf(label):
+        an = optvalue(optfile,'AN')
+        with timing.substage('psf '+label,kind='psffit'):
+            if psfworkers>1 and an is not None and an<0:
+                return daopsf_multi(imfile,wlistfile,apfile,optfile=optfile,ans=list(range(1,int(-an)+1)),
+                                    nworkers=psfworkers,logger=logger,bindir=bindir)
+            return daopsf(imfile,wlistfile,apfile,logger=logger,bindir=bindir,session=session)
+
+    # Convergence history of the fits
+    conv = PSFConvergence(dchi=0.002,mode=psfstop)
+    spararr = None
+
 
     #----------------------------------------------------------------
     # Iterate entire flag & neighbor subtraction process 
@@ -2521,8 +4039,15 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
         while (endflag==False):
             logger.info("Iter = "+str(niter))
             # Run DAOPSF
+            t0 = time.time()
             try:
-                pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                # The first fit of a cleaning iteration is on the same image and PSF stars as
+                #  the last fit on the subtracted image, so it would not change the PSF
+                if psfstop=='predict' and niter==1 and subiter>1 and spararr is not None:
+                    logger.info("Same image and PSF stars as the last fit, reusing it")
+                    pararr, parchi, profs = spararr, sparchi, sprofs
+                else:
+                    pararr, parchi, profs = runpsf(str(subiter)+"."+str(niter))
                 if pararr is not None:
                     chi = np.min(parchi)
                     mean_chi = np.mean(profs['SIG'])
@@ -2544,7 +4069,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
                     opttable[14] = 'AN = '+newanpsf
                     writelines(optfile,opttable,overwrite=True)                    
                     logger.info('Retrying DAOPHOT PSF with AN='+newanpsf)
-                    pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                    pararr, parchi, profs = runpsf(str(subiter)+"."+str(niter))
                     if pararr is not None:
                         chi = np.min(parchi)
                         mean_chi = np.mean(profs['SIG'])     
@@ -2567,11 +4092,12 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
                 si = np.argsort(profs['SIG'])[::-1]
                 bdstars = si[0:nbdstars]  # take the worse ones
             logger.info("  "+str(nbdstars)+" stars with flag or high sig")
+            conv.add(subiter,niter,'reject',chi,profs,nbdstars,time.time()-t0)
             # Delete stars with flags or high SIG values from list
             if (nbdstars>0) & (nstars>minstars):
                 listlines = readlines(wlistfile)
                 # Read the list
-                lstcat = daoread(wlistfile)
+                lstcat = daoread(wlistfile,cache=True)
                 # Match up with the stars we are deleting
                 mid, ind1, ind2 = np.intersect1d(profs[bdstars]['ID'],lstcat['ID'],return_indices=True)
                 # Remove the lines from listlines
@@ -2581,8 +4107,12 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
                 logger.info("  Removing IDs="+str(" ".join(profs[bdstars]['ID'].astype(str))))
                 logger.info("  "+str(nbdstars)+" bad stars removed. "+str(nstars-nbdstars)+" PSF stars left")
             # Should we end flagged star subtraction?
+            predicted = conv.done('reject')
             if (niter==maxiter) | (nbdstars==0) | (nstars<=minstars) | (np.abs(lastchi-chi)<dchi_thresh):
                 endflag = True
+            elif predicted:
+                logger.info("  PSF predicted to be converged, no more rejection iterations")
+                endflag = True
             niter += 1
             lastchi = chi
         
@@ -2597,7 +4127,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
             subfile = base+"a.fits"
             #subfile = base+str(subiter)+"a.fits" #ktedit:cpsf
             try:
-                subpsfnei(imfile,wlistfile,neifile,subfile,psffile=psffile,logger=logger)
+                subpsfnei(imfile,wlistfile,neifile,subfile,psffile=psffile,logger=logger,session=session)
             except:
                 logger.error("Subtracting neighbors failed.  Keeping original PSF file")
                 traceback.print_exc()                
@@ -2613,8 +4143,10 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
                 os.rename(subfile,imfile) 
                 logger.info(imfile+" once again moved to temp_"+imfile+", "+subfile+" moved to "+imfile) 
                 try:
-                    spararr, sparchi, sprofs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                    t0 = time.time()
+                    spararr, sparchi, sprofs = runpsf(str(subiter)+".sub")
                     chi = np.min(sparchi)
+                    conv.add(subiter,niter-1,'sub',chi,sprofs,0,time.time()-t0)
 
                     subsigs, profsind, sprofsind = np.intersect1d(profs['ID'],sprofs['ID'],return_indices=True)  
                     profsigs=profs['SIG'][profsind]                                                              
@@ -2640,8 +4172,15 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
 
         finalsubfile = base+str(subiter)+"a.fits"
         #if os.path.exists(finalsubfile)==False: finalsubfile=''
+        predicted = conv.done('sub')
         if ((((subiter==submaxit) | (np.abs(sublastchi-chi)<dchi_thresh)) & (subiter>=subminit)) | subendflag):
             subendflag = True
+            conv.stop = 'fixed'
+            finalsubfile = base+"a.fits"
+        elif predicted & (subiter>=subminit):
+            logger.info("PSF predicted to be converged, no more cleaning iterations")
+            subendflag = True
+            conv.stop = 'predict'
             finalsubfile = base+"a.fits"
         sublastchi = chi
         # Rename image files
@@ -2666,6 +4205,8 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
     if meta is not None:
         meta['PSFCHI'] = (chi,"Final PSF Chi value")
         meta['PSFSTARS'] = (len(profs),"Number of PSF stars")
+        conv.tometa(meta)
+    logger.info(str(len(conv.rows))+" PSF fits, stopped by the "+str(conv.stop)+" rule")
 
     # Copy working list to final list
     if os.path.exists(listfile): os.remove(listfile)
@@ -2678,7 +4219,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
 # Run ALLSTAR
 #-------------
 def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfile=None,
-            meta=None,logfile=None,logger=None,bindir=None):
+            meta=None,logfile=None,logger=None,bindir=None,ntiles=1,nworkers=None,margin=None):
     '''
     Run DAOPHOT ALLSTAR on an image.
 
@@ -2710,6 +4251,14 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    ntiles : int, optional
+           Split the image into ntiles x ntiles overlapping tiles and run ALLSTAR on
+           them in parallel (see allstar_tiled()).  Default is 1, one ALLSTAR run on
+           the whole image.
+    nworkers : int, optional
+           The number of tiles to run at the same time.  Default is all the tiles.
+    margin : int, optional
+           The overlap of the tiles in pixels.  Default is twice the PSF radius.
 
     Returns
     -------
@@ -2727,6 +4276,12 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
 
     '''
 
+    # Tiled ALLSTAR
+    if ntiles>1:
+        return allstar_tiled(imfile,psffile,apfile=apfile,subfile=subfile,outfile=outfile,
+                             optfile=optfile,meta=meta,logfile=logfile,logger=logger,bindir=bindir,
+                             ntiles=ntiles,nworkers=nworkers,margin=margin)
+
     if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
     logger.info("-- Running ALLSTAR --")
 
@@ -2799,7 +4354,7 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
 
     # Run the script
     try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
+        retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
         if retcode < 0:
             logger.warning("Child was terminated by signal"+str(-retcode))
         else:
@@ -2836,7 +4391,272 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
         meta["NALLSTAR"] = (num,"Number of ALLSTAR converged sources")
 
     # Return the final catalog
-    return daoread(outfile)
+    return daoread(outfile,cache=True)
+
+# Change NX/NY in a DAOPHOT file header line
+#-------------------------------------------
+def daoheadsize(line,nx,ny):
+    """ Replace NX and NY in the second header line of a DAOPHOT file, keeping the widths."""
+    m = re.match(r'(\s*\d+)(\s*\d+)(\s*\d+)(.*)',line)
+    if m is None:
+        return line
+    wx = len(m.group(2))
+    wy = len(m.group(3))
+    return m.group(1)+str(nx).rjust(wx)+str(ny).rjust(wy)+m.group(4)
+
+
+# Run ALLSTAR on one tile
+#------------------------
+def allstartile(tiledir,optlines,bindir=""):
+    """ Run ALLSTAR in a tile directory with t.fits, t.psf and t.ap inputs."""
+    scriptfile = os.path.join(tiledir,"t.als.sh")
+    lines = ["#!/bin/sh\n",
+             ""+bindir+"allstar << END_ALLSTAR >> t.als.log\n"]
+    lines += optlines
+    lines += ["\n",
+              "t.fits\n",
+              "t.psf\n",
+              "t.ap\n",
+              "t.als\n",
+              "ts.fits\n",
+              "EXIT\n",
+              "EXIT\n",
+              "END_ALLSTAR\n"]
+    f = open(scriptfile,'w')
+    f.writelines(lines)
+    f.close()
+    os.chmod(scriptfile,509)
+    try:
+        retcode = timing.call(["./t.als.sh"],stderr=subprocess.STDOUT,shell=False,cwd=tiledir)
+    except OSError:
+        retcode = -1
+    return retcode
+
+
+# Run ALLSTAR on overlapping tiles in parallel
+#---------------------------------------------
+def allstar_tiled(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfile=None,
+                  meta=None,logfile=None,logger=None,bindir=None,ntiles=2,nworkers=None,margin=None):
+    '''
+    Run DAOPHOT ALLSTAR on an image split up into overlapping tiles.
+
+    The image and .ap list are split into ntiles x ntiles tiles that overlap by `margin`
+    pixels, and ALLSTAR is run on the tiles in parallel in their own subdirectories.
+    Every source belongs to the tile whose core (the tile without the overlap) contains its
+    input position, and only that tile's ALLSTAR result is kept for it.  The subtracted
+    image is pasted together from the tile cores.  The .als and subtracted image are
+    in the same format as from allstar().  If ALLSTAR fails on any tile, it is run
+    once on the whole image instead.
+
+    Parameters
+    ----------
+    imfile : str
+           The filename of the DAOPHOT-ready FITS image.
+    psffile : str, optional
+           The name of the PSF file.  By default it is assumed that this is the base name of
+           `imfile` with a ".psf" suffix.
+    apfile : str, optional
+           The filename of the photometry file (normally the .ap aperture photometry file).
+           By default it is assumed that this is the base name of `imfile` with a ".ap" suffix.
+    subfile : str, optional
+            The FITS filename for the image with all stars subtracted.  By default this is
+            the base name of `imfile` with a "s.fits" suffix.
+    outfile : str, optional
+            The file name of the final .als source catalog.
+    optfile : str, optional
+            The option file for `imfile`.  By default it is assumed that this is
+            the base name of `imfile` with a ".als.opt" suffix.
+    meta : str, optional
+           The meta-data dictionary for this image.
+    logfile : str, optional
+            The name of the logfile.  By default this is the base name of `imfile` with
+            a ".als.log" suffix.  The logs of all the tiles are appended to it.
+    logger : logging object
+           The logger to use for the loggin information.
+    bindir : str, optional
+           The path to the directory with the allstar command.
+    ntiles : int, optional
+           The number of tiles in X and Y.  Default is 2.
+    nworkers : int, optional
+           The number of tiles to run at the same time.  Default is all the tiles.
+    margin : int, optional
+           The overlap of the tiles in pixels.  Default is twice the PSF radius.
+
+    Returns
+    -------
+    cat : astropy table
+        The catalog of ALLSTAR sources.
+
+    The PSF subtracted image and logfile will also be created.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cat = allstar_tiled("image.fits","image.psf",ntiles=4,nworkers=16)
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Running tiled ALLSTAR --")
+
+    if bindir is None: bindir=""  # /home/x25h971/bin/ is for Katie on Tempest, for example
+    if bindir != "": bindir=os.path.abspath(os.path.expanduser(bindir))+"/"  # ALLSTAR runs in the tile directories
+
+    # Make sure we have the image file name
+    if imfile is None:
+        logger.warning("No image filename input")
+        return
+
+    # Set up filenames, make sure they don't exist
+    base = os.path.basename(imfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    if psffile is None: psffile = base+".psf"
+    if optfile is None: optfile = base+".als.opt"
+    if apfile is None: apfile = base+".ap"
+    if subfile is None: subfile = base+"s.fits"
+    if outfile is None: outfile = base+".als"
+    if logfile is None: logfile = base+".als.log"
+    for f in [outfile,subfile,logfile]:
+        if os.path.exists(f): os.remove(f)
+
+    # Check that necessary files exist
+    for f in [imfile,psffile,apfile,optfile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return
+
+    # Load the image and the aperture photometry
+    im,head = fits.getdata(imfile,header=True)
+    ny,nx = im.shape
+    aplines = readlines(apfile)
+    apcat = daoread(apfile,cache=True)
+    nstars = len(apcat)
+    # Default margin, twice the PSF radius
+    #  the PSF lookup table has 2*(2*radius+1)+1 elements
+    if margin is None:
+        try:
+            npsf = int(readlines(psffile)[0][10:].split()[0])
+            margin = int(np.ceil(2*(npsf-1)/4.0))
+        except:
+            margin = 50
+    margin = int(margin)
+    # Option file lines
+    optlines = readlines(optfile)
+    logger.info("optfile = "+optfile)
+    optlines = [line+'\n' for line in optlines]
+
+    # Tile boundaries
+    xedge = np.round(np.linspace(0,nx,ntiles+1)).astype(int)
+    yedge = np.round(np.linspace(0,ny,ntiles+1)).astype(int)
+    # Which tile core each source is in, DAOPHOT coordinates are 1-based
+    xind = np.clip(np.searchsorted(xedge,apcat['X']-1,side='right')-1,0,ntiles-1)
+    yind = np.clip(np.searchsorted(yedge,apcat['Y']-1,side='right')-1,0,ntiles-1)
+    owner = yind*ntiles+xind
+    logger.info(str(ntiles)+"x"+str(ntiles)+" tiles with "+str(margin)+" pixel overlap")
+
+    # Make the tiles
+    tiledir = base+"_alstiles"
+    if os.path.exists(tiledir): shutil.rmtree(tiledir)
+    os.makedirs(tiledir)
+    tiles = []
+    for j in range(ntiles):
+        for i in range(ntiles):
+            tile = {'num':j*ntiles+i,'dir':os.path.join(tiledir,'tile'+str(j*ntiles+i).zfill(2)),
+                    'x0':xedge[i],'x1':xedge[i+1],'y0':yedge[j],'y1':yedge[j+1],
+                    'xlo':max(xedge[i]-margin,0),'xhi':min(xedge[i+1]+margin,nx),
+                    'ylo':max(yedge[j]-margin,0),'yhi':min(yedge[j+1]+margin,ny)}
+            os.makedirs(tile['dir'])
+            # Subimage
+            tim = im[tile['ylo']:tile['yhi'],tile['xlo']:tile['xhi']]
+            fits.writeto(os.path.join(tile['dir'],'t.fits'),tim,head,overwrite=True)
+            # Sources in the tile with the overlap
+            ind, = np.where((apcat['X']-1>=tile['xlo']) & (apcat['X']-1<tile['xhi']) &
+                            (apcat['Y']-1>=tile['ylo']) & (apcat['Y']-1<tile['yhi']))
+            tlines = aplines[0:3]
+            tlines[1] = daoheadsize(tlines[1],tile['xhi']-tile['xlo'],tile['yhi']-tile['ylo'])
+            for k in ind:
+                line1 = aplines[k*3+4]
+                line1 = line1[0:7]+'{:9.3f}'.format(apcat['X'][k]-tile['xlo'])+ \
+                        '{:9.3f}'.format(apcat['Y'][k]-tile['ylo'])+line1[25:]
+                tlines += ['',line1,aplines[k*3+5]]
+            writelines(os.path.join(tile['dir'],'t.ap'),tlines)
+            shutil.copyfile(psffile,os.path.join(tile['dir'],'t.psf'))
+            shutil.copyfile(optfile,os.path.join(tile['dir'],'allstar.opt'))
+            tile['nstars'] = len(ind)
+            tiles.append(tile)
+
+    # Run ALLSTAR on the tiles in parallel
+    if nworkers is None: nworkers=len(tiles)
+    t0 = time.time()
+    runtiles = [t for t in tiles if t['nstars']>0]
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        retcodes = list(executor.map(lambda t: allstartile(t['dir'],optlines,bindir),runtiles))
+    logger.info("ALLSTAR on "+str(len(retcodes))+" tiles took {:.2f} sec".format(time.time()-t0))
+
+    # Any tiles that failed, run ALLSTAR on the whole image instead
+    failed = [t['num'] for t,r in zip(runtiles,retcodes) if r!=0 or
+              os.path.exists(os.path.join(t['dir'],'t.als'))==False or
+              os.path.exists(os.path.join(t['dir'],'ts.fits'))==False]
+    if len(failed)>0:
+        logger.warning("ALLSTAR failed on tile(s) "+", ".join([str(n) for n in failed])+
+                       ", running it on the whole image")
+        shutil.rmtree(tiledir)
+        return allstar(imfile,psffile,apfile=apfile,subfile=subfile,outfile=outfile,optfile=optfile,
+                       meta=meta,logfile=logfile,logger=logger,bindir=bindir,ntiles=1)
+
+    # Merge the results
+    sub = np.array(im)
+    outlines = []
+    alshead = None
+    for tile in tiles:
+        tdir = tile['dir']
+        # Append the tile logs
+        if os.path.exists(os.path.join(tdir,'t.als.log')):
+            f = open(logfile,'a')
+            f.write("---- Tile "+str(tile['num'])+" ----\n")
+            f.write(open(os.path.join(tdir,'t.als.log')).read())
+            f.close()
+        # Paste the core of the subtracted image
+        if tile['nstars']>0:
+            tsub = fits.getdata(os.path.join(tdir,'ts.fits'))
+            sub[tile['y0']:tile['y1'],tile['x0']:tile['x1']] = \
+                tsub[tile['y0']-tile['ylo']:tile['y1']-tile['ylo'],tile['x0']-tile['xlo']:tile['x1']-tile['xlo']]
+        # Keep the sources that belong to this tile
+        if tile['nstars']>0 and os.path.exists(os.path.join(tdir,'t.als')):
+            alslines = readlines(os.path.join(tdir,'t.als'))
+            if alshead is None:
+                alshead = alslines[0:3]
+                alshead[1] = daoheadsize(alshead[1],nx,ny)
+            if len(alslines)<=3: continue
+            tcat = daoread(os.path.join(tdir,'t.als'))
+            ownid = apcat['ID'][owner==tile['num']]
+            keep, = np.where(np.isin(tcat['ID'],ownid))
+            for k in keep:
+                line = alslines[k+3]
+                line = line[0:7]+'{:9.3f}'.format(tcat['X'][k]+tile['xlo'])+ \
+                       '{:9.3f}'.format(tcat['Y'][k]+tile['ylo'])+line[25:]
+                outlines.append(line)
+    if alshead is None:
+        logger.error("Output file "+outfile+" NOT Found")
+        raise Exception("ALLSTAR failed")
+
+    # Write the final files
+    writelines(outfile,alshead+outlines)
+    fits.writeto(subfile,sub,head,overwrite=True)
+    shutil.rmtree(tiledir)
+    num = len(outlines)
+    logger.info(str(num)+" stars converged")
+    logger.info("Output file = "+outfile)
+    logger.info("Subfile = "+subfile)
+
+    # Put information in the header
+    if meta is not None:
+        meta["NALLSTAR"] = (num,"Number of ALLSTAR converged sources")
+
+    # Return the final catalog
+    return daoread(outfile,cache=True)
 
 
 # Calculate aperture corrections
@@ -2973,7 +4793,7 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
 
     # Run the script
     try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
+        retcode = timing.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
         if retcode < 0:
             logger.error("Child was terminated by signal"+str(-retcode))
         else:
@@ -3007,12 +4827,264 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
     logger.info("Output file = "+outfile)
 
     # Return the .tot catalog
+    return daoread(outfile,cache=True)
+
+
+# Growth curve model
+#-------------------
+def growmodel(r,ri,a,b,c,d,e):
+    '''
+    Fraction of the light of a star within radius r for the growth curve model of
+    Stetson (1990, PASP, 102, 932) as used here.  The profile is the sum of a Moffat
+    function (exponent `a`, fraction `b`), and a core that is an exponential
+    (fraction `c`, scale length d*ri) and a Gaussian (sigma ri), plus a sky error
+    term `e` (fraction of the light per square pixel).  All the radii are in units
+    of ri, the seeing of the image.
+    '''
+    x = np.asarray(r,float)/ri
+    fm = 1.0-(1.0+x**2)**(1.0-a)
+    fh = 1.0-(1.0+x/d)*np.exp(-x/d)
+    fg = 1.0-np.exp(-0.5*x**2)
+    return b*fm+(1.0-b)*(c*fh+(1.0-c)*fg)+e*np.pi*np.asarray(r,float)**2
+
+
+# Fit the growth curve model
+#---------------------------
+def growfit(mag,err,apertures,nfree=3,fixedvals=None,maxerr=0.2):
+    '''
+    Fit the growth curve model (see growmodel) to the aperture magnitudes of many
+    stars at once.  The magnitude differences between neighboring apertures of all
+    the stars are fit together with robust (Cauchy) least squares.
+
+    Parameters
+    ----------
+    mag : numpy array
+        The aperture magnitudes, [Nstars,Napertures], 99.999 for bad values.
+    err : numpy array
+        The aperture magnitude errors, [Nstars,Napertures].
+    apertures : list or array
+        The aperture radii.
+    nfree : int, optional, default = 3
+          The number of model parameters (a,b,c,d,e) to fit, besides the seeing.
+    fixedvals : list, optional
+          The values of the fixed parameters.  Should have 5-nfree elements.
+          By default they are [1.03, 0.2, 0.1, 0.6, 0.0][nfree:].
+    maxerr : float, optional, default = 0.2
+           Only use magnitudes with errors below this.
+
+    Returns
+    -------
+    pars : numpy array
+         The best-fit [ri,a,b,c,d,e], or None if the fit failed.
+    rms : numpy array
+        The scatter of the magnitude differences about the model that is not
+        from the photometric errors, for every aperture step.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        pars, rms = growfit(apcat['MAG'],apcat['ERR'],apertures[0:-2])
+
+    '''
+    mag = np.atleast_2d(np.array(mag,float))
+    err = np.atleast_2d(np.array(err,float))
+    rap = np.array(apertures,float)
+    allvals = np.array([1.03, 0.2, 0.1, 0.6, 0.0])
+    if fixedvals is not None:
+        allvals[nfree:] = fixedvals
+    # Magnitude differences of neighboring apertures
+    good = (mag<50) & (err<maxerr)
+    dmag = mag[:,1:]-mag[:,:-1]
+    dsig = np.sqrt(err[:,1:]**2+0.001**2)
+    use = good[:,1:] & good[:,:-1]
+    if np.sum(use)<nfree+2:
+        return None,None
+    step = np.broadcast_to(np.arange(len(rap)-1),dmag.shape)[use]
+    obs = dmag[use]
+    sig = dsig[use]
+    lo = np.array([0.05,1.001,0.0,0.0,0.01,-1.0])[0:nfree+1]
+    hi = np.array([50.0,10.0,1.0,1.0,10.0,1.0])[0:nfree+1]
+
+    def model(p):
+        pars = np.concatenate([p,allvals[nfree:]])
+        frac = growmodel(rap,*pars)
+        return -2.5*np.log10(np.maximum(frac[1:],1e-30)/np.maximum(frac[:-1],1e-30))
+
+    def resid(p):
+        return (obs-model(p)[step])/sig
+
+    # Starting seeing from a grid search
+    grid = np.linspace(0.3,10.0,50)
+    chisq = [np.sum(resid(np.concatenate([[ri],allvals[0:nfree]]))**2) for ri in grid]
+    p0 = np.concatenate([[grid[np.argmin(chisq)]],allvals[0:nfree]])
+    p0 = np.clip(p0,lo+1e-6,hi-1e-6)
+    # Cauchy weights for the outliers, so blended stars don't pull up the
+    # wings of the growth curve
+    try:
+        res = least_squares(resid,p0,bounds=(lo,hi),loss='cauchy')
+    except:
+        return None,None
+    if res.success is False or np.sum(np.isfinite(res.x)==False)>0:
+        return None,None
+    pars = np.concatenate([res.x,allvals[nfree:]])
+    # Scatter about the model beyond the photometric errors
+    rawres = obs-model(res.x)[step]
+    rms = np.zeros(len(rap)-1)+0.001
+    for k in range(len(rap)-1):
+        ind = (step==k)
+        if np.sum(ind)>1:
+            scat = 1.4826*np.median(np.abs(rawres[ind]))
+            rms[k] = np.sqrt(np.maximum(scat**2-np.median(sig[ind])**2,0.001**2))
+    return pars,rms
+
+
+# Growth curves and total magnitudes in Python
+#---------------------------------------------
+def growthcurve(photfile,aperfile,meta=None,nfree=[3,2,4],fixedvals=None,maxerr=0.2,logfile=None,
+                logger=None):
+    '''
+    Fit the growth curve and get the total magnitudes of the stars in an aperture
+    photometry file, as an alternative to DAOGROW (daogrow) that runs in Python.
+    The growth curve model (see growmodel) is fit to all the stars at once.  As
+    in DAOGROW, the total magnitude of a star is its magnitude in the aperture
+    with the smallest error of the total (FINALAP) plus the model correction from
+    that aperture out to the largest one (APCORR, never positive).  FINALAP is
+    never beyond the point where the star's growth curve stops agreeing with the
+    model, as when a neighbor gets into the larger apertures.
+
+    This is experimental and has not been checked against DAOGROW output yet
+    (see tests/test_growthcurve.py), so apcor() still runs daogrow.
+
+    Parameters
+    ----------
+    photfile : str
+             The aperture photometry file.
+    aperfile : str
+             The file containing the apertures used for the aperture photometry.
+    meta : astropy header, optional
+           The meta-data dictionary for the image.  Not needed, for the same
+           inputs as daogrow.
+    nfree : int or list, optional, default = [3,2,4]
+          The number of parameters to fit.  With a list, the values are tried in turn
+          until the fit works.
+    fixedvals : list, optional
+          The values for the parameters that are fixed.  By default they are
+          [1.03, 0.2, 0.1, 0.6, 0.0][nfree:].
+    maxerr : float, optional, default = 0.2
+           The maximum error of the magnitudes to use.
+    logfile : str, optional
+            The name of the logfile.  By default this is the base name of `photfile`
+            with a ".gro.log" suffix.
+    logger : logging object
+           The logger to use for the logging information.
+
+    Returns
+    -------
+    totcat : astropy table
+           The total magnitudes, in the same format as the DAOGROW .tot file.
+    Also, the .tot file is created.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        totcat = growthcurve("im101a.ap","im101a.apers")
+
+    '''
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Fitting growth curves --")
+
+    # Check that necessary files exist
+    for f in [photfile,aperfile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return None
+
+    # Set up filenames, make sure they don't exist
+    base = os.path.basename(photfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    if logfile is None: logfile = base+".gro.log"
+    outfile = base+".tot"
+    for f in [logfile,outfile]:
+        if os.path.exists(f): os.remove(f)
+
+    # Apertures, without the sky radii
+    rap = np.array([float(l.split('=')[1]) for l in readlines(aperfile)
+                    if '=' in l and l.split('=')[0].strip() not in ['IS','OS']])
+    apcat = daoread(photfile)
+    mag = np.array(apcat['MAG'],float).reshape(len(apcat),-1)
+    err = np.array(apcat['ERR'],float).reshape(len(apcat),-1)
+    naper = len(rap)
+
+    # Fit the growth curve, with fewer or more free parameters if it fails
+    pars = None
+    for nf in np.atleast_1d(nfree):
+        fv = fixedvals if (fixedvals is not None and len(fixedvals)==5-nf) else None
+        pars,rms = growfit(mag,err,rap,nfree=nf,fixedvals=fv,maxerr=maxerr)
+        if pars is not None:
+            break
+        logger.info("Growth curve fit with nfree="+str(nf)+" failed")
+    if pars is None:
+        logger.error("Growth curve fit failed")
+        raise Exception("Growth curve fit failed")
+    logger.info("nfree="+str(nf)+"  Ri={:.3f} A={:.3f} B={:.3f} C={:.3f} D={:.3f} E={:.4f}".format(*pars))
+
+    # Total magnitudes, as in DAOGROW the magnitude in one aperture (FINALAP)
+    # plus the model correction from there out to the largest aperture (APCORR).
+    # FINALAP is the aperture where the error of the total magnitude is smallest.
+    frac = growmodel(rap,*pars)
+    # the light in a larger aperture is never less, even with the sky term
+    dmodel = np.minimum(-2.5*np.log10(frac[1:]/frac[:-1]),0.0)
+    corr = np.append(np.cumsum(dmodel[::-1])[::-1],0.0)     # aperture k to the largest
+    corrvar = np.append(np.cumsum((rms**2)[::-1])[::-1],0.0)
+    gd = (mag<50) & (err<maxerr)
+    # Only out to where the star's own growth curve stops following the model,
+    # a neighbor in the larger apertures makes the star too bright
+    dmag = mag[:,1:]-mag[:,:-1]
+    agree = np.abs(dmag-dmodel) < 3*np.sqrt(err[:,1:]**2+rms**2+0.001**2)
+    gd[:,1:] &= np.cumprod(agree,axis=1)==1
+    totvar = np.where(gd,err**2+corrvar,np.inf)
+    keep = np.sum(gd,axis=1)>0
+    finalap = np.argmin(totvar,axis=1)+1
+    magfap = mag[np.arange(len(mag)),finalap-1]
+    apcorr = corr[finalap-1]
+    totmag = magfap+apcorr
+    toterr = np.sqrt(totvar[np.arange(len(mag)),finalap-1])
+
+    # Write the .tot file
+    aplines = readlines(photfile)
+    head = aplines[1].split()
+    head1 = "%3d%6d%6d%8.1f%8.1f%8.2f%8.2f%8.2f%8.2f%8.2f\n" % \
+            tuple([1]+[int(v) for v in head[1:3]]+[float(v) for v in head[3:10]])
+    ind, = np.where(keep)
+    f = open(outfile,'w')
+    f.write(aplines[0]+"\n")
+    f.write(head1)
+    f.write("\n")
+    writerows(f,"%7d%9.3f%9.3f%9.4f%9.4f%9.3f%9.3f%9.4f%9d\n",
+              [apcat['ID'][ind],apcat['X'][ind],apcat['Y'][ind],totmag[ind],toterr[ind],
+               apcat['SKY'][ind],magfap[ind],apcorr[ind],finalap[ind]])
+    f.close()
+    f = open(logfile,'w')
+    f.write("Growth curve of "+str(len(ind))+" stars in "+photfile+"\n")
+    f.write("nfree = "+str(nf)+"\n")
+    f.write("Ri A B C D E = "+" ".join(["{:.4f}".format(p) for p in pars])+"\n")
+    f.write("Model growth curve: "+" ".join(["{:.4f}".format(d) for d in dmodel])+"\n")
+    f.write("Model scatter:      "+" ".join(["{:.4f}".format(s) for s in rms])+"\n")
+    f.close()
+
+    # Load and return the catalog
+    logger.info("Output file = "+outfile)
     return daoread(outfile)
 
 
 # Calculate aperture corrections
 #-------------------------------
-def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfile=None,logger=None):
+def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfile=None,logger=None,
+          session=None,apphot='daophot'):
     '''
     Calculate the aperture correction for an image.
 
@@ -3035,6 +5107,11 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
             run.  By default this is the base name of `imfile` with a ".daogrow.log" suffix.
     logger : logging object
            The logger to use for the loggin information.
+    session : DaophotSession, optional
+            Run the DAOPHOT commands in this DAOPHOT session.
+    apphot : str, optional
+           Get the aperture photometry with DAOPHOT PHOTOMETRY ('daophot', the default)
+           or with aperphot() ('native').
 
     Returns
     -------
@@ -3092,8 +5169,12 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
     apertures = [3.0, 3.7965, 4.8046, 6.0803, 7.6947, 9.7377, 12.3232, 15.5952, 19.7360, \
                  24.9762, 31.6077, 40.0000, 50.0000]
     apersfile = base+".apers"
-    apcat, maglim = daoaperphot(imfile,listfile,apertures,optfile=optfile,
-                                apersfile=apersfile,logger=logger)
+    if apphot=='native':
+        apcat, maglim = aperphot(imfile,listfile,apertures,optfile=optfile,
+                                 apersfile=apersfile,logger=logger)
+    else:
+        apcat, maglim = daoaperphot(imfile,listfile,apertures,optfile=optfile,
+                                    apersfile=apersfile,logger=logger,session=session)
 
     # Step 2: Get PSF photometry from the same image
     psfcat = allstar(imfile,psffile,base+".ap",optfile=alsoptfile,logger=logger)
@@ -3120,3 +5201,158 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
     logger.info("aperture correction = %7.3f mag" % apcorr)
 
     return apcorr
+
+
+# Merge the SE and ALLSTAR catalogs
+#----------------------------------
+def mergecat(sexcat,als,apcorr,wcs=None,both=True,sexdetect=True,dcr=1.0,logger=None):
+    '''
+    Add the ALLSTAR PSF photometry to the SExtractor catalog.  The output
+    is a single structured array sized for the output rows and filled with
+    index arrays.
+
+    Parameters
+    ----------
+    sexcat : table
+       The SExtractor catalog.
+    als : table
+       The ALLSTAR catalog.
+    apcorr : float
+       The aperture correction, subtracted from the ALLSTAR magnitudes.
+    wcs : WCS object, optional
+       WCS of the image for RAPSF/DECPSF.
+    both : bool, optional
+       Only keep sources that have both SE and ALLSTAR information.  Default is True.
+    sexdetect : bool, optional
+       The SE catalog was used as the DAOPHOT detection list, match on the IDs.
+         Otherwise match on the coordinates.  Default is True.
+    dcr : float, optional
+       Matching radius (pixels) if the DAOPHOT detection list was used.  Default is 1.0.
+    logger : logging object, optional
+       Logger to use.
+
+    Returns
+    -------
+    cat : numpy structured array
+       The SE columns with XPSF, YPSF, MAGPSF, ERRPSF, SKY, ITER, CHI, SHARP,
+         RAPSF and DECPSF (and ALSID if sexdetect=False).
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cat = mergecat(sexcat,als,apcorr,wcs=wcs)
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')
+    nals = len(als)
+    alsmag = als['MAG']-apcorr
+
+    # New columns to add to the SE catalog
+    ncat = len(sexcat)
+    alsnames = ['X','Y','MAG','ERR','SKY','ITER','CHI','SHARP']
+    newnames = ['XPSF','YPSF','MAGPSF','ERRPSF','SKY','ITER',
+                'CHI','SHARP','RAPSF','DECPSF']
+    newtypes = ['float64','float64','float','float','float','float',
+                'float','float','float64','float64']
+    nan = float('nan')
+    newvals = [nan, nan, nan, nan ,nan, nan, nan, nan, nan, nan]
+    # DAOPHOT detection list used, need ALS ID
+    if not sexdetect:
+        alsnames = ['ID']+alsnames
+        newnames = ['ALSID']+newnames
+        newtypes = ['int32']+newtypes
+        newvals = [-1]+newvals
+
+    # Match up with IDs if SE list used by DAOPHOT
+    if sexdetect:
+        mid, ind1, ind2 = np.intersect1d(sexcat["NUMBER"],als["ID"],return_indices=True)
+    # Match up with coordinates, DAOPHOT detection list used
+    else:
+        # closest SE source within dcr of each ALS source, one-to-one
+        kdt = cKDTree(np.vstack((sexcat['X_IMAGE'],sexcat['Y_IMAGE'])).T)
+        dist,sind = kdt.query(np.vstack((als['X'],als['Y'])).T,distance_upper_bound=dcr)
+        aind, = np.where(np.isfinite(dist))
+        aind = aind[np.argsort(dist[aind],kind='stable')]
+        uind1,first = np.unique(sind[aind],return_index=True)
+        ind1,ind2 = uind1,aind[first]
+        logger.info(str(len(ind1))+" SE and ALS sources matched within "+str(dcr)+" pixels")
+
+    # Output rows, only keep sources that have SE+ALLSTAR information
+    #  trim out ones that don't have ALS
+    if (both is True) & (nals<ncat):
+        rows = ind1
+        dest = np.arange(len(ind1))
+    else:
+        rows = np.arange(ncat)
+        dest = ind1
+    nrows = len(rows)
+
+    # Preallocate the output catalog and fill it with index arrays
+    dtype = [(n,sexcat[n].dtype,sexcat[n].shape[1:]) for n in sexcat.colnames]
+    dtype += [(n,t) for n,t in zip(newnames,newtypes)]
+    cat = np.zeros(nrows,dtype=np.dtype(dtype))
+    for n in sexcat.colnames:
+        cat[n] = np.asarray(sexcat[n])[rows]
+    for n,v in zip(newnames,newvals):
+        cat[n] = v
+    for n1,n2 in zip(newnames,alsnames):
+        cat[n1][dest] = alsmag[ind2] if n2=='MAG' else als[n2][ind2]
+
+    # Add RA, DEC
+    if wcs is not None:
+        r,d = wcs.all_pix2world(cat["XPSF"],cat["YPSF"],1)
+        cat['RAPSF'] = r
+        cat['DECPSF'] = d
+
+    return cat
+
+
+# Write the final catalog
+#------------------------
+def writecat(outfile,cat,meta,template=None):
+    '''
+    Write a catalog array with the meta-data in the primary header and the
+    table in extension 1, in one go.
+
+    Parameters
+    ----------
+    outfile : str
+       The output filename.
+    cat : numpy structured array
+       The catalog, e.g. from mergecat().
+    meta : header
+       The primary header.
+    template : table, optional
+       Table with the column units, descriptions, formats and meta-data to use.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        writecat("F1-00507801_01.cat.fits",cat,meta,template=sexcat)
+
+    '''
+
+    # Keep the template column units and descriptions
+    newcat = Table(cat,copy=False)
+    if template is not None:
+        newcat.meta.update(template.meta)
+        for n in template.colnames:
+            newcat[n].unit = template[n].unit
+            newcat[n].description = template[n].description
+            newcat[n].format = template[n].format
+
+    # Table header from an empty copy, the rows go straight from the array
+    hdu0 = fits.table_to_hdu(newcat[:0])
+    hdu = fits.BinTableHDU(cat,header=hdu0.header)
+    for col in hdu0.columns:
+        hdu.columns[col.name].unit = col.unit
+        hdu.columns[col.name].disp = col.disp
+
+    # Meta in PDU header and the table in extension 1
+    hdulist = fits.HDUList([fits.PrimaryHDU(header=meta),hdu])
+    hdulist.writeto(outfile,overwrite=True)
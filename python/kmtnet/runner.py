@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# RUNNER.PY - Run many tasks on one node without SLURM
+#
+
+from __future__ import print_function
+
+__authors__ = 'David Nidever <dnidever@noao.edu>'
+__version__ = '20261018'  # yyyymmdd
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import traceback
+from collections import deque
+import numpy as np
+from argparse import ArgumentParser
+from astropy.table import Table
+from dlnpyutils import utils as dln
+
+
+def availablememory():
+    """ Available memory in MB (from /proc/meminfo)."""
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo','r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])/1024.0
+    return None
+
+
+class Runner:
+    """
+    Run the tasks of a task table on this node.  Each worker has its own
+    queue of tasks and takes work from the back of the longest other queue
+    once its own is empty.  The number of tasks running at once is limited
+    by the cores and the memory, the starts are spaced by stagger seconds,
+    and failed tasks are retried.  The status of all the tasks is written
+    to the progress file whenever something changes.
+
+    Parameters
+    ----------
+    tasks : table
+       Table with the information on the tasks.  Must have columns of:
+         cmd, outfile, errfile, dir (optional), memory (optional, MB),
+         cost (optional, tasks are started most expensive first).
+    ncores : int, optional
+       Number of cores to use.  Default is all of them.
+    taskcores : int, optional
+       Number of cores each task uses.  Default is 1.
+    memory : float, optional
+       Memory (MB) that the tasks can use.  Default is 90% of the available memory.
+    taskmemory : float, optional
+       Memory (MB) each task needs, if there is no memory column.  Default is 0.
+    stagger : float, optional
+       Minimum number of seconds between two task starts.  Default is 5.
+    retries : int, optional
+       Number of times to rerun a failed task.  Default is 1.
+    progressfile : str, optional
+       JSON file with the status of all the tasks.
+    logger : logging object, optional
+       Logger to use.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        runner = Runner(tasks,ncores=32,taskmemory=4000,progressfile='progress.json')
+        status = runner.run()
+
+    """
+
+    def __init__(self,tasks,ncores=None,taskcores=1,memory=None,taskmemory=0.0,stagger=5.0,
+                 retries=1,progressfile=None,logger=None):
+        if isinstance(tasks,Table)==False:
+            tasks = Table(tasks)
+        self.tasks = tasks
+        self.ntasks = len(tasks)
+        if ncores is None:
+            ncores = os.cpu_count()
+        self.nworkers = int(np.maximum(ncores//taskcores,1))
+        if memory is None:
+            memory = availablememory()
+            if memory is not None: memory*=0.9
+        self.memory = memory
+        if 'memory' in tasks.colnames:
+            self.taskmemory = np.array(tasks['memory']).astype(float)
+        else:
+            self.taskmemory = np.zeros(self.ntasks,float)+taskmemory
+        if memory is not None and np.sum(self.taskmemory>memory)>0:
+            raise Exception(str(np.sum(self.taskmemory>memory))+" tasks need more than "+str(memory)+" MB")
+        self.stagger = stagger
+        self.retries = retries
+        self.progressfile = progressfile
+        if logger is None: logger=dln.basiclogger()
+        self.logger = logger
+        # Status of the tasks
+        self.status = ['pending']*self.ntasks
+        self.attempts = np.zeros(self.ntasks,int)
+        self.retcode = [None]*self.ntasks
+        self.start = np.zeros(self.ntasks,float)
+        self.end = np.zeros(self.ntasks,float)
+        self.worker = np.zeros(self.ntasks,int)-1
+        # Deal the tasks out to the worker queues, most expensive first
+        order = np.arange(self.ntasks)
+        if 'cost' in tasks.colnames:
+            order = np.argsort(-np.array(tasks['cost']).astype(float),kind='stable')
+        self.queues = [deque(order[i::self.nworkers].tolist()) for i in range(self.nworkers)]
+        self._lock = threading.Condition()
+        self._usedmemory = 0.0
+        self._nextstart = 0.0
+        self._t0 = None
+
+    def __repr__(self):
+        return "Runner("+str(self.ntasks)+" tasks, "+str(self.nworkers)+" workers)"
+
+    def nexttask(self,w):
+        """ Get the next task for a worker, stealing one if its queue is empty."""
+        with self._lock:
+            if len(self.queues[w])>0:
+                return self.queues[w].popleft()
+            # Steal from the back of the longest queue
+            nqueue = [len(q) for q in self.queues]
+            victim = int(np.argmax(nqueue))
+            if nqueue[victim]==0:
+                return None
+            return self.queues[victim].pop()
+
+    def reserve(self,i):
+        """ Wait for the memory and the start slot of a task."""
+        with self._lock:
+            if self.memory is not None:
+                while self._usedmemory+self.taskmemory[i]>self.memory:
+                    self._lock.wait()
+            self._usedmemory += self.taskmemory[i]
+            # Space the starts
+            wait = self._nextstart-time.time()
+            self._nextstart = np.maximum(time.time(),self._nextstart)+self.stagger
+        if wait>0:
+            time.sleep(wait)
+
+    def release(self,i):
+        with self._lock:
+            self._usedmemory -= self.taskmemory[i]
+            self._lock.notify_all()
+
+    def runtask(self,i,w):
+        """ Run one task, returns the exit code."""
+        task = self.tasks[i]
+        cwd = None
+        if 'dir' in task.colnames and str(task['dir']).strip()!='':
+            cwd = str(task['dir']).strip()
+        outfile = str(task['outfile']).strip()
+        errfile = str(task['errfile']).strip()
+        with self._lock:
+            self.attempts[i] += 1
+            self.status[i] = 'running'
+            self.worker[i] = w
+            self.start[i] = time.time()
+        self.writeprogress()
+        self.logger.info('Worker '+str(w)+' starting task '+str(i+1)+': '+str(task['cmd']))
+        try:
+            with open(outfile,'a') as out, open(errfile,'a') as err:
+                retcode = subprocess.call(str(task['cmd']),shell=True,stdout=out,stderr=err,cwd=cwd)
+        except:
+            self.logger.error(traceback.format_exc())
+            retcode = -1
+        return retcode
+
+    def work(self,w):
+        """ Worker loop."""
+        while True:
+            i = self.nexttask(w)
+            if i is None:
+                break
+            self.reserve(i)
+            try:
+                retcode = self.runtask(i,w)
+            finally:
+                self.release(i)
+            with self._lock:
+                self.end[i] = time.time()
+                self.retcode[i] = retcode
+                if retcode==0:
+                    self.status[i] = 'done'
+                elif self.attempts[i]<=self.retries:
+                    self.status[i] = 'pending'
+                    self.queues[w].append(i)
+                else:
+                    self.status[i] = 'failed'
+            if retcode!=0:
+                self.logger.warning('Task '+str(i+1)+' failed with exit code '+str(retcode)+
+                                    ' ('+self.status[i]+')')
+            self.writeprogress()
+
+    def summary(self):
+        return {s:self.status.count(s) for s in ['pending','running','done','failed']}
+
+    def writeprogress(self):
+        """ Write the status of all the tasks."""
+        if self.progressfile is None:
+            return
+        with self._lock:
+            prog = {'time':time.time(),'elapsed':time.time()-self._t0,'nworkers':self.nworkers,
+                    'usedmemory':self._usedmemory,'summary':self.summary(),'tasks':[]}
+            for i in range(self.ntasks):
+                prog['tasks'].append({'task':i+1,'status':self.status[i],'attempts':int(self.attempts[i]),
+                                      'retcode':self.retcode[i],'worker':int(self.worker[i]),
+                                      'start':float(self.start[i]),'end':float(self.end[i])})
+            tmpfile = self.progressfile+'.'+str(threading.get_ident())+'.tmp'
+            with open(tmpfile,'w') as f:
+                json.dump(prog,f,indent=1)
+            os.replace(tmpfile,self.progressfile)
+
+    def run(self):
+        """ Run all of the tasks.  Returns the status of each task."""
+        self._t0 = time.time()
+        self.logger.info('Running '+str(self.ntasks)+' tasks with '+str(self.nworkers)+' workers')
+        self.writeprogress()
+        threads = [threading.Thread(target=self.work,args=(w,),daemon=True) for w in range(self.nworkers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.writeprogress()
+        self.logger.info(str(self.summary())+' in '+'{:.1f}'.format(time.time()-self._t0)+' seconds')
+        return self.status
+
+
+#-------------------------------------------------
+# Main command-line program
+#-------------------------------------------------
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description='Run the tasks of a task table on this node.')
+    parser.add_argument('taskfile',type=str,nargs=1,help='Task table (FITS) with cmd, outfile and errfile columns')
+    parser.add_argument('--ncores',type=int,nargs=1,default=None,help='Number of cores to use')
+    parser.add_argument('--taskcores',type=int,nargs=1,default=1,help='Number of cores each task uses')
+    parser.add_argument('--memory',type=float,nargs=1,default=None,help='Memory (MB) the tasks can use')
+    parser.add_argument('--taskmemory',type=float,nargs=1,default=0.0,help='Memory (MB) each task needs')
+    parser.add_argument('--stagger',type=float,nargs=1,default=5.0,help='Seconds between task starts')
+    parser.add_argument('--retries',type=int,nargs=1,default=1,help='Number of times to rerun failed tasks')
+    parser.add_argument('--progress',type=str,nargs=1,default=None,help='Progress file')
+    args = parser.parse_args()
+
+    def getarg(val):
+        return val[0] if isinstance(val,list) else val
+
+    tasks = Table.read(args.taskfile[0])
+    runner = Runner(tasks,ncores=getarg(args.ncores),taskcores=getarg(args.taskcores),
+                    memory=getarg(args.memory),taskmemory=getarg(args.taskmemory),
+                    stagger=getarg(args.stagger),retries=getarg(args.retries),
+                    progressfile=getarg(args.progress))
+    status = runner.run()
+    if 'failed' in status:
+        sys.exit(1)
@@ -10,6 +10,8 @@ from astropy.table import Table
 from astropy.io import fits
 from dlnpyutils import utils as dln
 import subprocess
+import heapq
+from glob import glob
 
 # Some slurm helper functions
 
@@ -18,18 +20,146 @@ def genkey(n=20):
     key =  ''.join(random.choice(characters) for i in range(n))
     return key
 
+def taskfile(task):
+    """ The exposure file of a task, from the 'filename' column or the command."""
+    if 'filename' in task.colnames:
+        return str(task['filename']).strip()
+    for c in str(task['cmd']).split():
+        if c.endswith('.fits') or c.endswith('.fits.fz') or c.endswith('.fz'):
+            return c
+    return None
+
+def readhistory(history):
+    """ Exposure runtimes (seconds) from the Exposure timing tables (*_timing.fits)."""
+    if isinstance(history,str):
+        history = glob(history)
+    runtime = {}
+    for f in history:
+        try:
+            tab = Table.read(f)
+        except:
+            continue
+        base = tab.meta.get('EXPOSURE')
+        if base is None:
+            base = os.path.basename(f).replace('_timing.fits','')
+        # Sum of the chip times, the node cpus are the parallel resource
+        ind, = np.where((np.char.strip(np.array(tab['stage']).astype(str))=='total') &
+                        (np.char.strip(np.array(tab['kind']).astype(str))=='stage'))
+        if len(ind)>0:
+            runtime[base] = float(np.sum(tab['wall'][ind]))
+    return runtime
+
+def predictcost(tasks,history=None,logger=None):
+    """
+    Predict the runtime of each task.  Exposures with a historical runtime
+    (from the Exposure timing tables) use it, the others are scaled from the
+    number of pixels (summed over the extensions, or the file size if the
+    header can't be read) with the median historical seconds per pixel.
+    Without any history the cost is in units of Mpix.
+
+    Parameters
+    ----------
+    tasks : table
+       Table with the information on the tasks.  Uses the 'filename' column
+         if there is one, otherwise the .fits/.fz file in 'cmd'.
+    history : str or list, optional
+       Timing table files (or a glob pattern) of earlier runs.
+    logger : logging object, optional
+       Logger to use.
+
+    Returns
+    -------
+    cost : numpy array
+       Predicted cost of each task.
+    units : str
+       'sec' or 'Mpix'.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cost,units = predictcost(tasks,history='/data/kmtnet/*/*/*_timing.fits')
+
+    """
+
+    if logger is None:
+        logger = dln.basiclogger()
+    ntasks = len(tasks)
+    runtime = {}
+    if history is not None:
+        runtime = readhistory(history)
+    npix = np.zeros(ntasks,float)+np.nan
+    hist = np.zeros(ntasks,float)+np.nan
+    for i in range(ntasks):
+        filename = taskfile(tasks[i])
+        if filename is None or os.path.exists(filename)==False:
+            continue
+        base = os.path.splitext(os.path.basename(filename))[0]
+        if base in runtime:
+            hist[i] = runtime[base]
+        try:
+            with fits.open(filename) as hdu:
+                npix[i] = np.sum([h.header.get('NAXIS1',0)*h.header.get('NAXIS2',0) for h in hdu])
+        except:
+            npix[i] = os.path.getsize(filename)/4.0   # 32-bit pixels
+    npix /= 1e6
+    # Nothing known about the exposure, use the median
+    if np.sum(np.isfinite(npix))==0:
+        npix[:] = 1.0
+    npix[~np.isfinite(npix)] = np.nanmedian(npix)
+    # Convert to seconds with the historical runtimes
+    gd, = np.where(np.isfinite(hist) & (npix>0))
+    if len(gd)>0:
+        rate = np.median(hist[gd]/npix[gd])
+        cost = npix*rate
+        cost[gd] = hist[gd]
+        units = 'sec'
+        logger.info(str(len(gd))+' tasks with historical runtimes, '+'{:.2f}'.format(rate)+' sec/Mpix')
+    else:
+        cost = npix
+        units = 'Mpix'
+    return cost,units
+
+def packtasks(cost,nodes):
+    """ Distribute the tasks over the nodes, longest-processing-time first.
+        Returns the node (1-based) of each task and the total cost of each node."""
+    node = np.zeros(len(cost),int)
+    load = np.zeros(nodes,float)
+    heap = [(0.0,i) for i in range(nodes)]
+    for j in np.argsort(-np.asarray(cost),kind='stable'):
+        tot,i = heapq.heappop(heap)
+        node[j] = i+1
+        load[i] = tot+cost[j]
+        heapq.heappush(heap,(load[i],i))
+    return node,load
+
+def nodemakespan(cost,cpus):
+    """ Finishing time of tasks run in order on cpus slots."""
+    slots = [0.0]*np.minimum(cpus,np.maximum(len(cost),1))
+    for c in cost:
+        t = heapq.heappop(slots)
+        heapq.heappush(slots,t+c)
+    return max(slots)
+
 # submitting tempest measure jobs
 def submit(tasks,label,nodes=1,cpus=64,version='v4',account='priority-davidnidever',
            partition='priority',staggertime=60,host='tempest_group',shared=True,
            walltime='12-00:00:00',notification=False,memory=7500,numpy_num_threads=2,
            precommands=None,nosubmit=False,slurmroot='/tmp',slurmdir=None,
-           verbose=True,logger=None):
+           balance=True,history=None,verbose=True,logger=None):
     """
     Submit a bunch of jobs
 
     tasks : table
       Table with the information on the tasks.  Must have columns of:
         cmd, outfile, errfile, dir (optional)
+    balance : bool
+      Distribute the tasks over the nodes by their predicted cost instead
+        of round-robin.  Default is True.  Otherwise the tasks of each node
+        are also run in their original order.
+    history : str or list
+      Timing tables of earlier runs used to predict the cost.
 
     """
 
@@ -61,18 +191,45 @@ def submit(tasks,label,nodes=1,cpus=64,version='v4',account='priority-davidnidev
         tasks = Table(tasks)
     tasks['task'] = -1
     tasks['node'] = -1
+
+    # Predicted cost of each task
+    cost,units = predictcost(tasks,history=history,logger=logger)
+    tasks['cost'] = cost
     
     # Parcel out the tasks to the nodes
-    #  -loop over all the nodes until we've
-    #    exhausted all of the tasks
-    count = 0
-    while (count<ntasks):
-        for i in range(nodes):
-            node = i+1
-            if count>=ntasks: break
-            tasks['task'][count] = count+1
-            tasks['node'][count] = node
-            count += 1
+    if balance:
+        # longest-processing-time first
+        tasks['task'] = np.arange(ntasks)+1
+        tasks['node'],load = packtasks(cost,nodes)
+    else:
+        #  -loop over all the nodes until we've
+        #    exhausted all of the tasks
+        count = 0
+        while (count<ntasks):
+            for i in range(nodes):
+                node = i+1
+                if count>=ntasks: break
+                tasks['task'][count] = count+1
+                tasks['node'][count] = node
+                count += 1
+
+    # Predicted makespan of each node, when balanced the most expensive
+    #  tasks are started first
+    report = ['# node  ntasks  cost  makespan ('+units+')']
+    makespan = 0.0
+    for i in range(nodes):
+        ind, = np.where(tasks['node']==i+1)
+        if balance:
+            ind = ind[np.argsort(-cost[ind],kind='stable')]
+        span = nodemakespan(cost[ind],cpus) if len(ind)>0 else 0.0
+        makespan = np.maximum(makespan,span)
+        report += ['{:4d} {:7d} {:12.1f} {:12.1f}'.format(i+1,len(ind),np.sum(cost[ind]),span)]
+    # Compare to round-robin
+    rrspan = np.max([nodemakespan(cost[i::nodes],cpus) for i in range(np.minimum(nodes,np.maximum(ntasks,1)))])
+    report += ['# predicted makespan = {:.1f} {:s}, round-robin = {:.1f} {:s}'.format(makespan,units,rrspan,units)]
+    if verbose:
+        logger.info('Predicted makespan = {:.1f} {:s} (round-robin {:.1f} {:s})'.format(makespan,units,rrspan,units))
+    dln.writelines(os.path.join(jobdir,label+'_makespan.txt'),report)
 
     # Make the main slurm script and the scripts for each node
             
@@ -83,6 +240,9 @@ def submit(tasks,label,nodes=1,cpus=64,version='v4',account='priority-davidnidev
     for i in range(len(node_index['value'])):
         ind = node_index['index'][node_index['lo'][i]:node_index['hi'][i]+1]
         ind = np.sort(ind)
+        # most expensive first, otherwise in the original order
+        if balance:
+            ind = ind[np.argsort(-cost[ind],kind='stable')]
         nind = len(ind)
         node = node_index['value'][i]
         nodefile = 'node{:02d}.slurm'.format(node)
@@ -213,7 +373,7 @@ def nsclauncher(tasks,label,nodes=1,cpus=64,version='v4',account='priority-david
                 partition='priority',staggertime=60,host='tempest_group',shared=True,
                 walltime='12-00:00:00',notification=False,memory=7500,numpy_num_threads=2,
                 precommands=None,nosubmit=False,slurmroot='/tmp',slurmdir=None,
-                logdir=None,verbose=True,logger=None):
+                logdir=None,port=9471,verbose=True,logger=None):
     """
     Submit a bunch of jobs
 
@@ -293,9 +453,9 @@ def nsclauncher(tasks,label,nodes=1,cpus=64,version='v4',account='priority-david
         lines += ['echo "Making logdir = '+logdir+'"']
         lines += ['mkdir -p '+logdir]
 
-        # nscjob_manager tasksfile version --host host --staggertime 60 --njobs 64
-        cmd = 'nsc_launcher '+taskfile+' '+version+' --host '+host
-        cmd += ' --nchost NETCATHOST --ncport NETCATPORT'
+        # The workers report each task as done or failed to the task server
+        cmd = 'python -m kmtnet.taskworker '+os.path.join(jobdir,label+'_tasks.fits')
+        cmd += ' --host $NETCATHOST --port $NETCATPORT'
         
         # Loop over the processes
         for j in range(cpus):
@@ -350,23 +510,20 @@ def nsclauncher(tasks,label,nodes=1,cpus=64,version='v4',account='priority-david
     lines += ['export LAUNCHER_NPROCS='+str(nprocs)]
     lines += ["export LAUNCHER_NJOBS=`wc -l $LAUNCHER_JOB_FILE | awk '{print $1}'`"]
     lines += ['']
-    # Start the taskserver
+    lines += ['SBATCH_NODE=$( printf "%02d']
+    lines += ['" "$SLURM_ARRAY_TASK_ID" )']
+    # Start the taskserver, the node script is sourced so it picks up
+    #  the host and port variables
+    #  the state file lets a relaunch skip the tasks that are done
     lines += ['NETCATHOST=$HOSTNAME']
-    tskserverlog = os.path.join(jobdir,'tskserver.log')
-    lines += ['nsctskserver '+str(ntasks)+' $NETCATHOST 9471 2> '+tskserverlog+' &']
+    lines += ['NETCATPORT='+str(port)]
+    tskserverlog = os.path.join(jobdir,'tskserver${SBATCH_NODE}.log')
+    tskstatefile = os.path.join(jobdir,label+'_tasks${SBATCH_NODE}.state')
+    lines += ['python -m kmtnet.taskserver '+str(ntasks)+' --host $NETCATHOST --port $NETCATPORT '+
+              '--statefile '+tskstatefile+' 2> '+tskserverlog+' &']
     lines += ['LAUNCHER_DYN_PID=$!']
     lines += ['disown $LAUNCHER_DYN_PID']
     lines += ['sleep 1s']
-    # Modify all of the node slurm files for the netcat host and port    
-    lines += ['']
-    #lines += ['for i in `eval "echo {2..$max}"`']
-    lines += ['for f in `ls node??.slurm`']    
-    lines += ['do']
-    lines += ['    echo "modifying $f"']
-    lines += ['    cmd="sed -i \'s/NETCATHOST/${NETCATHOST}/g\' $f"']
-    lines += ['    eval $cmd']
-    lines += ["    sed -i 's/NETCATPORT/9471/g' $f"]
-    lines += ['done']
 
     lines += ['echo "Launcher: Setup complete."']
     lines += ['echo']
@@ -378,8 +535,6 @@ def nsclauncher(tasks,label,nodes=1,cpus=64,version='v4',account='priority-david
     lines += ['echo "   Total jobs:         $LAUNCHER_NJOBS"']
     lines += ['echo "   Job file:           $LAUNCHER_JOB_FILE"']
     
-    lines += ['SBATCH_NODE=$( printf "%02d']
-    lines += ['" "$SLURM_ARRAY_TASK_ID" )']
     lines += ['source '+jobdir+'/node${SBATCH_NODE}.slurm']
     lines += ['wait']
     lines += ['']
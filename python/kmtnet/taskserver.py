@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+#
+# TASKSERVER.PY - Hand out task numbers to the workers over TCP
+#
+
+from __future__ import print_function
+
+__authors__ = 'David Nidever <dnidever@noao.edu>'
+__version__ = '20261018'  # yyyymmdd
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+from collections import deque
+import numpy as np
+from argparse import ArgumentParser
+from dlnpyutils import utils as dln
+
+# Task status
+PENDING,CLAIMED,DONE,FAILED = 0,1,2,3
+STATUSNAMES = ['pending','claimed','done','failed']
+
+
+class TaskServer:
+    """
+    Hand out task numbers to workers over TCP.  The requests and replies are
+    one JSON object per line:
+
+      {"op":"claim","n":2,"done":[5]}  ->  {"tasks":[7,8]}   ([] when there are none left)
+      {"op":"done","tasks":[7]}        ->  {"ok":true}
+      {"op":"fail","tasks":[8],"error":"..."}  ->  {"ok":true}
+      {"op":"status"}                  ->  {"pending":..,"claimed":..,"done":..,"failed":..}
+      {"op":"shutdown"}                ->  {"ok":true}
+
+    The old netcat request {"hostUp": true} is also understood, it gets
+    one task number as plain text (nothing when there are none left).  The
+    old clients never report back, so like nsctskserver these tasks count
+    as done once they are handed out.  Tasks that a worker still had claimed
+    when its connection closed are marked as failed.  Every change is
+    appended to the state file so a relaunch skips the tasks that were
+    already done.  The server stops once all tasks are done or failed.
+
+    Parameters
+    ----------
+    ntasks : int
+       Number of tasks.
+    host : str, optional
+       Hostname to listen on.  Default is 'localhost'.
+    port : int, optional
+       Port to listen on.  Default is 9471.
+    statefile : str, optional
+       File to keep the task progress in.
+    first : int, optional
+       The number of the first task.  Default is 0.
+    retryfailed : bool, optional
+       Hand out the tasks that failed in an earlier run again.  Default is True.
+    logger : logging object, optional
+       Logger to use.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        server = TaskServer(100,port=9471,statefile='tasks.state')
+        server.run()
+
+    """
+
+    def __init__(self,ntasks,host='localhost',port=9471,statefile=None,first=0,
+                 retryfailed=True,logger=None):
+        self.ntasks = ntasks
+        self.host = host
+        self.port = port
+        self.statefile = statefile
+        self.first = first
+        self.retryfailed = retryfailed
+        if logger is None: logger=dln.basiclogger()
+        self.logger = logger
+        self.status = np.zeros(ntasks,int)
+        self.pending = deque()
+        self._state = None
+        self._stop = None
+        self.load()
+
+    def __repr__(self):
+        return "TaskServer("+str(self.ntasks)+" tasks, "+self.host+":"+str(self.port)+")"
+
+    def load(self):
+        """ Get the progress of an earlier run from the state file."""
+        if self.statefile is not None and os.path.exists(self.statefile):
+            with open(self.statefile,'r') as f:
+                lines = f.readlines()
+            head = json.loads(lines[0])
+            if head.get('ntasks')!=self.ntasks or head.get('first')!=self.first:
+                raise Exception(self.statefile+" is for "+str(head.get('ntasks'))+" tasks starting at "+
+                                str(head.get('first')))
+            for line in lines[1:]:
+                try:
+                    ev = json.loads(line)
+                except:
+                    continue   # partly written last line
+                self.status[ev['task']] = STATUSNAMES.index(ev['status'])
+            ndone = np.sum(self.status==DONE)
+            nfailed = np.sum(self.status==FAILED)
+            self.logger.info(str(ndone)+" tasks done and "+str(nfailed)+" failed in earlier runs")
+            # Claimed tasks were never finished
+            self.status[self.status==CLAIMED] = PENDING
+            if self.retryfailed:
+                self.status[self.status==FAILED] = PENDING
+        self.pending = deque(np.where(self.status==PENDING)[0].tolist())
+        if self.statefile is not None:
+            new = os.path.exists(self.statefile)==False
+            self._state = open(self.statefile,'a')
+            if new:
+                self._state.write(json.dumps({'ntasks':self.ntasks,'first':self.first})+'\n')
+                self._state.flush()
+
+    def record(self,tasks,status,worker,error=None):
+        """ Save task status changes to the state file."""
+        if self._state is None or len(tasks)==0:
+            return
+        t = time.time()
+        lines = []
+        for i in tasks:
+            ev = {'task':int(i),'status':STATUSNAMES[status],'worker':worker,'time':t}
+            if error is not None: ev['error']=error
+            lines.append(json.dumps(ev)+'\n')
+        self._state.write(''.join(lines))
+        self._state.flush()
+        os.fsync(self._state.fileno())
+
+    def claim(self,n,worker):
+        """ Claim the next n pending tasks."""
+        tasks = []
+        while len(tasks)<n and len(self.pending)>0:
+            tasks.append(self.pending.popleft())
+        self.status[tasks] = CLAIMED
+        self.record(tasks,CLAIMED,worker)
+        return tasks
+
+    def finish(self,tasks,status,worker,error=None):
+        """ Mark claimed tasks as done or failed."""
+        tasks = [i for i in tasks if i>=0 and i<self.ntasks and self.status[i]==CLAIMED]
+        self.status[tasks] = status
+        self.record(tasks,status,worker,error)
+        if status==FAILED and len(tasks)>0:
+            self.logger.info("Tasks "+",".join([str(i+self.first) for i in tasks])+" failed: "+str(error))
+        return tasks
+
+    def finished(self):
+        """ All tasks are done or failed."""
+        return len(self.pending)==0 and np.sum(self.status==CLAIMED)==0
+
+    def summary(self):
+        return {STATUSNAMES[s]:int(np.sum(self.status==s)) for s in range(len(STATUSNAMES))}
+
+    def request(self,req,worker,claimed):
+        """ Handle one request from a worker."""
+        op = req.get('op')
+        worker = req.get('worker',worker)
+        if op=='claim':
+            done = [i-self.first for i in req.get('done',[])]
+            self.finish(done,DONE,worker)
+            tasks = self.claim(int(req.get('n',1)),worker)
+            claimed.update(tasks)
+            return {'tasks':[i+self.first for i in tasks]}
+        elif op=='done' or op=='fail':
+            status = DONE if op=='done' else FAILED
+            self.finish([i-self.first for i in req.get('tasks',[])],status,worker,req.get('error'))
+            return {'ok':True}
+        elif op=='status':
+            return self.summary()
+        elif op=='shutdown':
+            self._stop.set()
+            return {'ok':True}
+        return {'error':'unknown op '+str(op)}
+
+    async def handle(self,reader,writer):
+        """ Serve one worker connection."""
+        worker = str(writer.get_extra_info('peername'))
+        claimed = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line)==0:
+                    break
+                try:
+                    req = json.loads(line)
+                except:
+                    reply = {'error':'bad request'}
+                else:
+                    # Old netcat clients get one task number and are done,
+                    #  they never report back so it counts as finished
+                    if 'hostUp' in req:
+                        tasks = self.claim(1,worker)
+                        self.finish(tasks,DONE,worker)
+                        if len(tasks)>0:
+                            writer.write((str(tasks[0]+self.first)+'\n').encode())
+                            await writer.drain()
+                        break
+                    reply = self.request(req,worker,claimed)
+                writer.write((json.dumps(reply)+'\n').encode())
+                await writer.drain()
+        except (ConnectionError,asyncio.IncompleteReadError,asyncio.CancelledError):
+            pass
+        finally:
+            # The worker went away without finishing these
+            lost = [i for i in claimed if self.status[i]==CLAIMED]
+            self.finish(lost,FAILED,worker,'worker disconnected')
+            writer.close()
+            if self.finished():
+                self._stop.set()
+
+    async def serve(self):
+        """ Serve until all tasks are finished or there is a shutdown request."""
+        self._stop = asyncio.Event()
+        if self.finished():
+            self.logger.info("All "+str(self.ntasks)+" tasks are already done")
+            self.close()
+            return
+        server = await asyncio.start_server(self.handle,self.host,self.port,reuse_address=True)
+        self.logger.info("Serving "+str(len(self.pending))+" tasks on "+self.host+":"+str(self.port))
+        async with server:
+            await self._stop.wait()
+        self.logger.info(str(self.summary()))
+        self.close()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def close(self):
+        if self._state is not None:
+            self._state.close()
+        self._state = None
+
+
+class TaskClient:
+    """
+    Get task numbers from a TaskServer.
+
+    Parameters
+    ----------
+    host : str, optional
+       Hostname of the server.  Default is 'localhost'.
+    port : int, optional
+       Port of the server.  Default is 9471.
+    worker : str, optional
+       Name of this worker.  Default is hostname:pid.
+    retries : int, optional
+       Number of times to try to connect, one second apart.  Default is 5.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        client = TaskClient('node01',9471)
+        tasks = client.claim(4)
+        client.done(tasks)
+
+    """
+
+    def __init__(self,host='localhost',port=9471,worker=None,retries=5):
+        self.host = host
+        self.port = port
+        if worker is None:
+            worker = socket.gethostname()+':'+str(os.getpid())
+        self.worker = worker
+        self.retries = retries
+        self.claimed = []
+        self._sock = None
+        self._file = None
+
+    def __repr__(self):
+        return "TaskClient("+self.host+":"+str(self.port)+")"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def connect(self):
+        for i in range(self.retries):
+            try:
+                self._sock = socket.create_connection((self.host,self.port))
+                break
+            except ConnectionRefusedError:
+                if i==self.retries-1: raise
+                time.sleep(1)
+        self._file = self._sock.makefile('rb')
+
+    def request(self,**req):
+        """ Send a request to the server and return the reply."""
+        if self._sock is None:
+            self.connect()
+        req['worker'] = self.worker
+        self._sock.sendall((json.dumps(req)+'\n').encode())
+        line = self._file.readline()
+        if len(line)==0:
+            self.close()
+            raise ConnectionError("Task server closed the connection")
+        return json.loads(line)
+
+    def claim(self,n=1,done=None):
+        """ Claim up to n tasks, and report tasks as done at the same time."""
+        if done is None: done=[]
+        tasks = self.request(op='claim',n=n,done=list(done))['tasks']
+        self.claimed = [i for i in self.claimed if i not in done]+tasks
+        return tasks
+
+    def done(self,tasks):
+        self.claimed = [i for i in self.claimed if i not in tasks]
+        return self.request(op='done',tasks=list(tasks))
+
+    def fail(self,tasks,error=None):
+        self.claimed = [i for i in self.claimed if i not in tasks]
+        return self.request(op='fail',tasks=list(tasks),error=error)
+
+    def status(self):
+        return self.request(op='status')
+
+    def shutdown(self):
+        return self.request(op='shutdown')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._sock is not None:
+            self._sock.close()
+        self._file = None
+        self._sock = None
+
+
+#-------------------------------------------------
+# Main command-line program
+#-------------------------------------------------
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description='Hand out task numbers to workers over TCP.')
+    parser.add_argument('ntasks',type=int,nargs=1,help='Number of tasks')
+    parser.add_argument('--host',type=str,nargs=1,default='localhost',help='Hostname to listen on')
+    parser.add_argument('--port',type=int,nargs=1,default=9471,help='Port to listen on')
+    parser.add_argument('--statefile',type=str,nargs=1,default=None,help='File to keep the task progress in')
+    parser.add_argument('--first',type=int,nargs=1,default=0,help='Number of the first task')
+    parser.add_argument('--noretry',action='store_true',help='Do not rerun tasks that failed before')
+    args = parser.parse_args()
+
+    ntasks = args.ntasks[0]
+    host = args.host[0] if isinstance(args.host,list) else args.host
+    port = args.port[0] if isinstance(args.port,list) else args.port
+    statefile = args.statefile[0] if isinstance(args.statefile,list) else args.statefile
+    first = args.first[0] if isinstance(args.first,list) else args.first
+
+    server = TaskServer(ntasks,host=host,port=port,statefile=statefile,first=first,
+                        retryfailed=(args.noretry==False))
+    server.run()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# TASKWORKER.PY - Run the tasks that a TaskServer hands out
+#
+
+from __future__ import print_function
+
+__authors__ = 'David Nidever <dnidever@noao.edu>'
+__version__ = '20261018'  # yyyymmdd
+
+import sys
+import time
+import subprocess
+import traceback
+from argparse import ArgumentParser
+from astropy.table import Table
+from dlnpyutils import utils as dln
+from .taskserver import TaskClient
+
+
+def runtask(task,logger=None):
+    """ Run one task of a task table, returns the exit code."""
+    if logger is None: logger=dln.basiclogger()
+    cwd = None
+    if 'dir' in task.colnames and str(task['dir']).strip()!='':
+        cwd = str(task['dir']).strip()
+    outfile = str(task['outfile']).strip()
+    errfile = str(task['errfile']).strip()
+    try:
+        with open(outfile,'a') as out, open(errfile,'a') as err:
+            retcode = subprocess.call(str(task['cmd']),shell=True,stdout=out,stderr=err,cwd=cwd)
+    except:
+        logger.error(traceback.format_exc())
+        retcode = -1
+    return retcode
+
+
+def taskworker(tasks,host='localhost',port=9471,first=0,logger=None):
+    """
+    Run the tasks of a task table as a TaskServer hands them out.  Each task
+    is reported as done or failed (non-zero exit code) when it finishes.
+    The worker stops when there are no tasks left.
+
+    Parameters
+    ----------
+    tasks : table
+       Table with the information on the tasks.  Must have columns of:
+         cmd, outfile, errfile, dir (optional)
+    host : str, optional
+       Hostname of the server.  Default is 'localhost'.
+    port : int, optional
+       Port of the server.  Default is 9471.
+    first : int, optional
+       The task number of the first row of `tasks`.  Default is 0.
+    logger : logging object, optional
+       Logger to use.
+
+    Returns
+    -------
+    ndone : int
+       Number of tasks that finished okay.
+    nfailed : int
+       Number of tasks that failed.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        ndone,nfailed = taskworker(tasks,'node01',9471)
+
+    """
+
+    if logger is None: logger=dln.basiclogger()
+    if isinstance(tasks,Table)==False:
+        tasks = Table(tasks)
+    ndone,nfailed = 0,0
+    done = []
+    with TaskClient(host,port) as client:
+        while True:
+            # Report the last task as done and get the next one
+            try:
+                claimed = client.claim(1,done=done)
+            except (ConnectionError,OSError):
+                # The server stops once all of the tasks are finished
+                break
+            done = []
+            if len(claimed)==0:
+                break
+            num = claimed[0]
+            task = tasks[num-first]
+            logger.info('Starting task '+str(num)+': '+str(task['cmd']))
+            t0 = time.time()
+            retcode = runtask(task,logger=logger)
+            if retcode==0:
+                done = [num]
+                ndone += 1
+            else:
+                logger.warning('Task '+str(num)+' failed with exit code '+str(retcode))
+                client.fail([num],'exit code '+str(retcode))
+                nfailed += 1
+            logger.info('Task '+str(num)+' took {:.1f} seconds'.format(time.time()-t0))
+    return ndone,nfailed
+
+
+#-------------------------------------------------
+# Main command-line program
+#-------------------------------------------------
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description='Run the tasks that a task server hands out.')
+    parser.add_argument('taskfile',type=str,nargs=1,help='Task table (FITS) with cmd, outfile and errfile columns')
+    parser.add_argument('--host',type=str,nargs=1,default='localhost',help='Hostname of the task server')
+    parser.add_argument('--port',type=int,nargs=1,default=9471,help='Port of the task server')
+    parser.add_argument('--first',type=int,nargs=1,default=0,help='Number of the first task')
+    args = parser.parse_args()
+
+    taskfile = args.taskfile[0]
+    host = args.host[0] if isinstance(args.host,list) else args.host
+    port = args.port[0] if isinstance(args.port,list) else args.port
+    first = args.first[0] if isinstance(args.first,list) else args.first
+
+    tasks = Table.read(taskfile)
+    ndone,nfailed = taskworker(tasks,host=host,port=port,first=first)
+    if nfailed>0:
+        sys.exit(1)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#
+# BENCH_DAOREAD.PY - Time daoread against the old per-row reader
+#
+#  python -m kmtnet.tests.bench_daoread [nstars] [kind]
+#
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from kmtnet import phot
+from kmtnet.tests.legacy import olddaoread
+from kmtnet.tests.synthetic import writedaofile
+
+
+def bench(nstars=200000,kind='als'):
+    tmpdir = tempfile.mkdtemp(prefix='benchdao')
+    fil = os.path.join(tmpdir,'bench.'+kind)
+    writedaofile(fil,kind,nstars)
+    t0 = time.time()
+    oldcat = olddaoread(fil)
+    told = time.time()-t0
+    t0 = time.time()
+    cat = phot.daoread(fil)
+    tnew = time.time()-t0
+    phot.daoread(fil,cache=True)
+    t0 = time.time()
+    phot.daoread(fil,cache=True)
+    tcache = time.time()-t0
+    same = all([np.array_equal(np.asarray(cat[c]),np.asarray(oldcat[c])) for c in cat.colnames])
+    for f in [fil,fil+'.npz']:
+        if os.path.exists(f): os.remove(f)
+    os.rmdir(tmpdir)
+    print("%d-line .%s file" % (nstars,kind))
+    print("  old reader   %7.3f sec" % told)
+    print("  daoread      %7.3f sec  (%.1fx)" % (tnew,told/tnew))
+    print("  cached       %7.3f sec" % tcache)
+    print("  identical    "+str(same))
+    return told,tnew,tcache
+
+
+if __name__ == "__main__":
+    nstars = int(sys.argv[1]) if len(sys.argv)>1 else 200000
+    kind = sys.argv[2] if len(sys.argv)>2 else 'als'
+    bench(nstars,kind)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#
+# BENCH_GROWMASK.PY - Time growmask against the convolve mask growing
+#
+#  python -m kmtnet.tests.bench_growmask [size] [nmask] [box]
+#
+
+import sys
+import time
+import numpy as np
+from scipy.ndimage import convolve
+from kmtnet import phot
+from kmtnet.tests.synthetic import randmask
+
+
+def bench(size=9000,nmask=20000,box=5):
+    mask = randmask((size,size),nmask)
+    t0 = time.time()
+    old = convolve(mask,np.ones((box,box)),mode='reflect')>0
+    told = time.time()-t0
+    t0 = time.time()
+    new = phot.growmask(mask,(box,box))
+    tnew = time.time()-t0
+    print("%dx%d int16 mask, %d masked pixels, %dx%d box" % (size,size,nmask,box,box))
+    print("  convolve  %7.3f sec" % told)
+    print("  growmask  %7.3f sec  (%.1fx)" % (tnew,told/tnew))
+    print("  identical "+str(np.array_equal(old,new)))
+    return told,tnew
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv)>1 else 9000
+    nmask = int(sys.argv[2]) if len(sys.argv)>2 else 20000
+    box = int(sys.argv[3]) if len(sys.argv)>3 else 5
+    bench(size,nmask,box)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# BENCH_SEEDFWHM.PY - Time the initial FWHM estimate modes of Chip
+#
+#  python -m kmtnet.tests.bench_seedfwhm [size] [nstars]
+#
+#  The 'sex' FWHM comes from SExtractor (phot.sexfwhm of the first
+#  runsex() catalog), so it is only measured when SExtractor and the
+#  config files of the host are there.
+#
+
+import os
+import sys
+import time
+import tempfile
+from kmtnet import kmtnet,utils
+from kmtnet.tests.synthetic import starchip
+
+
+def bench(size=4096,nstars=3000,fwhm=4.0,pixscale=0.4,host=None):
+    curdir = os.getcwd()
+    wdir = tempfile.mkdtemp(prefix='seedfwhm')
+    os.chdir(wdir)
+    try:
+        im,head,cat = starchip('chip',nstars,nx=size,ny=size,fwhm=fwhm,pixscale=pixscale)
+        chip = kmtnet.Chip('flux.fits','chip',host,data=im,header=head,fwhmmode='sex')
+        print("%dx%d chip, %d stars, true FWHM %.2f arcsec" % (size,size,len(cat),fwhm*pixscale))
+        out = {}
+        for mode in ['full','tiled']:
+            t0 = time.time()
+            out[mode] = (chip.seedfwhm(mode),time.time()-t0)
+        configdir = os.path.join(utils.getdirs(host)[0],'config')
+        if os.path.exists(os.path.join(chip.bindir,'sex')) and os.path.exists(configdir):
+            chip.seedfwhm('sex')
+            t0 = time.time()
+            chip.runsex()
+            out['sex'] = (chip._fwhm,time.time()-t0)
+        else:
+            print("  no SExtractor, skipping the 'sex' mode")
+        for mode,(f,dt) in out.items():
+            print("  %-6s %6.3f arcsec  %+5.1f%% of full  %7.3f sec" %
+                  (mode,f,100*(f/out['full'][0]-1),dt))
+    finally:
+        os.chdir(curdir)
+    return out
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv)>1 else 4096
+    nstars = int(sys.argv[2]) if len(sys.argv)>2 else 3000
+    bench(size,nstars)
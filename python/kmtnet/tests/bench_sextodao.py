@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#
+# BENCH_SEXTODAO.PY - Time sextodao against the old per-row writer
+#
+#  python -m kmtnet.tests.bench_sextodao [nstars] [format]
+#
+
+import os
+import sys
+import time
+import tempfile
+from kmtnet import phot
+from kmtnet.tests.legacy import oldsextodao
+from kmtnet.tests.synthetic import sexcat
+from kmtnet.tests.test_sextodao import META
+
+
+def bench(nstars=200000,format='lst'):
+    cat = sexcat(nstars)
+    tmpdir = tempfile.mkdtemp(prefix='benchsex')
+    oldfile = os.path.join(tmpdir,'old.'+format)
+    newfile = os.path.join(tmpdir,'new.'+format)
+    t0 = time.time()
+    oldsextodao(cat,META,oldfile,format=format)
+    told = time.time()-t0
+    t0 = time.time()
+    phot.sextodao(cat,META,newfile,format=format)
+    tnew = time.time()-t0
+    same = open(oldfile,'rb').read()==open(newfile,'rb').read()
+    for f in [oldfile,newfile]: os.remove(f)
+    os.rmdir(tmpdir)
+    print("%d-row .%s file" % (nstars,format))
+    print("  old writer  %7.3f sec" % told)
+    print("  sextodao    %7.3f sec  (%.1fx)" % (tnew,told/tnew))
+    print("  identical   "+str(same))
+    return told,tnew
+
+
+if __name__ == "__main__":
+    nstars = int(sys.argv[1]) if len(sys.argv)>1 else 200000
+    format = sys.argv[2] if len(sys.argv)>2 else 'lst'
+    bench(nstars,format)
@@ -0,0 +1,410 @@
+"""
+Reference versions of the pipeline code from before the speedups, the
+tests check that the new code gives the same results.
+"""
+
+import os
+import re
+import shutil
+import numpy as np
+from astropy.table import Table,Column
+from astropy.io import fits
+from dlnpyutils.utils import readlines,numlines,basiclogger
+
+
+def olddaoread(fil):
+    """ The per-row, per-column daoread from before daocols."""
+
+    # Not enough inputs
+    if fil is None:
+        print("No file name input")
+        return None
+    # Make sure the file exists
+    if os.path.exists(fil) is False:
+        print(fil+" NOT found")
+        return None
+    lines = readlines(fil)
+    nstars = len(lines)-3
+    if nstars == 0:
+        print("No stars in "+fil)
+        return None
+    # Check header
+    line2 = lines[1]
+    nl = int(line2.strip().split(' ')[0])
+    # NL  is a code indicating the file type:
+    # NL = 3 a group file
+    # NL = 2 an aperture photometry file
+    # NL = 1 other (output from FIND, PEAK, or NSTAR) or ALLSTAR, DAOGROW
+    # NL = 0 a file without a header
+    
+    # Check number of columns
+    arr1 = lines[3].split()
+    if len(arr1)==0: arr1 = lines[4].split()
+    ncols = len(arr1)
+
+    # NL = 1  coo file
+    if (nl==1) & (ncols==7):
+        dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('SHARP',float),('ROUND',float),('ROUND2',float)])
+        cat = np.zeros(nstars,dtype=dtype)
+        lengths = np.array([7,9,9,9,9,9,9])
+        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
+        hi = lo+lengths
+        names = cat.dtype.names
+        for i in range(nstars):
+            line1 = lines[i+3]
+            for j in range(len(names)):
+                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
+    # NL = 1  tot file
+    elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is True):
+        # NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
+        #  1  2046  4094   117.7 38652.0   13.12    3.00    3.91    1.55    6.00
+        #  
+        #     11  454.570   37.310  13.9710   0.0084  164.683   14.040  -0.0690        6
+        #     36  287.280   93.860  14.5110   0.0126  165.018   14.580  -0.0690        6
+        dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('MAGFAP',float),('APCORR',float),('FINALAP',int)])
+        cat = np.zeros(nstars,dtype=dtype)
+        lengths = np.array([7,9,9,9,9,9,9,9,9])
+        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
+        hi = lo+lengths
+        names = cat.dtype.names
+        for i in range(nstars):
+            line1 = lines[i+3]
+            for j in range(len(names)):
+                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
+
+    # NL = 1  als file
+    elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is False):
+        dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('ITER',float),('CHI',float),('SHARP',float)])
+        cat = np.zeros(nstars,dtype=dtype)
+        lengths = np.array([7,9,9,9,9,9,9,9,9])
+        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
+        hi = lo+lengths
+        names = cat.dtype.names
+        for i in range(nstars):
+            line1 = lines[i+3]
+            for j in range(len(names)):
+                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
+    # NL = 2  aperture photometry
+    elif nl==2:
+        #
+        #      1 1434.670   15.590   99.999   99.999   99.999   99.999   99.999
+        #      1615.662 20.90  0.00  9.9999   9.9999   9.9999   9.9999   9.9999
+        #
+        #      2  233.850   18.420   99.999   99.999   99.999   99.999   99.999
+        #      1613.601 20.96  0.02  9.9999   9.9999   9.9999   9.9999   9.9999
+        #
+        #  The columns are: ID, X, Y, Mag1, Mag2, etc..
+        #                   Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.
+        ncols = len(lines[4].split())
+        naper = ncols-3   # apertures
+        nstars = int((numlines(fil)-3.0)/3.0)  # stars
+        dtype = np.dtype([('ID',int),('X',float),('Y',float),('SKY',float),('SKYSIG',float),('SKYSKEW',float),('MAG',float,naper),('ERR',float,naper)])
+        cat = np.zeros(nstars,dtype=dtype)
+        # for line 1
+        lengths1 = np.concatenate([np.array([7,9,9]),np.zeros(naper,dtype=int)+9])
+        dtype1 = np.concatenate([np.array([7,9,9]),np.zeros(naper,dtype=int)+9])
+        lo1 = np.concatenate((np.array([0]), np.cumsum(lengths1[0:-1])))
+        hi1 = lo1+lengths1
+        names1 = ['ID','X','Y']+['MAG'+f for f in (np.arange(naper)+1).astype(str)]
+        # for line 2
+        lengths2 = np.concatenate([np.array([14,6,6]),np.zeros(naper,dtype=int)+9])
+        lo2 = np.concatenate((np.array([0]), np.cumsum(lengths2[0:-1])))
+        hi2 = lo2+lengths2
+        names1 = ['SKY','SKYSIG','SKYSKEW']+['ERR'+f for f in (np.arange(naper)+1).astype(str)]
+        for i in range(nstars):
+            # line 1
+            # ID, X, Y, Mag1, Mag2, etc.. 
+            line1 = lines[i*3+4]
+            cat[i]['ID'] = int(line1[lo1[0]:hi1[0]])
+            cat[i]['X'] = float(line1[lo1[1]:hi1[1]])
+            cat[i]['Y'] = float(line1[lo1[2]:hi1[2]])
+            mag = np.zeros(naper,dtype=float)
+            for j in range(naper):
+                mag[j] = np.array(line1[lo1[j+3]:hi1[j+3]],dtype=float)
+            cat[i]['MAG'] = mag
+            # line 2
+            # Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.  
+            line2 = lines[i*3+5]
+            cat[i]['SKY'] = float(line2[lo2[0]:hi2[0]])
+            cat[i]['SKYSIG'] = float(line2[lo2[1]:hi2[1]])
+            cat[i]['SKYSKEW'] = float(line2[lo2[2]:hi2[2]])
+            err = np.zeros(naper,dtype=float)
+            for j in range(naper):
+                err[j] = np.array(line2[lo2[j+3]:hi2[j+3]],dtype=float)
+            cat[i]['ERR'] = err
+    # NL = 3  list
+    elif nl==3:
+        dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float)])
+        cat = np.zeros(nstars,dtype=dtype)
+        lengths = np.array([7,9,9,9,9,9,9])
+        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
+        hi = lo+lengths
+        names = cat.dtype.names
+        for i in range(nstars):
+            line1 = lines[i+3]
+            nline1 = len(line1)
+            for j in range(len(names)):
+                # someimtes lst files are missing the SKY column
+                if hi[j]<=nline1:
+                    cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
+                else:
+                    print('Warning: cannot read column '+names[j]+' for line '+str(i+1))
+    else:
+        print("Cannot load this file")
+        return None
+    # Return as astropy Table
+    return Table(cat)
+
+
+def oldsextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=None,
+                saturate=None,rdnoise=None,gain=None,lowbad=None,thresh=None,logger=None):
+    """ The per-row sextodao from before writerows."""
+
+    if logger is None: logger = basiclogger('phot')   # set up basic logger if necessary
+    # Not enough inputs
+    if cat is None:
+        logger.warning("No catalog input")
+        return
+    if meta is None:
+        logger.warning("No image meta-data dictionary input")
+        return
+    if outfile is None:
+        logger.warning("No outfile given")
+        return
+    # Delete outfile
+    if os.path.exists(outfile): os.remove(outfile)
+
+    # Get meta-data parameters, keyword inputs take priority over "meta"
+    if naxis1 is None: naxis1=meta['NAXIS1']
+    if naxis2 is None: naxis2=meta['NAXIS2']
+    if saturate is None: saturate=meta['SATURATE']
+    if rdnoise is None: rdnoise=meta['RDNOISE']
+    if gain is None: gain=meta['GAIN']
+    if lowbad is None:
+        if meta.get('SKYMED') is not None:
+            skymed = meta['SKYMED']
+            skyrms = meta['SKYRMS']
+            lowbad = skymed-7.*skyrms > 0.0
+            thresh = skyrms*3.5
+        else:
+            logger.info("No sky value found in meta.  Using LOWBAD=1.0")
+            lowbad = 1.0
+    if thresh is None: thresh=20.0
+
+
+    # Formats: coo, lst, ap, als
+
+    # Header values:  this information comes from daophot2.pdf pg.69
+    # NL: Originally meant "number of lines" but not anymore
+    # NX: size of X-dimension of image in pixels
+    # NY: size of Y-dimension of image in pixels
+    # LOWBAD: lower good data limit, calculated by FIND
+    # HIGHBAD: upper good data limit, specified in option file
+    # THRESH: threshold calculated by FIND
+    # AP1: radius (pixels) of the first aperture used by PHOTOMETRY
+    # PH/ADU: gain in photons/ADU used when running FIND
+    # RDNOISE: rdnoise (ADU) used when running FIND
+    # FRAD: value of fitting radius
+
+    # Go through the formats
+    # "coo" file from FIND
+    if format == "coo":
+
+        #NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
+        #  1  2046  4094  1472.8 38652.0   80.94    0.00    3.91    1.55    3.90
+        # 
+        #      1  1434.67    15.59   -0.045    0.313    0.873    1.218
+        #      2   233.85    18.42   -0.018    0.218   -0.781    1.433
+        #    ID      X         Y       MAG     SHARP    ROUND    ROUND2
+        f = open(outfile,'w')
+        # Header
+        f.write(" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n")
+        f.write("  3 %5d %5d %7.1f %7.1f %7.2f %7.2f %7.2f %7.2f %7.2f\n" %
+                (naxis1,naxis2,lowbad,saturate,thresh,3.0,gain,rdnoise/gain,3.9))
+        f.write("\n")
+        #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
+        # Write the data
+        for e in cat:
+            f.write("%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f\n" %
+                    (e["NUMBER"],e["X_IMAGE"],e["Y_IMAGE"],e["MAG_AUTO"],0.6,0.0,0.0))
+        f.close()
+
+    # "lst" file from PICKPSF
+    elif format == "lst":
+
+        #NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
+        # 3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90
+        #
+        #   318 1519.850  622.960   10.963    0.001    0.315
+        #  1199 1036.580 2257.650   11.008    0.001    0.321
+        #   ID     X        Y         MAG      ERR      SKY?
+        f = open(outfile,'w')
+        # Header
+        f.write(" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n")
+        f.write("  3 %5d %5d %7.1f %7.1f %7.2f %7.2f %7.2f %7.2f %7.2f\n" %
+                (naxis1,naxis2,lowbad,saturate,thresh,3.0,gain,rdnoise/gain,3.9))
+        f.write("\n")
+        #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
+        # Write the data
+        for e in cat:
+            f.write("%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n" %
+                    (e["NUMBER"],e["X_IMAGE"]+1,e["Y_IMAGE"]+1,e["MAG_AUTO"],e["MAGERR_AUTO"],0.3))
+        f.close()
+
+    # "ap" file from PHOTOMETRY
+    elif format == "ap":
+        logger.warning(".ap files not supported yet")
+        return
+
+    # "als" file from ALLSTAR
+    elif format == "als":
+
+        # NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
+        #  1  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90
+        # 
+        #      7  219.110   30.895   16.934   0.0935 1613.224       4.    0.872    0.040
+        #     25 1396.437   62.936   12.588   0.0063 1615.938       4.    1.102   -0.042
+        #    ID      X        Y       MAG      ERR     SKY        ITER     CHI     SHARP
+        f = open(outfile,'w')
+        # Header
+        f.write(" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n")
+        f.write("  3 %5d %5d %7.1f %7.1f %7.2f %7.2f %7.2f %7.2f %7.2f\n" %
+                (naxis1,naxis2,lowbad,saturate,thresh,3.0,gain,rdnoise/gain,3.9))
+        f.write("\n")
+        #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
+        # Write the data
+        for e in cat:
+            f.write("%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n" %
+                    (e["NUMBER"],e["X_IMAGE"]+1,e["Y_IMAGE"]+1,e["MAG_AUTO"],e["MAGERR_AUTO"],1500.0,1,1.0,0.0))
+        f.close()
+
+    # Not supported
+    else:
+        logger.warning(format+" NOT supported")
+        return
+
+
+def oldsexconfig(configdir,outfile,smaskfile,swtfile,meta,sexiter=1,dthresh=2.0):
+    """ The default.config writer of runsex() from before SexConfig.
+        Returns the filter name."""
+
+    # Copy the default files
+    shutil.copyfile(configdir+"default.conv","default.conv")
+    shutil.copyfile(configdir+"default.nnw","default.nnw")
+    shutil.copyfile(configdir+"default.param","default.param")
+
+    # Read in configuration file and modify for this image
+    lines = readlines(configdir+'default.config')
+
+    filter_name = ''
+    cnt = 0
+    for l in lines:
+        # CATALOG_NAME
+        m = re.search('^CATALOG_NAME',l)
+        if m != None:
+            lines[cnt] = "CATALOG_NAME     "+outfile+"         # name of the output catalog\n"
+        # FLAG_IMAGE
+        m = re.search('^FLAG_IMAGE',l)
+        if m != None:
+            lines[cnt] = "FLAG_IMAGE     "+smaskfile+"         # filename for an input FLAG-image\n"
+        # WEIGHT_IMAGE
+        m = re.search('^WEIGHT_IMAGE',l)
+        if m != None:
+            lines[cnt] = "WEIGHT_IMAGE     "+swtfile+"  # Weight image name\n"
+        # SATUR_LEVEL
+        m = re.search('^SATUR_LEVEL',l)
+        if m != None:
+            lines[cnt] = "SATUR_LEVEL     "+str(meta["saturate"])+"         # level (in ADUs) at which arises saturation\n"
+        # Gain
+        m = re.search('^GAIN',l)
+        if m != None:
+            lines[cnt] = "GAIN            "+str(meta["gain"])+"            # detector gain in e-/ADU.\n"
+        # Check_image
+        m = re.search('^CHECKIMAGE_TYPE',l)
+        if m != None:
+            lines[cnt] = "CHECKIMAGE_TYPE SEGMENTATION"
+        # Check_image name
+        m = re.search('^CHECKIMAGE_NAME',l)
+        if m != None:
+            lines[cnt] = "CHECKIMAGE_NAME seg_"+str(sexiter)+".fits"
+        # DETECT_THRESH
+        m = re.search('^DETECT_THRESH',l)
+        if m != None:
+            lines[cnt] = "DETECT_THRESH   "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2"
+        # ANALYSIS_THRESH
+        m = re.search('^ANALYSIS_THRESH',l)
+        if m != None:
+            lines[cnt] = "ANALYSIS_THRESH "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2"
+        # SEEING_FWHM
+        m = re.search('^SEEING_FWHM',l)
+        if m != None:
+            lines[cnt] = "SEEING_FWHM     "+str(meta["fwhm"])+"            # stellar FWHM in arcsec\n"
+        # PHOT_APERTURES, aperture diameters in pixels
+        m = re.search('^PHOT_APERTURES',l)
+        if m != None:
+            aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
+            aper_pix = aper_world / meta["pixscale"]
+            lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"
+        # Filter name
+        m = re.search('^FILTER_NAME',l)
+        if m != None:
+            filter_name = (l.split())[1]
+        cnt = cnt+1
+
+    # Add newlines
+    lines = [line + '\n' for line in lines]
+    # Write out the new config file
+    if os.path.exists("default.config"):
+        os.remove("default.config")
+    fo = open('default.config', 'w')
+    fo.writelines(lines)
+    fo.close()
+
+    return filter_name
+
+
+def oldfinalcat(sexcat,als,apcorr,wcs,meta,outfile,both=True):
+    """ The column-by-column merge of Chip.finalcat() from before mergecat,
+        for the SE detection list.  The old writer appended the table to a
+        file opened read-only, here the table is written in extension 1 the
+        way it was meant to be."""
+
+    als = Table(als)
+    nals = len(als)
+    als['MAG'] -= apcorr
+
+    # Just add columns to the SE catalog
+    ncat = len(sexcat)
+    newcat = sexcat.copy()
+    alsnames = ['X','Y','MAG','ERR','SKY','ITER','CHI','SHARP']
+    newnames = ['XPSF','YPSF','MAGPSF','ERRPSF','SKY','ITER',
+                'CHI','SHARP','RAPSF','DECPSF']
+    newtypes = ['float64','float64','float','float','float','float',
+                'float','float','float64','float64']
+    nan = float('nan')
+    newvals = [nan, nan, nan, nan ,nan, nan, nan, nan, nan, nan]
+    newcols = []
+    for n,t,v in zip(newnames,newtypes,newvals):
+        col = Column(name=n,length=ncat,dtype=t)
+        col[:] = v
+        newcols.append(col)
+    newcat.add_columns(newcols)
+    # Match up with IDs
+    mid, ind1, ind2 = np.intersect1d(newcat["NUMBER"],als["ID"],return_indices=True)
+    for id1,id2 in zip(newnames,alsnames):
+        newcat[id1][ind1] = als[id2][ind2]
+    # Only keep sources that have SE+ALLSTAR information
+    #  trim out ones that don't have ALS
+    if (both is True) & (nals<ncat):
+        newcat = newcat[ind1]
+
+    # Add RA, DEC
+    r,d = wcs.all_pix2world(newcat["XPSF"],newcat["YPSF"],1)
+    newcat['RAPSF'] = r
+    newcat['DECPSF'] = d
+
+    # Write to file, meta in PDU header and the table in extension 1
+    hdulist = fits.HDUList([fits.PrimaryHDU(header=meta),fits.table_to_hdu(newcat)])
+    hdulist.writeto(outfile,overwrite=True)
+
+    return newcat
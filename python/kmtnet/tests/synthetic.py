@@ -0,0 +1,230 @@
+"""
+Synthetic catalogs and images for the tests and benchmarks.
+"""
+
+import numpy as np
+
+DAOHEADER = " NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n"
+
+# Line formats of the DAOPHOT files
+DAOFORMATS = {'coo':"%7d%9.2f%9.2f%9.3f%9.3f%9.3f%9.3f\n",
+              'lst':"%7d%9.3f%9.3f%9.3f%9.3f%9.3f\n",
+              'lstnosky':"%7d%9.3f%9.3f%9.3f%9.3f\n",
+              'als':"%7d%9.3f%9.3f%9.3f%9.4f%9.3f%8.0f.%9.3f%9.3f\n",
+              'tot':"%7d%9.3f%9.3f%9.4f%9.4f%9.3f%9.3f%9.4f%9d\n"}
+DAONL = {'coo':1,'lst':3,'lstnosky':3,'als':1,'tot':1,'ap':2}
+
+
+def daocat(nstars,seed=0,nx=2048,ny=4096):
+    """ Random star catalog with the columns of the DAOPHOT files."""
+    rng = np.random.default_rng(seed)
+    cat = {}
+    cat['ID'] = np.arange(nstars)+1
+    cat['X'] = rng.uniform(1,nx,nstars)
+    cat['Y'] = rng.uniform(1,ny,nstars)
+    cat['MAG'] = rng.uniform(10,22,nstars)
+    cat['ERR'] = rng.uniform(0.001,0.5,nstars)
+    cat['SKY'] = rng.normal(1600,50,nstars)
+    cat['SHARP'] = rng.normal(0,0.5,nstars)
+    cat['ROUND'] = rng.normal(0,0.5,nstars)
+    cat['ROUND2'] = rng.normal(0,0.5,nstars)
+    cat['ITER'] = rng.integers(2,50,nstars)
+    cat['CHI'] = rng.uniform(0.5,3,nstars)
+    cat['MAGFAP'] = cat['MAG']+rng.normal(0,0.05,nstars)
+    cat['APCORR'] = rng.normal(-0.07,0.01,nstars)
+    cat['FINALAP'] = rng.integers(1,13,nstars)
+    return cat
+
+
+def writedaofile(filename,kind,nstars,seed=0,naper=6):
+    """
+    Write a synthetic DAOPHOT file of one kind: coo, lst, lstnosky (an .lst
+    without the SKY column), als, tot or ap.  Returns the input catalog.
+    """
+    cat = daocat(nstars,seed)
+    rng = np.random.default_rng(seed+1)
+    with open(filename,'w') as f:
+        f.write(DAOHEADER)
+        f.write("%3d  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n" % DAONL[kind])
+        f.write("\n")
+        if kind=='coo':
+            cols = ['ID','X','Y','MAG','SHARP','ROUND','ROUND2']
+        elif kind=='lst':
+            cols = ['ID','X','Y','MAG','ERR','SKY']
+        elif kind=='lstnosky':
+            cols = ['ID','X','Y','MAG','ERR']
+        elif kind=='als':
+            cols = ['ID','X','Y','MAG','ERR','SKY','ITER','CHI','SHARP']
+        elif kind=='tot':
+            cols = ['ID','X','Y','MAG','ERR','SKY','MAGFAP','APCORR','FINALAP']
+        if kind=='ap':
+            mag = cat['MAG'][:,None]-np.linspace(0,0.5,naper)[None,:]
+            err = rng.uniform(0.001,0.5,(nstars,naper))
+            # Some stars have no good photometry
+            bad = rng.random((nstars,naper))<0.05
+            mag[bad] = 99.999
+            err[bad] = 9.9999
+            skysig = rng.uniform(5,60,nstars)
+            skyskew = rng.uniform(-2,2,nstars)
+            writeaprows(f,cat['ID'],cat['X'],cat['Y'],mag,cat['SKY'],skysig,skyskew,err)
+        else:
+            fmt = DAOFORMATS[kind]
+            for i in range(nstars):
+                f.write(fmt % tuple([cat[c][i] for c in cols]))
+    return cat
+
+
+def writeaprows(f,ids,x,y,mag,sky,skysig,skyskew,err):
+    """ Write the two-line .ap rows of the stars to an open file."""
+    naper = mag.shape[1]
+    fmt = "\n%7d%9.3f%9.3f"+naper*"%9.3f"+"\n%14.3f%6.2f%6.2f%8.4f"+(naper-1)*"%9.4f"+"\n"
+    for i in range(len(ids)):
+        f.write(fmt % tuple([ids[i],x[i],y[i]]+mag[i].tolist()+[sky[i],skysig[i],skyskew[i]]+err[i].tolist()))
+
+
+def randmask(shape,nmask,seed=0,dtype=np.int16):
+    """ Mask image with random masked pixels, including some on the edges."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape,dtype)
+    y = rng.integers(0,shape[0],nmask)
+    x = rng.integers(0,shape[1],nmask)
+    mask[y,x] = rng.integers(1,5,nmask)
+    # Masked pixels on the edges and corners
+    mask[0,shape[1]//2] = 1
+    mask[shape[0]//3,-1] = 2
+    mask[-1,-1] = 1
+    mask[0,0] = 4
+    return mask
+
+
+def sexcat(nstars,seed=0,nx=2048,ny=4096):
+    """ Synthetic SExtractor catalog with the dtypes of the FITS_LDAC catalogs."""
+    from astropy.table import Table
+    rng = np.random.default_rng(seed)
+    cat = Table()
+    cat['NUMBER'] = np.arange(nstars,dtype=np.int32)+1
+    cat['X_IMAGE'] = rng.uniform(0.5,nx+0.5,nstars)
+    cat['Y_IMAGE'] = rng.uniform(0.5,ny+0.5,nstars)
+    cat['MAG_AUTO'] = rng.uniform(-15,-2,nstars).astype(np.float32)
+    cat['MAGERR_AUTO'] = rng.uniform(0.0,0.5,nstars).astype(np.float32)
+    # Failed measurements
+    bad = rng.random(nstars)<0.02
+    cat['MAG_AUTO'][bad] = 99.0
+    cat['MAGERR_AUTO'][bad] = 99.0
+    return cat
+
+
+def gaussstamp(x,y,flux,sigma,nx,ny,half):
+    """ Pixel-integrated Gaussian star, DAOPHOT (1-based) coordinates."""
+    from scipy.special import erf
+    ix = int(np.round(x))-1
+    iy = int(np.round(y))-1
+    x0,x1 = np.maximum(ix-half,0),np.minimum(ix+half+1,nx)
+    y0,y1 = np.maximum(iy-half,0),np.minimum(iy+half+1,ny)
+    # Pixel i covers i+0.5 to i+1.5
+    xe = np.arange(x0,x1+1)+0.5
+    ye = np.arange(y0,y1+1)+0.5
+    fx = np.diff(0.5*erf((xe-x)/(np.sqrt(2)*sigma)))
+    fy = np.diff(0.5*erf((ye-y)/(np.sqrt(2)*sigma)))
+    return (slice(y0,y1),slice(x0,x1)),flux*fy[:,None]*fx[None,:]
+
+
+def starfield(base,nstars=100,seed=0,nx=400,ny=400,fwhm=4.0,sky=1000.0,gain=2.0,rdnoise=5.0,
+              saturate=60000.0,magrange=(12.0,18.0),noise=True,spacing=None,nblend=0):
+    """
+    Write a synthetic star field for the aperture photometry tests: base.fits
+    (float32), base.coo with the true positions, and the base.opt/.als.opt
+    option files.  The stars are Gaussians on a jittered grid, so they are
+    isolated, except for `nblend` of them that get a neighbor 6-12 pixels
+    away that is not in the .coo file.  Returns the table of true positions
+    and magnitudes (zero point of 25, as in DAOPHOT).
+    """
+    from astropy.io import fits
+    from astropy.table import Table
+    from kmtnet import phot
+    rng = np.random.default_rng(seed)
+    sigma = fwhm/2.35482
+    if spacing is None:
+        spacing = int(np.floor(np.sqrt((nx-60)*(ny-60)/nstars)))
+    gx,gy = np.meshgrid(np.arange(30+spacing/2,nx-30,spacing),np.arange(30+spacing/2,ny-30,spacing))
+    gx,gy = gx.ravel()[0:nstars],gy.ravel()[0:nstars]
+    nstars = len(gx)
+    cat = Table()
+    cat['ID'] = np.arange(nstars)+1
+    # Rounded like in the .coo file
+    cat['X'] = np.round(gx+rng.uniform(-0.5,0.5,nstars),2)
+    cat['Y'] = np.round(gy+rng.uniform(-0.5,0.5,nstars),2)
+    cat['MAG'] = rng.uniform(magrange[0],magrange[1],nstars)
+    cat['FLUX'] = 10**(-0.4*(cat['MAG']-25.0))
+    cat['BLEND'] = np.zeros(nstars,bool)
+    if nblend>0:
+        cat['BLEND'][rng.choice(nstars,nblend,replace=False)] = True
+    im = np.zeros((ny,nx))
+    half = int(np.ceil(8*sigma))
+    for i in range(nstars):
+        sl,stamp = gaussstamp(cat['X'][i],cat['Y'][i],cat['FLUX'][i],sigma,nx,ny,half)
+        im[sl] += stamp
+        if cat['BLEND'][i]:
+            ang,dist = rng.uniform(0,2*np.pi),rng.uniform(6.0,12.0)
+            sl,stamp = gaussstamp(cat['X'][i]+dist*np.cos(ang),cat['Y'][i]+dist*np.sin(ang),
+                                  cat['FLUX'][i]*rng.uniform(0.3,2.0),sigma,nx,ny,half)
+            im[sl] += stamp
+    im += sky
+    if noise:
+        im = rng.poisson(im*gain)/gain+rng.normal(0,rdnoise,im.shape)
+    fits.writeto(base+'.fits',im.astype(np.float32),overwrite=True)
+    # Coordinate file, the header has the good data range and the gain
+    with open(base+'.coo','w') as f:
+        f.write(DAOHEADER)
+        f.write("%3d%6d%6d%8.1f%8.1f%8.2f%8.2f%8.2f%8.2f%8.2f\n" % (1,nx,ny,7.0,saturate,20.0,0.0,gain,rdnoise,fwhm))
+        f.write("\n")
+        for i in range(nstars):
+            f.write(DAOFORMATS['coo'] % (cat['ID'][i],cat['X'][i],cat['Y'][i],0.0,0.6,0.0,0.0))
+    meta = fits.Header()
+    meta['GAIN'] = gain
+    meta['RDNOISE'] = rdnoise
+    meta['FWHM'] = fwhm
+    meta['PIXSCALE'] = 1.0
+    meta['SATURATE'] = saturate
+    phot.mkopt(base,meta,logger=phot.basiclogger('phot'))
+    return cat
+
+
+GROWAPERTURES = [3.0,4.5,6.0,8.0,10.0,13.0,16.0,40.0,50.0]
+
+
+def growfixture(base,nstars=200,seed=11,nblend=25):
+    """
+    Aperture photometry of a noisy star field with blended stars for the
+    growth curve tests: base.ap, base.apers and base.truth (ID, MAG and
+    BLEND of the true stars).  The files in tests/data were made with
+    growfixture('grow') in that directory, the image is removed.
+    """
+    import os
+    from kmtnet import phot
+    cat = starfield(base,nstars,nx=700,ny=700,seed=seed,magrange=(13.0,18.0),nblend=nblend)
+    phot.aperphot(base+'.fits',base+'.coo',apertures=GROWAPERTURES)
+    cat['ID','MAG','BLEND'].write(base+'.truth',format='ascii.fixed_width_two_line',
+                                  formats={'MAG':'%.4f'},overwrite=True)
+    for ext in ['.fits','.coo','.opt','.als.opt','.ap.log','.ap.npz']:
+        if os.path.exists(base+ext): os.remove(base+ext)
+    return cat
+
+
+def starchip(base,nstars=400,nx=2048,ny=2048,fwhm=4.0,pixscale=0.4,seed=0):
+    """
+    Synthetic star field (see starfield) as a chip image and header for
+    kmtnet.Chip.  Returns the image, the header and the table of the stars.
+    """
+    from astropy.io import fits
+    cat = starfield(base,nstars,seed=seed,nx=nx,ny=ny,fwhm=fwhm)
+    im = fits.getdata(base+'.fits').astype(float)
+    head = fits.Header()
+    head['GAIN'] = 2.0
+    head['RDNOISE'] = 5.0
+    head['PIXSCALE'] = pixscale
+    head['SATURATE'] = 60000.0
+    head['CCDNUM'] = 1
+    head['EXPTIME'] = 60.0
+    head['DATE-OBS'] = '2020-01-01T00:00:00'
+    return im,head,cat
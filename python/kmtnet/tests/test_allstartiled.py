@@ -0,0 +1,109 @@
+import os
+import sys
+import numpy as np
+import pytest
+from astropy.io import fits
+from kmtnet import phot
+from kmtnet.tests.synthetic import DAOHEADER,DAOFORMATS,writeaprows
+
+# A fake allstar: the .als has the input positions and the "subtracted"
+# image is half the image minus one at the pixel of every star.  It fails
+# in the tile directories if the FAILTILE file is there.
+FAKEALLSTAR = '''#!{python}
+import os, sys
+import numpy as np
+from astropy.io import fits
+names = [l.strip() for l in sys.stdin if l.strip().endswith(('.fits','.psf','.ap','.als'))]
+imfile,psffile,apfile,alsfile,subfile = names[0:5]
+if os.path.basename(os.getcwd()).startswith('tile') and os.path.exists({failfile!r}):
+    sys.exit(1)
+lines = open(apfile).read().split('\\n')
+im,head = fits.getdata(imfile,header=True)
+sub = im*0.5
+out = open(alsfile,'w')
+out.write(lines[0]+'\\n'+' 1'+lines[1][3:]+'\\n\\n')
+for k in range(4,len(lines),3):
+    if lines[k].strip()=='': continue
+    num,x,y,mag = int(lines[k][0:7]),float(lines[k][7:16]),float(lines[k][16:25]),float(lines[k][25:34])
+    sub[int(np.floor(y+0.5))-1,int(np.floor(x+0.5))-1] -= 1.0
+    out.write("{fmt}" % (num,x,y,mag,0.01,1000.0,4,1.0,0.0))
+out.close()
+fits.writeto(subfile,sub,head,overwrite=True)
+print(' Finished.')
+'''
+
+
+@pytest.fixture
+def field(tmp_path):
+    """ Random image, .ap, .psf and .als.opt in tmp_path, and the fake allstar."""
+    rng = np.random.default_rng(3)
+    nx,ny,nstars = 200,150,300
+    im = rng.normal(1000,10,(ny,nx)).astype(np.float32)
+    fits.writeto(tmp_path/'im.fits',im)
+    x = rng.uniform(1,nx,nstars)
+    y = rng.uniform(1,ny,nstars)
+    # Some on the tile boundaries, DAOPHOT coordinates are 1-based
+    x[0:10] = 101.0
+    y[10:20] = 76.0
+    mag = np.zeros((nstars,3))+rng.uniform(12,18,nstars)[:,None]
+    with open(tmp_path/'im.ap','w') as f:
+        f.write(DAOHEADER)
+        f.write("  2  %4d  %4d  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n" % (nx,ny))
+        writeaprows(f,np.arange(nstars)+1,x,y,mag,np.zeros(nstars)+1000.0,np.zeros(nstars)+10.0,
+                    np.zeros(nstars),np.zeros((nstars,3))+0.01)
+    (tmp_path/'im.psf').write_text("PENNY1      51    4    6    0   12.000   30000.000   100.0   100.0\n")
+    (tmp_path/'im.als.opt').write_text("WA = -2\nFI = 4.0\nIS = 10.0\nOS = 20.0\n")
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    fmt = DAOFORMATS['als'].replace('\n','\\n')
+    (bindir/'allstar').write_text(FAKEALLSTAR.format(python=sys.executable,fmt=fmt,
+                                                     failfile=str(tmp_path/'FAILTILE')))
+    (bindir/'allstar').chmod(0o755)
+    return {'dir':tmp_path,'bindir':str(bindir)+'/','im':im,'x':x,'y':y,'nstars':nstars}
+
+
+def expected(field):
+    sub = field['im']*0.5
+    for x,y in zip(field['x'],field['y']):
+        sub[int(np.floor(float('%.3f' % y)+0.5))-1,int(np.floor(float('%.3f' % x)+0.5))-1] -= 1.0
+    return sub
+
+
+def runallstar(field,**kwargs):
+    curdir = os.getcwd()
+    os.chdir(field['dir'])
+    try:
+        cat = phot.allstar('im.fits','im.psf',bindir=field['bindir'],**kwargs)
+        sub = fits.getdata('ims.fits')
+    finally:
+        os.chdir(curdir)
+    return cat,sub
+
+
+@pytest.mark.parametrize("ntiles",[2,3])
+def test_allstar_tiled(field,ntiles):
+    cat,sub = runallstar(field,ntiles=ntiles,margin=12)
+    # Every star once, at its position on the whole image
+    assert len(cat)==field['nstars']
+    assert len(np.unique(cat['ID']))==len(cat)
+    cat.sort('ID')
+    assert np.allclose(cat['X'],field['x'],atol=6e-4)
+    assert np.allclose(cat['Y'],field['y'],atol=6e-4)
+    # The cores of the subtracted tiles are pasted back in the right place
+    assert sub.shape==field['im'].shape
+    assert np.allclose(sub,expected(field))
+    assert os.path.exists(field['dir']/'im_alstiles')==False
+    # Same as one ALLSTAR run
+    cat1,sub1 = runallstar(field,ntiles=1)
+    assert np.array_equal(sub,sub1)
+    cat1.sort('ID')
+    assert np.array_equal(np.asarray(cat['X']),np.asarray(cat1['X']))
+
+
+def test_allstar_tiled_failed(field):
+    # ALLSTAR fails on the tiles, so it is run on the whole image instead
+    (field['dir']/'FAILTILE').write_text('')
+    cat,sub = runallstar(field,ntiles=2,margin=12)
+    assert len(cat)==field['nstars']
+    assert len(np.unique(cat['ID']))==len(cat)
+    assert np.allclose(sub,expected(field))
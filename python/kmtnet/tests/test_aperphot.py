@@ -0,0 +1,168 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from astropy.io import fits
+from kmtnet import phot
+from kmtnet.tests.legacy import olddaoread
+from kmtnet.tests.synthetic import starfield
+
+APERTURES = [3.0,5.0,8.0,12.0,15.0,20.0,25.0]
+FWHM = 4.0
+
+
+def truemag(cat,r,fwhm=FWHM):
+    """ Magnitude of the Gaussian stars in an aperture of radius r."""
+    sigma = fwhm/2.35482
+    return np.array(cat['MAG'])-2.5*np.log10(1-np.exp(-r**2/(2*sigma**2)))
+
+
+@pytest.fixture(scope='module')
+def field(tmp_path_factory):
+    """ Noise-free and noisy fields and their aperture photometry."""
+    wdir = tmp_path_factory.mktemp('aperphot')
+    curdir = os.getcwd()
+    os.chdir(wdir)
+    out = {'dir':str(wdir)}
+    try:
+        out['cat'] = starfield('clean',100,noise=False,seed=1)
+        out['ap'],out['maglim'] = phot.aperphot('clean.fits','clean.coo',apertures=APERTURES)
+        out['ncat'] = starfield('noisy',400,nx=800,ny=800,noise=True,seed=3)
+        out['nap'],out['nmaglim'] = phot.aperphot('noisy.fits','noisy.coo',apertures=APERTURES)
+    finally:
+        os.chdir(curdir)
+    return out
+
+
+def test_circoverlap():
+    # The pixel areas add up to the circle area
+    for r,xc,yc in [(3.0,0.0,0.0),(5.3,0.27,-0.41),(0.7,0.5,0.5),(12.0,0.1,0.9)]:
+        e = np.arange(-15,16)+0.5
+        g = phot.circoverlap((e-xc)[None,:],(e-yc)[:,None],r)
+        w = g[1:,1:]-g[:-1,1:]-g[1:,:-1]+g[:-1,:-1]
+        assert np.sum(w)==pytest.approx(np.pi*r**2,rel=1e-10)
+        assert np.all(w>=-1e-12) and np.all(w<=1+1e-12)
+        # Against a supersampled pixel grid
+        sub = (np.arange(200)+0.5)/200
+        px,py = 15+int(np.floor(xc+r*0.7)),15+int(np.floor(yc))
+        xs = e[px]+sub[None,:]-xc
+        ys = e[py]+sub[:,None]-yc
+        frac = np.mean(xs**2+ys**2<=r**2)
+        assert w[py,px]==pytest.approx(frac,abs=2e-3)
+
+
+def test_skymmm():
+    rng = np.random.default_rng(7)
+    sky = rng.normal(1000,10,(50,2000))
+    # Contaminated by stars
+    sky[:,0:200] += rng.exponential(300,(50,200))
+    skymod,sigma,skew,nsky = phot.skymmm(sky)
+    assert np.all(np.abs(skymod-1000)<2.0)
+    assert np.all(np.abs(sigma-10)<1.5)
+    # Too few sky values, and NaNs are not used
+    short = np.zeros((2,30))+np.nan
+    short[0,0:10] = 1000.0
+    short[1,:] = 1000.0+rng.normal(0,5,30)
+    skymod,sigma,skew,nsky = phot.skymmm(short,minsky=20)
+    assert sigma[0]==-1 and nsky[0]==0
+    assert sigma[1]>0 and nsky[1]>20
+
+
+def test_aperphot_truth(field):
+    cat,ap = field['cat'],field['ap']
+    assert np.array_equal(ap['ID'],cat['ID'])
+    assert np.all(ap['SKY']==pytest.approx(1000.0))
+    for i,r in enumerate(APERTURES[0:-2]):
+        diff = ap['MAG'][:,i]-truemag(cat,r)
+        if r>=2*FWHM:
+            assert np.max(np.abs(diff))<0.002
+        else:
+            # The light is not uniform inside the pixels on the edge of a small
+            #  aperture, the flux inside the circle is underestimated
+            assert np.all(diff>=0) and np.max(diff)<0.03
+
+
+def test_aperphot_noise(field):
+    cat,ap = field['ncat'],field['nap']
+    assert np.abs(np.median(ap['SKY'])-1000)<1.5
+    # Poisson sky of 1000 ADU with gain 2 and 5 ADU readnoise
+    assert np.median(ap['SKYSIG'])==pytest.approx(np.sqrt(1000/2.0+25),rel=0.05)
+    for i in [1,2]:
+        diff = ap['MAG'][:,i]-truemag(cat,APERTURES[i])
+        gd = (ap['ERR'][:,i]<0.1)
+        assert np.sum(gd)>200
+        assert np.abs(np.median(diff[gd]))<0.005
+        # The errors describe the scatter
+        z = diff[gd]/ap['ERR'][gd,i]
+        assert 0.8 < 1.4826*np.median(np.abs(z-np.median(z))) < 1.35
+    # Magnitude limit of the S/N~5 stars
+    assert field['nmaglim'] is not None
+    sn5 = (ap['ERR'][:,0]>=0.15) & (ap['ERR'][:,0]<=0.25)
+    assert field['nmaglim']==pytest.approx(np.median(ap['MAG'][sn5,0]),abs=1e-3)
+
+
+def test_aperphot_format(field):
+    for name,ap in [('clean',field['ap']),('noisy',field['nap'])]:
+        apfile = os.path.join(field['dir'],name+'.ap')
+        lines = open(apfile).read().split('\n')
+        coolines = open(os.path.join(field['dir'],name+'.coo')).read().split('\n')
+        assert lines[0]==coolines[0]
+        assert int(lines[1][0:3])==2
+        assert float(lines[1].split()[6])==APERTURES[0]
+        assert len(lines)==3+3*len(ap)+1
+        assert len(lines[4])==7+9*2+9*5 and len(lines[5])==14+6+6+8+9*4
+        # The .ap file reads back the same with the new and the old reader
+        for cat in [phot.daoread(apfile),olddaoread(apfile)]:
+            assert cat.colnames==ap.colnames
+            for c in ap.colnames:
+                assert np.array_equal(np.asarray(cat[c]),np.asarray(ap[c]))
+        assert ap['MAG'].shape==(len(ap),5)
+    apers = open(os.path.join(field['dir'],'clean.apers')).read().split('\n')
+    assert apers[0]=='A1 =  3.0000' and apers[5]=='IS = 20.0000'
+
+
+def test_aperphot_badpixels(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cat = starfield('bad',16,noise=False,seed=2)
+    im,head = fits.getdata('bad.fits',header=True)
+    # A saturated pixel 4 pixels from star 1, and star 2 moved to the edge
+    ix,iy = int(np.round(cat['X'][0]))-1,int(np.round(cat['Y'][0]))-1
+    im[iy,ix+4] = 70000.0
+    fits.writeto('bad.fits',im,head,overwrite=True)
+    lines = open('bad.coo').read().split('\n')
+    lines[4] = lines[4][0:7]+"%9.2f%9.2f" % (3.0,cat['Y'][1])+lines[4][25:]
+    open('bad.coo','w').write('\n'.join(lines))
+    ap,maglim = phot.aperphot('bad.fits','bad.coo',apertures=APERTURES)
+    assert ap['MAG'][0,0]<90
+    assert np.all(ap['MAG'][0,1:]==99.999) and np.all(ap['ERR'][0,1:]==9.9999)
+    assert np.all(ap['MAG'][1,:]==99.999)
+    assert np.all(ap['MAG'][2:,:]<90)
+
+
+def test_aperphot_workers(field,tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for ext in ['fits','coo','opt']:
+        shutil.copy(os.path.join(field['dir'],'noisy.'+ext),'noisy.'+ext)
+    phot.aperphot('noisy.fits','noisy.coo',apertures=APERTURES,nworkers=3,batchsize=37)
+    assert open('noisy.ap').read()==open(os.path.join(field['dir'],'noisy.ap')).read()
+
+
+@pytest.mark.skipif(shutil.which('daophot') is None,reason='daophot is not installed')
+def test_aperphot_daophot(field,tmp_path,monkeypatch):
+    # The same fields with DAOPHOT PHOTOMETRY.  It uses an approximation for
+    #  the partial pixels, not the exact overlap.
+    monkeypatch.chdir(tmp_path)
+    for name,cat,ap in [('clean',field['cat'],field['ap']),('noisy',field['ncat'],field['nap'])]:
+        for ext in ['fits','coo','opt']:
+            shutil.copy(os.path.join(field['dir'],name+'.'+ext),name+'.'+ext)
+        dao,maglim = phot.daoaperphot(name+'.fits',name+'.coo',apertures=APERTURES)
+        assert np.array_equal(dao['ID'],ap['ID'])
+        gd = (dao['ERR'][:,0]<0.02) & (ap['ERR'][:,0]<0.02)
+        assert np.sum(gd)>10
+        assert np.abs(np.median(dao['SKY'][gd]-ap['SKY'][gd]))<0.5
+        for i,r in enumerate(APERTURES[0:-2]):
+            diff = ap['MAG'][gd,i]-dao['MAG'][gd,i]
+            if r>=2*FWHM:
+                assert np.abs(np.median(diff))<0.003
+            else:
+                assert np.abs(np.median(diff))<0.03
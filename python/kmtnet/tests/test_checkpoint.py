@@ -0,0 +1,205 @@
+import os
+import json
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from kmtnet import checkpoint
+
+
+class Interrupted(Exception):
+    pass
+
+
+class StubChip:
+    """ The parts of Chip that the checkpoints use, with stages that only
+        write small working files."""
+
+    def __init__(self,directory,stop=None):
+        self.dir = str(directory)
+        self.meta = fits.Header()
+        self.meta['EXPTIME'] = 60.0
+        self.sexcat = None
+        self.sexcatfile = None
+        self.sexiter = 1
+        self.sexiterdone = False
+        self.subiter = None
+        self.apcorr = None
+        self.seeing = None
+        self._fwhm = None
+        self._sexmaglim = None
+        self._daomaglim = None
+        self._nsn5first = None
+        self.checkpoint = None
+        self.stop = stop        # [name,iter] of the stage to fail in
+        self.ran = []
+
+    # Same as Chip.runstage() without the timer
+    def runstage(self,name,func,*args,**kwargs):
+        if self.checkpoint is not None and self.checkpoint.done(name,self.sexiter):
+            return
+        func(*args,**kwargs)
+        if self.checkpoint is not None:
+            self.checkpoint.save(self,name)
+
+    def _run(self,name):
+        if self.stop==[name,self.sexiter]:
+            raise Interrupted(name)
+        self.ran.append([name,self.sexiter])
+
+    def seedfwhm(self):
+        self._run('seedfwhm')
+        self._fwhm = 1.6
+        self.meta['FWHM'] = 1.6
+
+    def runsex(self):
+        self._run('runsex')
+        cat = Table({'NUMBER':np.arange(10*self.sexiter)+1,
+                     'NDET_ITER':np.zeros(10*self.sexiter,int)+self.sexiter})
+        self.sexcat = cat
+        self.sexcatfile = 'flux_sex.cat'
+        cat.write(os.path.join(self.dir,'flux_sex.cat'),format='ascii',overwrite=True)
+        self._sexmaglim = 20.0+self.sexiter
+        if self.sexiter==1:
+            self._nsn5first = 8
+
+    def allstar(self):
+        self._run('allstar')
+        with open(os.path.join(self.dir,'flux%d.als' % self.sexiter),'w') as f:
+            f.write('als %d\n' % self.sexiter)
+        self.meta['ALSITER'] = self.sexiter
+
+    def getapcor(self):
+        self._run('getapcor')
+        self.apcorr = -0.05
+
+    def process(self):
+        if self.checkpoint is not None and len(self.checkpoint.stages)>0:
+            self.checkpoint.restore(self)
+        while self.sexiterdone==False:
+            self.runstage('runsex',self.runsex)
+            self.runstage('allstar',self.allstar)
+            if self.sexiter==3:
+                self.sexiterdone = True
+            self.sexiter += 1
+            if self.checkpoint is not None:
+                self.checkpoint.save(self,'iteration',self.sexiter-1)
+        self.runstage('getapcor',self.getapcor)
+
+
+def runchip(directory,stop=None,resume=False):
+    """ Run the stub chip like Exposure.loadchip() and Chip.process() do."""
+    chip = StubChip(directory,stop=stop)
+    ckpt = checkpoint.ChipCheckpoint(os.path.join(str(directory),'chip.ckpt.json'),directory)
+    if resume and ckpt.load():
+        if len(ckpt.verify())>0:
+            ckpt.reset()
+    chip.checkpoint = ckpt
+    chip.runstage('seedfwhm',chip.seedfwhm)
+    chip.process()
+    return chip
+
+
+ALLSTAGES = [['seedfwhm',1],['runsex',1],['allstar',1],['iteration',1],
+             ['runsex',2],['allstar',2],['iteration',2],
+             ['runsex',3],['allstar',3],['iteration',3],['getapcor',4]]
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    # Stops in the second iteration, after its SExtractor run
+    with pytest.raises(Interrupted):
+        runchip(tmp_path,stop=['allstar',2])
+    ckpt = checkpoint.ChipCheckpoint(tmp_path/'chip.ckpt.json',tmp_path)
+    assert ckpt.load()
+    assert ckpt.stages==ALLSTAGES[0:5]
+    assert ckpt.verify()==[]
+    assert ckpt.complete==False
+    assert sorted(ckpt.files)==sorted([str(tmp_path/f) for f in ['flux1.als','flux_sex.cat',checkpoint.SEXCATFILE]])
+    # The state is put back
+    chip = StubChip(tmp_path)
+    ckpt.restore(chip)
+    assert chip.sexiter==2 and chip.sexiterdone==False
+    assert chip._fwhm==1.6 and chip._sexmaglim==22.0 and chip._nsn5first==8
+    assert chip.sexcatfile=='flux_sex.cat'
+    assert chip.meta['FWHM']==1.6 and chip.meta['ALSITER']==1
+    assert len(chip.sexcat)==20 and np.all(chip.sexcat['NDET_ITER']==2)
+
+
+def test_checkpoint_resume(tmp_path):
+    with pytest.raises(Interrupted):
+        runchip(tmp_path,stop=['allstar',2])
+    # Only the remaining stages are run, not the FWHM seed or SExtractor again
+    chip = runchip(tmp_path,resume=True)
+    assert chip.ran==[['allstar',2],['runsex',3],['allstar',3],['getapcor',4]]
+    assert chip.sexiter==4 and chip.apcorr==-0.05 and chip.meta['ALSITER']==3
+    # Same as a run that was not interrupted
+    (tmp_path/'full').mkdir()
+    full = runchip(tmp_path/'full')
+    ckpt = checkpoint.ChipCheckpoint(tmp_path/'chip.ckpt.json',tmp_path)
+    ckpt.load()
+    assert ckpt.stages==ALLSTAGES
+    assert full.checkpoint.stages==ALLSTAGES
+    assert full.ran==ALLSTAGES[0:3]+ALLSTAGES[4:6]+ALLSTAGES[7:9]+ALLSTAGES[10:]
+
+
+def test_checkpoint_corrupted(tmp_path):
+    with pytest.raises(Interrupted):
+        runchip(tmp_path,stop=['runsex',3])
+    ckpt = checkpoint.ChipCheckpoint(tmp_path/'chip.ckpt.json',tmp_path)
+    assert ckpt.load() and ckpt.verify()==[]
+    # Changed, same size and a new modification time
+    alsfile = tmp_path/'flux2.als'
+    alsfile.write_text('als 9\n')
+    st = os.stat(alsfile)
+    os.utime(alsfile,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    assert ckpt.verify()==[str(alsfile)]
+    # Touched but not changed is fine
+    alsfile.write_text('als 2\n')
+    assert ckpt.verify()==[]
+    # Missing
+    os.remove(tmp_path/'flux1.als')
+    assert ckpt.verify()==[str(tmp_path/'flux1.als')]
+    # So the chip is run from the start
+    chip = runchip(tmp_path,resume=True)
+    assert chip.ran==[s for s in ALLSTAGES if s[0]!='iteration']
+    # An unreadable manifest is not used
+    with open(tmp_path/'chip.ckpt.json','r+') as f:
+        f.truncate(os.path.getsize(tmp_path/'chip.ckpt.json')//2)
+    ckpt = checkpoint.ChipCheckpoint(tmp_path/'chip.ckpt.json',tmp_path)
+    assert ckpt.load()==False
+    assert ckpt.stages==[]
+    chip = runchip(tmp_path,resume=True)
+    assert chip.ran==[s for s in ALLSTAGES if s[0]!='iteration']
+
+
+def test_checkpoint_finish(tmp_path):
+    runchip(tmp_path)
+    ckpt = checkpoint.ChipCheckpoint(tmp_path/'chip.ckpt.json',tmp_path)
+    ckpt.load()
+    ckpt.finish([tmp_path/'flux3.als'])
+    man = json.load(open(tmp_path/'chip.ckpt.json'))
+    assert man['complete'] and man['stages'][-1]==['complete',0]
+    assert list(man['files'])==[str(tmp_path/'flux3.als')]
+    assert checkpoint.ChipCheckpoint(tmp_path/'chip.ckpt.json',tmp_path).load()
+
+
+def test_chip_runstage(tmp_path):
+    # The real Chip.runstage() skips the stages in the checkpoint
+    pytest.importorskip('prometheus')
+    from kmtnet import kmtnet
+    from kmtnet.tests.synthetic import starchip
+    curdir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        im,head,cat = starchip('chip',nstars=50,nx=256,ny=256)
+        chip = kmtnet.Chip('flux.fits','chip','localhost',data=im,header=head,fwhmmode='sex',seed=False)
+        chip.checkpoint = checkpoint.ChipCheckpoint('chip.ckpt.json','.')
+        ran = []
+        chip.runstage('a',ran.append,1)
+        chip.runstage('a',ran.append,2)
+        chip.sexiter = 2
+        chip.runstage('a',ran.append,3)
+    finally:
+        os.chdir(curdir)
+    assert ran==[1,3]
+    assert chip.checkpoint.stages==[['a',1],['a',2]]
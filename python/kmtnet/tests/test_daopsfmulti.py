@@ -0,0 +1,89 @@
+import os
+import sys
+import numpy as np
+import pytest
+from kmtnet import phot
+
+# A fake daophot for the PSF trials.  The chi of each analytic function
+#  (the AN option) is in CHIS, the PSF file has the options it was made
+#  with.  LORENTZ writes no PSF and MOFFAT35 does not converge.
+FAKEDAOPHOT = '''#!{python}
+import sys
+CHIS = {{1:0.0512,2:0.0433,3:0.0214,4:None,5:None,6:0.0251,7:0.0356}}
+opt = open('t.opt').read()
+an = int(float([l.split('=')[1] for l in opt.split('\\n') if l.split('=')[0].strip()=='AN'][0]))
+sys.stdin.read()
+if an==5:
+    sys.exit(0)
+print(" Command: PSF")
+print("")
+if CHIS[an] is None:
+    print(" Failed to converge.")
+    sys.exit(0)
+print("        Chi    Parameters...")
+print(">>   %.4f   1.79190   1.69498" % (CHIS[an]+0.01))
+print(">>   %.4f   1.66754   1.57059  -0.00304" % CHIS[an])
+print("")
+print(" Profile errors:")
+print("")
+print("   1044  %.3f      1039  0.010       304  0.013 *    1118  0.020       119  0.027" % CHIS[an])
+print("    610  0.012       580  0.013       373 saturated")
+print("")
+print(" File with PSF stars and neighbors = t.nei")
+open('t.psf','w').write("AN = %d\\n" % an+opt)
+open('t.nei','w').write("nei %d\\n" % an)
+'''
+
+OPTLINES = ["FW = 4.00","FI = 6.00","PS = 18.00","VA = 2","AN = -6","EX = 5","PE = 0.75"]
+
+
+@pytest.fixture
+def psfdir(tmp_path):
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    (bindir/'daophot').write_text(FAKEDAOPHOT.format(python=sys.executable))
+    (bindir/'daophot').chmod(0o755)
+    for f in ['im.fits','im.ap','im.lst']:
+        (tmp_path/f).write_text(f+'\n')
+    (tmp_path/'im.opt').write_text('\n'.join(OPTLINES)+'\n')
+    return tmp_path
+
+
+def runmulti(psfdir,**kwargs):
+    curdir = os.getcwd()
+    os.chdir(psfdir)
+    try:
+        out = phot.daopsf_multi('im.fits','im.lst',bindir=str(psfdir/'bin'),**kwargs)
+    finally:
+        os.chdir(curdir)
+    return out
+
+
+@pytest.mark.parametrize("nworkers",[None,2])
+def test_daopsf_multi_best(psfdir,nworkers):
+    pararr,parchi,profs = runmulti(psfdir,nworkers=nworkers)
+    # MOFFAT25 has the lowest chi
+    assert np.min(parchi)==pytest.approx(0.0214)
+    assert pararr[-1]==['0.0214','1.66754','1.57059','-0.00304']
+    assert len(profs)==8
+    assert profs['SIG'][0]==pytest.approx(0.021)
+    assert profs['FLAG'][2]=='*'
+    # Its PSF, neighbors and log are kept, with the options it was made with
+    psflines = (psfdir/'im.psf').read_text().splitlines()
+    assert psflines[0]=='AN = 3'
+    assert psflines[1:]==[l if l[0:2]!='AN' else 'AN =     3.00' for l in OPTLINES]
+    assert (psfdir/'im.nei').read_text()=='nei 3\n'
+    assert '0.0214' in (psfdir/'im.psf.log').read_text()
+    assert os.path.exists(psfdir/'im_psftrials')==False
+
+
+def test_daopsf_multi_subset(psfdir):
+    # Only the ones that do not work and one other
+    pararr,parchi,profs = runmulti(psfdir,ans=[4,5,7])
+    assert np.min(parchi)==pytest.approx(0.0356)
+    assert (psfdir/'im.psf').read_text().startswith('AN = 7\n')
+    # None of them work
+    out = runmulti(psfdir,ans=[4,5])
+    assert out==(None,None,None)
+    for f in ['im.psf','im.nei','im.psf.log','im_psftrials']:
+        assert os.path.exists(psfdir/f)==False
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pytest
+from kmtnet import phot
+from kmtnet.tests.legacy import olddaoread
+from kmtnet.tests.synthetic import writedaofile
+
+
+def sametable(cat1,cat2):
+    assert cat1.colnames==cat2.colnames
+    for c in cat1.colnames:
+        assert cat1[c].dtype==cat2[c].dtype
+        assert cat1[c].shape==cat2[c].shape
+        assert np.array_equal(np.asarray(cat1[c]),np.asarray(cat2[c]))
+
+
+@pytest.mark.parametrize("kind",['coo','lst','lstnosky','als','tot','ap'])
+def test_daoread_parity(kind,tmp_path):
+    fil = str(tmp_path / ("synth."+kind))
+    writedaofile(fil,kind,500,seed=3)
+    cat = phot.daoread(fil)
+    assert len(cat)==500
+    sametable(cat,olddaoread(fil))
+
+
+def test_daoread_values(tmp_path):
+    fil = str(tmp_path / "synth.als")
+    incat = writedaofile(fil,'als',100,seed=4)
+    cat = phot.daoread(fil)
+    assert np.array_equal(cat['ID'],incat['ID'])
+    assert np.allclose(cat['X'],incat['X'],atol=5e-4)
+    assert np.allclose(cat['ITER'],incat['ITER'])
+    # An .lst without SKY gets zeros
+    fil = str(tmp_path / "synth.lst")
+    writedaofile(fil,'lstnosky',100,seed=4)
+    cat = phot.daoread(fil)
+    assert np.all(cat['SKY']==0.0)
+    assert np.allclose(cat['MAG'],incat['MAG'],atol=5e-4)
+
+
+def test_daoread_cache(tmp_path):
+    fil = str(tmp_path / "synth.ap")
+    writedaofile(fil,'ap',200,seed=5)
+    cat1 = phot.daoread(fil,cache=True)
+    assert os.path.exists(fil+'.npz')
+    cat2 = phot.daoread(fil,cache=True)   # from the cache
+    sametable(cat1,cat2)
+    sametable(cat2,olddaoread(fil))
+
+
+def test_daoread_cache_invalidate(tmp_path):
+    fil = str(tmp_path / "synth.als")
+    writedaofile(fil,'als',200,seed=6)
+    cat1 = phot.daoread(fil,cache=True)
+    # Rewritten with a different size
+    writedaofile(fil,'als',150,seed=7)
+    cat2 = phot.daoread(fil,cache=True)
+    assert len(cat2)==150
+    sametable(cat2,olddaoread(fil))
+    # Same size, only the values and the modification time change
+    lines = open(fil).readlines()
+    lines[3] = lines[3][0:16]+'%9.3f' % 1.0+lines[3][25:]   # Y of the first star
+    with open(fil,'w') as f:
+        f.writelines(lines)
+    st = os.stat(fil)
+    os.utime(fil,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    assert os.stat(fil).st_size==st.st_size
+    cat3 = phot.daoread(fil,cache=True)
+    assert cat3['Y'][0]==pytest.approx(1.0)
+    sametable(cat3,olddaoread(fil))
+
+
+def test_daoread_cache_modified(tmp_path):
+    # Changing the returned table does not change what the cache returns
+    fil = str(tmp_path / "synth.tot")
+    writedaofile(fil,'tot',100,seed=8)
+    cat1 = phot.daoread(fil,cache=True)
+    cat1['MAG'] += 1.0
+    cat1['ID'][0] = -1
+    cat2 = phot.daoread(fil,cache=True)
+    sametable(cat2,olddaoread(fil))
+    cat2['X'][:] = 0.0
+    sametable(phot.daoread(fil,cache=True),olddaoread(fil))
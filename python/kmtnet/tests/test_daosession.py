@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import pytest
+from kmtnet import phot
+
+# A fake daophot that answers a few commands at the "Command:" prompt
+FAKEDAOPHOT = '''#!{python}
+import sys, time
+def out(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+out(" Fake DAOPHOT\\n\\n Command: ")
+for line in sys.stdin:
+    cmd = line.strip().upper()
+    if cmd=="EXIT":
+        break
+    elif cmd=="OK":
+        out(" Done.\\n\\n Command: ")
+    elif cmd=="SLOW":
+        # Quiet for a while in the middle of the output
+        out(" Working...\\n")
+        time.sleep(1.5)
+        out(" Done.\\n\\n Command: ")
+    elif cmd=="QUIET":
+        # Reads the answer and works without printing anything, like PHOTOMETRY
+        out(" File for output (default quiet.ap): ")
+        sys.stdin.readline()
+        time.sleep(1.5)
+        out("\\n Done.\\n\\n Command: ")
+    elif cmd=="OVERWRITE":
+        out(" This file already exists.  Overwrite it? ")
+    elif cmd=="FILE":
+        out(" Input file name: ")
+        name = sys.stdin.readline().strip()
+        while name!="exists.fits":
+            out(" File does not exist.\\n Input file name: ")
+            name = sys.stdin.readline()
+            if name=="":
+                sys.exit(0)
+            name = name.strip()
+        out(" Done.\\n\\n Command: ")
+    elif cmd=="DIE":
+        out(" Segmentation fault\\n")
+        sys.exit(1)
+    else:
+        out(" Unknown command.\\n\\n Command: ")
+'''
+
+
+@pytest.fixture
+def bindir(tmp_path):
+    daophot = tmp_path / "daophot"
+    daophot.write_text(FAKEDAOPHOT.format(python=sys.executable))
+    daophot.chmod(0o755)
+    return str(tmp_path)+"/"
+
+
+def test_session_commands(bindir,tmp_path):
+    logfile = str(tmp_path / "session.log")
+    with phot.DaophotSession(bindir=bindir,stall=0.5,timeout=30) as session:
+        out = session.command(["OK"],logfile)
+        assert "Done." in out
+        # Quiet output that does not end at a prompt is not a stall
+        out = session.command(["SLOW"],logfile)
+        assert "Done." in out
+        out = session.command(["FILE","exists.fits"],logfile)
+        assert "Done." in out
+        # Quiet after a prompt that was answered is not a stall either
+        out = session.command(["QUIET","quiet.ap"],logfile)
+        assert "Done." in out
+        assert session.ncommands==4
+    assert session.running==False
+    assert open(logfile).read().count("Done.")==4
+
+
+def test_session_nostall(bindir):
+    # Only the timeout
+    with phot.DaophotSession(bindir=bindir,stall=None,timeout=1.0) as session:
+        out = session.command(["OK"])
+        assert "Done." in out
+        with pytest.raises(Exception,match="timed out"):
+            session.command(["OVERWRITE"])
+
+
+@pytest.mark.parametrize("lines,prompt",[(["OVERWRITE"],"Overwrite it?"),
+                                         (["FILE","missing.fits"],"Input file name:")])
+def test_session_stall(bindir,lines,prompt):
+    session = phot.DaophotSession(bindir=bindir,stall=0.5,timeout=60)
+    session.start()
+    t0 = time.time()
+    with pytest.raises(Exception,match=prompt):
+        session.command(lines)
+    assert time.time()-t0 < 10
+    # The stuck daophot is killed and a new one is started for the next command
+    out = session.command(["OK"])
+    assert "Done." in out
+    session.close()
+
+
+def test_session_died(bindir):
+    with phot.DaophotSession(bindir=bindir,stall=0.5) as session:
+        with pytest.raises(Exception,match="ended unexpectedly"):
+            session.command(["DIE"])
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from kmtnet import phot
+from kmtnet.tests.synthetic import DAOHEADER,DAOFORMATS,daocat
+from kmtnet.tests.legacy import oldfinalcat
+
+ALSCOLS = ['ID','X','Y','MAG','ERR','SKY','ITER','CHI','SHARP']
+
+
+def sexcatalog(ncat,seed=0):
+    """ Small SExtractor catalog with units, descriptions and a vector column."""
+    rng = np.random.default_rng(seed)
+    cat = Table()
+    cat['NUMBER'] = np.arange(ncat,dtype=np.int32)+1
+    cat['X_IMAGE'] = rng.uniform(1,2048,ncat)
+    cat['Y_IMAGE'] = rng.uniform(1,4096,ncat)
+    cat['MAG_AUTO'] = rng.uniform(12,22,ncat).astype(np.float32)
+    cat['MAGERR_AUTO'] = rng.uniform(0.001,0.3,ncat).astype(np.float32)
+    cat['MAG_APER'] = rng.uniform(12,22,(ncat,5)).astype(np.float32)
+    cat['FLAGS'] = rng.integers(0,4,ncat).astype(np.int16)
+    cat['NDET_ITER'] = rng.integers(1,4,ncat).astype(np.int16)
+    for n in ['X_IMAGE','Y_IMAGE']:
+        cat[n].unit = 'pix'
+        cat[n].description = 'Object position along '+n[0]
+        cat[n].format = '%11.4f'
+    for n in ['MAG_AUTO','MAGERR_AUTO','MAG_APER']:
+        cat[n].unit = 'mag'
+    cat['MAG_AUTO'].description = 'Kron-like elliptical aperture magnitude'
+    cat.meta['EXTNAME'] = 'LDAC_OBJECTS'
+    return cat
+
+
+def alscatalog(tmp_path,ids,sexcat,seed=1):
+    """ An .als for some of the SE sources, read back with daoread."""
+    cat = daocat(len(ids),seed)
+    cat['ID'] = ids
+    ind = np.searchsorted(sexcat['NUMBER'],ids)
+    cat['X'] = sexcat['X_IMAGE'][ind]+0.1
+    cat['Y'] = sexcat['Y_IMAGE'][ind]-0.1
+    alsfile = str(tmp_path/'flux.als')
+    with open(alsfile,'w') as f:
+        f.write(DAOHEADER)
+        f.write("  1  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n")
+        for i in range(len(ids)):
+            f.write(DAOFORMATS['als'] % tuple([cat[c][i] for c in ALSCOLS]))
+    return phot.daoread(alsfile)
+
+
+def chipwcs():
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN','DEC--TAN']
+    wcs.wcs.crval = [270.0,-29.0]
+    wcs.wcs.crpix = [1024.0,2048.0]
+    wcs.wcs.cdelt = [-0.4/3600,0.4/3600]
+    return wcs
+
+
+def chipmeta():
+    meta = fits.Header()
+    meta['EXPTIME'] = 60.0
+    meta['CCDNUM'] = 3
+    meta['apcor'] = (-0.05,'Aperture correction in mags')
+    return meta
+
+
+@pytest.mark.parametrize("nals,both",[(300,True),(300,False),(500,True)])
+def test_finalcat_legacy(tmp_path,nals,both):
+    ncat = 500
+    sexcat = sexcatalog(ncat)
+    rng = np.random.default_rng(2)
+    ids = np.sort(rng.choice(ncat,nals,replace=False)+1)
+    # Not in the SE order
+    ids = ids[rng.permutation(nals)]
+    als = alscatalog(tmp_path,ids,sexcat)
+    wcs,meta = chipwcs(),chipmeta()
+    old = oldfinalcat(sexcat,als,-0.05,wcs,meta,str(tmp_path/'old.fits'),both=both)
+    cat = phot.mergecat(sexcat,als,-0.05,wcs=wcs,both=both)
+    phot.writecat(str(tmp_path/'new.fits'),cat,meta,template=sexcat)
+    assert len(cat)==(nals if both else ncat)
+    assert cat.dtype.names==tuple(old.colnames)
+    for n in old.colnames:
+        assert np.array_equal(cat[n],np.asarray(old[n]),equal_nan=True)
+        assert cat[n].dtype==old[n].dtype
+    # Same files
+    with fits.open(tmp_path/'old.fits') as ohdu, fits.open(tmp_path/'new.fits') as nhdu:
+        assert len(nhdu)==len(ohdu)==2
+        assert nhdu[0].header==ohdu[0].header
+        assert nhdu[1].header==ohdu[1].header
+        for n in old.colnames:
+            assert np.array_equal(nhdu[1].data[n],ohdu[1].data[n],equal_nan=True)
+    new = Table.read(tmp_path/'new.fits')
+    assert new['X_IMAGE'].unit=='pix' and new['MAG_APER'].unit=='mag'
+
+
+def test_finalcat_coords(tmp_path):
+    # DAOPHOT detection list, matched on the positions
+    sexcat = sexcatalog(200)
+    als = Table(alscatalog(tmp_path,np.arange(150)+1,sexcat))
+    als['ID'] = np.arange(150)+1001
+    # Far from all SE sources
+    als['X'][140:] += 50.0
+    # Two ALS sources for SE source 5, the closer one is kept
+    als['X'][6] = sexcat['X_IMAGE'][4]+0.5
+    als['Y'][6] = sexcat['Y_IMAGE'][4]
+    cat = phot.mergecat(sexcat,als,0.0,both=True,sexdetect=False,dcr=1.0)
+    assert cat.dtype.names[len(sexcat.colnames)]=='ALSID'
+    assert len(cat)==139
+    assert np.array_equal(cat['NUMBER'],np.concatenate((np.arange(6),np.arange(7,140)))+1)
+    assert np.array_equal(cat['ALSID'],cat['NUMBER']+1000)
+    assert np.all(np.hypot(cat['XPSF']-cat['X_IMAGE'],cat['YPSF']-cat['Y_IMAGE'])<1.0)
+    # No WCS, no coordinates
+    assert np.all(np.isnan(cat['RAPSF']))
+    # All the SE sources
+    cat = phot.mergecat(sexcat,als,0.0,both=False,sexdetect=False,dcr=1.0)
+    assert len(cat)==200
+    assert np.sum(cat['ALSID']>0)==139
+    assert np.all(np.isnan(cat['MAGPSF'][cat['ALSID']==-1]))
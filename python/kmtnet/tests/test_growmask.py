@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from scipy.ndimage import convolve
+from kmtnet import phot
+from kmtnet.tests.synthetic import randmask
+
+
+@pytest.mark.parametrize("shape",[(3,3),(5,5),(7,7),(2,2),(4,4),(6,6),(3,4),(4,3),(1,5),(6,1),(1,1)])
+def test_growmask_convolve(shape):
+    mask = randmask((137,211),400,seed=shape[0]*10+shape[1])
+    grown = phot.growmask(mask,shape)
+    assert grown.dtype==bool
+    assert grown.shape==mask.shape
+    assert np.array_equal(grown,convolve(mask,np.ones(shape),mode='reflect')>0)
+
+
+def test_growmask_empty():
+    mask = np.zeros((50,60),np.int16)
+    assert np.sum(phot.growmask(mask,(5,5)))==0
+    mask[20,30] = 1
+    grown = phot.growmask(mask,(5,5))
+    assert np.sum(grown)==25
+    assert np.all(grown[18:23,28:33])
@@ -0,0 +1,147 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from astropy.io import ascii,fits
+from kmtnet import phot
+from kmtnet.tests.synthetic import DAOHEADER,GROWAPERTURES,writeaprows
+
+# Stored aperture photometry of a field with blended stars, made with
+# synthetic.growfixture('grow').  A recorded DAOGROW output for it can be
+# added as data/grow.daogrow.tot, it is used when daogrow is not installed.
+DATADIR = os.path.join(os.path.dirname(__file__),'data')
+
+
+def copyfixture(wdir):
+    for ext in ['.ap','.apers']:
+        shutil.copy(os.path.join(DATADIR,'grow'+ext),os.path.join(wdir,'grow'+ext))
+
+
+def totcheck(tot):
+    """ The .tot rules: MAG = MAGFAP + APCORR and APCORR is never positive."""
+    assert np.all(np.abs(tot['MAG']-tot['MAGFAP']-tot['APCORR'])<1e-3)
+    assert np.all(tot['APCORR']<=0)
+    assert np.all((tot['FINALAP']>=1) & (tot['FINALAP']<=len(GROWAPERTURES)-2))
+
+
+@pytest.fixture(scope='module')
+def native(tmp_path_factory):
+    wdir = tmp_path_factory.mktemp('growthcurve')
+    copyfixture(wdir)
+    curdir = os.getcwd()
+    os.chdir(wdir)
+    try:
+        tot = phot.growthcurve('grow.ap','grow.apers')
+    finally:
+        os.chdir(curdir)
+    return tot
+
+
+def test_growmodel():
+    r = np.array([1.0,2.0,4.0,8.0,16.0,100.0,1e4])
+    frac = phot.growmodel(r,1.7,2.5,0.2,0.1,0.6,0.0)
+    assert np.all(np.diff(frac)>0)
+    assert frac[-1]==pytest.approx(1.0,abs=1e-3)
+    # Pure Gaussian
+    frac = phot.growmodel(r,1.7,1.03,0.0,0.0,0.6,0.0)
+    assert frac==pytest.approx(1-np.exp(-0.5*(r/1.7)**2))
+
+
+def test_growfit():
+    # Magnitude differences from a known model with noise and some outliers
+    rap = np.array(GROWAPERTURES[0:-2])
+    pars = np.array([1.8,2.5,0.3,0.1,0.6,0.0])
+    frac = phot.growmodel(rap,*pars)
+    rng = np.random.default_rng(5)
+    nstars = 300
+    m0 = rng.uniform(13,18,nstars)
+    err = np.zeros((nstars,len(rap)))+0.002+0.01*10**(0.4*(m0[:,None]-16))*(rap/3)
+    mag = m0[:,None]-2.5*np.log10(frac)+rng.normal(0,1,err.shape)*err
+    mag[0:20,3:] -= np.linspace(0.05,0.5,len(rap)-3)    # neighbors in the large apertures
+    mag[20,4] = 99.999
+    fpars,rms = phot.growfit(mag,err,rap,nfree=3)
+    assert fpars is not None
+    assert len(rms)==len(rap)-1
+    ffrac = phot.growmodel(rap,*fpars)
+    assert -2.5*np.log10(ffrac[1:]/ffrac[:-1])==pytest.approx(-2.5*np.log10(frac[1:]/frac[:-1]),abs=0.003)
+
+
+def test_growthcurve_truth(native):
+    tot = native
+    truth = ascii.read(os.path.join(DATADIR,'grow.truth'))
+    # All the stars with a good aperture magnitude
+    ap = phot.daoread(os.path.join(DATADIR,'grow.ap'))
+    gd = np.sum((ap['MAG']<50) & (ap['ERR']<0.2),axis=1)>0
+    assert np.array_equal(tot['ID'],ap['ID'][gd])
+    totcheck(tot)
+    ind = np.searchsorted(truth['ID'],tot['ID'])
+    diff = tot['MAG']-truth['MAG'][ind]
+    blend = np.array(truth['BLEND'][ind])=='True'
+    good = tot['ERR']<0.03
+    # Isolated stars
+    assert np.abs(np.median(diff[good & ~blend]))<0.01
+    assert np.all(np.abs(diff[good & ~blend])<5*tot['ERR'][good & ~blend]+0.02)
+    # Blended stars are not much fainter than their own magnitude
+    assert np.abs(np.median(diff[blend]))<0.03
+    assert np.all(diff[blend]<5*tot['ERR'][blend]+0.03)
+
+
+def test_growthcurve_blends(tmp_path):
+    # Growth curves with star-to-star scatter, the first 30 stars have a
+    # neighbor in the larger apertures
+    rap = np.array(GROWAPERTURES[0:-2])
+    frac = phot.growmodel(rap,1.8,2.5,0.3,0.1,0.6,0.0)
+    rng = np.random.default_rng(5)
+    nstars = 300
+    m0 = rng.uniform(12,18,nstars)
+    err = 0.002+0.01*10**(0.4*(m0[:,None]-16))*(rap/3)
+    mag = m0[:,None]-2.5*np.log10(frac)+rng.normal(0,1,err.shape)*err
+    mag[:,1:] += np.cumsum(rng.normal(0,0.02,(nstars,len(rap)-1)),axis=1)
+    mag[0:30,2:] -= np.linspace(0.1,0.8,len(rap)-2)
+    with open(tmp_path/'blend.ap','w') as f:
+        f.write(DAOHEADER)
+        f.write("  2  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n")
+        writeaprows(f,np.arange(nstars)+1,np.arange(nstars)+100.0,np.zeros(nstars)+100.0,mag,
+                    np.zeros(nstars)+1000.0,np.zeros(nstars)+10.0,np.zeros(nstars),err)
+    with open(tmp_path/'blend.apers','w') as f:
+        f.writelines(["A%d = %7.4f\n" % (i+1,r) for i,r in enumerate(rap)]+["IS = 40.0\n","OS = 50.0\n"])
+    curdir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        tot = phot.growthcurve('blend.ap','blend.apers')
+    finally:
+        os.chdir(curdir)
+    totcheck(tot)
+    diff = tot['MAG']-m0[tot['ID']-1]
+    blend = tot['ID']<=30
+    assert np.abs(np.median(diff[~blend]))<0.005
+    assert np.abs(np.median(diff[blend]))<0.05
+    # The neighbor is only in the larger apertures
+    assert np.all(tot['FINALAP'][blend & (tot['ERR']<0.02)]<=3)
+
+
+def test_growthcurve_daogrow(native,tmp_path):
+    recorded = os.path.join(DATADIR,'grow.daogrow.tot')
+    if shutil.which('daogrow') is not None:
+        copyfixture(tmp_path)
+        meta = fits.Header()
+        meta['DATE-OBS'] = '2020-01-01T00:00:00'
+        meta['EXPTIME'] = 60.0
+        curdir = os.getcwd()
+        os.chdir(tmp_path)
+        try:
+            dtot = phot.daogrow('grow.ap','grow.apers',meta)
+        finally:
+            os.chdir(curdir)
+    elif os.path.exists(recorded):
+        dtot = phot.daoread(recorded)
+    else:
+        pytest.skip('No daogrow and no recorded DAOGROW output')
+    totcheck(dtot)
+    tot = native
+    _,ind1,ind2 = np.intersect1d(tot['ID'],dtot['ID'],return_indices=True)
+    assert len(ind1)>0.95*len(dtot)
+    diff = tot['MAG'][ind1]-dtot['MAG'][ind2]
+    good = dtot['ERR'][ind2]<0.03
+    assert np.abs(np.median(diff[good]))<0.005
+    assert np.percentile(np.abs(diff[good]),90)<0.02
@@ -0,0 +1,120 @@
+import os
+import sys
+import tarfile
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from kmtnet import utils
+
+BASE = 'F1-00507801'
+
+
+def chipfiles(expdir,nchips=4):
+    """ Chip catalogs and other chip files of an exposure.  Returns the
+        catalogs and the contents of the other files."""
+    os.makedirs(expdir,exist_ok=True)
+    rng = np.random.default_rng(4)
+    cats = {}
+    others = {}
+    for ccdnum in range(1,nchips+1):
+        cat = Table({'NUMBER':np.arange(10*ccdnum)+1,'MAGPSF':rng.uniform(12,20,10*ccdnum)})
+        head = fits.Header()
+        head['CCDNUM'] = ccdnum
+        head['EXPTIME'] = 60.0
+        catfile = os.path.join(expdir,BASE+'_'+str(ccdnum)+'.fits')
+        fits.HDUList([fits.PrimaryHDU(header=head),fits.table_to_hdu(cat)]).writeto(catfile)
+        cats[ccdnum] = cat
+        for ext in ['.als','.psf']:
+            name = BASE+'_'+str(ccdnum)+ext
+            others[name] = rng.bytes(1000*ccdnum)
+    others[BASE+'_timing.fits'] = rng.bytes(500)
+    for name,data in others.items():
+        with open(os.path.join(expdir,name),'wb') as f:
+            f.write(data)
+    # The exposure log is not bundled
+    with open(os.path.join(expdir,BASE+'.log'),'w') as f:
+        f.write('log\n')
+    return cats,others
+
+
+def checkbundle(expdir,cats,others,compression):
+    measfile = os.path.join(expdir,BASE+'_meas.fits')
+    tfile = os.path.join(expdir,BASE+utils.tarext(compression))
+    assert sorted(os.listdir(expdir))==sorted([BASE+'_meas.fits',BASE+'_header.fits',BASE+'.log',
+                                               os.path.basename(tfile)])
+    with fits.open(measfile) as hdu:
+        assert len(hdu)==len(cats)+1
+        for i,ccdnum in enumerate(cats):
+            assert hdu[i+1].header['EXTNAME']==str(ccdnum)
+            assert np.array_equal(hdu[i+1].data['MAGPSF'],cats[ccdnum]['MAGPSF'])
+    with fits.open(os.path.join(expdir,BASE+'_header.fits')) as hdu:
+        assert [h.header['CCDNUM'] for h in hdu[1:]]==list(cats)
+    with tarfile.open(tfile,'r:*') as tar:
+        assert sorted(tar.getnames())==sorted(others)
+        for name,data in others.items():
+            assert tar.extractfile(name).read()==data
+
+
+@pytest.mark.parametrize("compression",['gz','xz',''])
+def test_measbundler(tmp_path,compression):
+    expdir = str(tmp_path/BASE)
+    cats,others = chipfiles(expdir)
+    # As the chips finish
+    bundler = utils.MeasBundler(expdir,compression=compression,level=1 if compression!='' else None)
+    assert bundler.tarfile.endswith(BASE+utils.tarext(compression))
+    for ccdnum in [2,1,4,3]:
+        bundler.addchip(ccdnum)
+    assert bundler.nchips==4 and bundler.nrows==100
+    bundler.close()
+    cats = {c:cats[c] for c in [2,1,4,3]}
+    checkbundle(expdir,cats,others,compression)
+
+
+@pytest.mark.parametrize("compression",['gz','bz2','xz'])
+def test_concatmeas_tar(tmp_path,compression):
+    # An exposure directory that was tarred up, without the directory
+    expdir = str(tmp_path/BASE)
+    cats,others = chipfiles(expdir)
+    tfile = str(tmp_path/(BASE+utils.tarext(compression)))
+    with utils.opentar(tfile,'w',compression) as tar:
+        for f in sorted(os.listdir(expdir)):
+            tar.add(os.path.join(expdir,f),arcname=f)
+    for f in os.listdir(expdir):
+        os.remove(os.path.join(expdir,f))
+    os.rmdir(expdir)
+    utils.concatmeas(tfile,compression=compression)
+    assert os.path.exists(tfile)==False
+    checkbundle(expdir,cats,others,compression)
+    # Already done
+    utils.concatmeas(expdir)
+    checkbundle(expdir,cats,others,compression)
+
+
+def test_concatmeas_dir(tmp_path):
+    # The old .tar.gz of the exposure directory
+    expdir = str(tmp_path/BASE)
+    cats,others = chipfiles(expdir,nchips=12)
+    tfile = str(tmp_path/(BASE+'.tar.gz'))
+    with tarfile.open(tfile,'w:gz') as tar:
+        tar.add(expdir,arcname=BASE)
+    for f in os.listdir(expdir):
+        os.remove(os.path.join(expdir,f))
+    os.rmdir(expdir)
+    utils.concatmeas(tfile)
+    checkbundle(expdir,cats,others,'gz')
+
+
+def test_compression_check(tmp_path):
+    with pytest.raises(Exception,match='not supported'):
+        utils.MeasBundler(str(tmp_path),compression='lz4')
+    if sys.version_info<(3,14):
+        with pytest.raises(Exception,match='python 3.14'):
+            utils.MeasBundler(str(tmp_path),compression='zst')
+        with pytest.raises(Exception,match='python 3.14'):
+            utils.opentar(str(tmp_path/'test.tar.zst'),'w','zst')
+    else:
+        expdir = str(tmp_path/BASE)
+        cats,others = chipfiles(expdir)
+        utils.concatmeas(expdir,compression='zst')
+        checkbundle(expdir,cats,others,'zst')
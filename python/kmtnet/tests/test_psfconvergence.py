@@ -0,0 +1,235 @@
+import os
+import hashlib
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from kmtnet import phot
+from kmtnet.phot import PSFConvergence
+from kmtnet.tests.synthetic import writedaofile
+
+
+def profs(sigs,ids=None,flags=None):
+    n = len(sigs)
+    if ids is None: ids=np.arange(n)+1
+    if flags is None: flags=['']*n
+    return Table({'ID':np.array(ids),'SIG':np.array(sigs,float),'FLAG':np.array(flags,dtype='U10')})
+
+
+def test_geometric_chi():
+    conv = PSFConvergence(dchi=0.002,mode='predict')
+    rng = np.random.default_rng(1)
+    # The SIG values change a lot, so only the chi rule can fire
+    for i,chi in enumerate([0.050,0.040,0.0392]):
+        conv.add(1,i+1,'reject',chi,profs(rng.uniform(0.01,0.1,20)),nrej=0)
+        predicted = conv.done('reject')
+    # d1=-0.01, d2=-0.0008, ratio=0.08, remaining change 7e-5
+    assert predicted
+    assert [r['converged'] for r in conv.rows]==[False,False,True]
+    # Slow geometric decay, remaining change 0.0045
+    conv = PSFConvergence(dchi=0.002,mode='predict')
+    for i,chi in enumerate([0.050,0.040,0.032]):
+        conv.add(1,i+1,'sub',chi,profs(rng.uniform(0.01,0.1,20)))
+    assert conv.done('sub')==False
+    # Chi went up, not a geometric series
+    conv = PSFConvergence(dchi=0.002,mode='predict')
+    for i,chi in enumerate([0.050,0.040,0.0401]):
+        conv.add(1,i+1,'sub',chi,profs(rng.uniform(0.01,0.1,20)))
+    assert conv.done('sub')==False
+
+
+def test_sig_stable():
+    sigs = np.linspace(0.02,0.05,40)
+    # Same SIG values and one of 40 rejected (<= 5%)
+    conv = PSFConvergence(dsig=0.002,frej=0.05,mode='predict')
+    conv.add(1,1,'reject',0.05,profs(sigs),nrej=3)
+    assert conv.done('reject')==False     # needs two fits
+    conv.add(1,2,'reject',0.07,profs(sigs+0.001),nrej=2)
+    assert conv.rows[-1]['dsig']==pytest.approx(0.001)
+    assert conv.done('reject')
+    # Too many rejected stars
+    conv = PSFConvergence(dsig=0.002,frej=0.05,mode='predict')
+    conv.add(1,1,'reject',0.05,profs(sigs),nrej=3)
+    conv.add(1,2,'reject',0.07,profs(sigs+0.001),nrej=3)
+    assert conv.done('reject')==False
+    # SIG changed too much
+    conv = PSFConvergence(dsig=0.002,frej=0.05,mode='predict')
+    conv.add(1,1,'reject',0.05,profs(sigs),nrej=0)
+    conv.add(1,2,'reject',0.07,profs(sigs+0.003),nrej=0)
+    assert conv.done('reject')==False
+    # Only the stars in both fits are compared, saturated stars are skipped
+    conv = PSFConvergence(dsig=0.002,frej=0.05,mode='predict')
+    conv.add(1,1,'reject',0.05,profs(sigs),nrej=0)
+    flags = ['']*39+['saturated']
+    sigs2 = sigs.copy()
+    sigs2[-1] = 1.0
+    conv.add(1,2,'reject',0.07,profs(sigs2[1:],ids=np.arange(2,41),flags=flags[1:]),nrej=0)
+    assert conv.rows[-1]['dsig']==0.0
+    assert conv.done('reject')
+
+
+def test_reject_loop_restarts():
+    sigs = np.linspace(0.02,0.05,40)
+    conv = PSFConvergence(mode='predict')
+    conv.add(1,1,'reject',0.05,profs(sigs))
+    conv.add(1,2,'reject',0.05,profs(sigs))
+    assert conv.done('reject')
+    # A new cleaning iteration starts a new rejection loop
+    conv.add(2,1,'reject',0.05,profs(sigs))
+    assert len(conv.loop('reject'))==1
+    assert conv.done('reject')==False
+    # The fits on the subtracted images are one loop
+    conv.add(1,2,'sub',0.05,profs(sigs))
+    conv.add(2,1,'sub',0.05,profs(sigs))
+    assert len(conv.loop('sub'))==2
+
+
+def test_fixed_never_stops():
+    sigs = np.linspace(0.02,0.05,40)
+    conv = PSFConvergence(mode='fixed')
+    for i,chi in enumerate([0.050,0.040,0.0392,0.0391]):
+        conv.add(1,i+1,'sub',chi,profs(sigs))
+        assert conv.done('sub')==False
+    # The prediction is still recorded
+    assert [r['converged'] for r in conv.rows]==[False,True,True,True]
+    tab = conv.table()
+    assert list(tab['converged'])==[False,True,True,True]
+    meta = fits.Header()
+    conv.stop = 'fixed'
+    conv.tometa(meta)
+    assert meta['PSFNFIT']==4 and meta['PSFMODE']=='fixed'
+    assert len(meta['HISTORY'])==4
+    with pytest.raises(Exception):
+        PSFConvergence(mode='other')
+
+
+#----------------------------------------------------------------------
+# A/B of the fixed and predict rules in createpsf, with daopsf and
+#  subpsfnei replaced by deterministic stand-ins
+#----------------------------------------------------------------------
+
+def filehash(filename):
+    return hashlib.md5(open(filename,'rb').read()).hexdigest()[0:10]
+
+
+class FakeDAOPHOT:
+    """
+    Stand-ins for daopsf and subpsfnei.  The image files are text files, every
+    neighbor subtraction adds a '|' to the image, and the PSF gets better with
+    the number of subtractions (gen) of the image it is fit on.  The outputs
+    only depend on the inputs, so the same fit gives the same .psf and .nei.
+    """
+
+    def __init__(self,ratio=0.3):
+        self.ratio = ratio
+        self.fits = []
+        self.subs = []
+
+    def daopsf(self,imfile=None,listfile=None,apfile=None,logger=None,bindir=None,session=None,**kwargs):
+        base = os.path.splitext(os.path.basename(imfile))[0]
+        image = open(imfile).read()
+        gen = image.count('|')
+        lst = phot.daoread(listfile)
+        ids = np.array(lst['ID'])
+        bad = (ids % 7 == 0)
+        sigs = 0.02+0.001*(ids % 5)+0.05*self.ratio**gen
+        sigs[bad] *= 4
+        # Like DAOPHOT the chi is about the mean profile scatter
+        chi = np.mean(sigs)
+        key = 'gen='+str(gen)+' image='+filehash(imfile)+' list='+filehash(listfile)
+        with open(base+'.psf','w') as f:
+            f.write('PENNY1    '+key+'\n')
+        with open(base+'.nei','w') as f:
+            f.write(key+'\n')
+        self.fits.append({'image':filehash(imfile),'list':filehash(listfile),'gen':gen,'chi':chi})
+        return np.array([1]),np.array([chi]),profs(sigs,ids=ids)
+
+    def subpsfnei(self,imfile=None,listfile=None,photfile=None,outfile=None,psffile=None,
+                  logger=None,session=None,**kwargs):
+        psf = open(psffile).read()
+        nei = open(os.path.splitext(psffile)[0]+'.nei').read()
+        self.subs.append({'psf':psf,'nei':nei,'list':filehash(listfile)})
+        gen = int(psf.split()[1].split('=')[1])
+        # A better PSF leaves a cleaner subtracted image
+        with open(outfile,'w') as f:
+            f.write(open(imfile).read().split('|')[0]+'|'*(gen+1))
+
+
+def runcreatepsf(tmp_path,monkeypatch,psfstop,label=None,ratio=0.3):
+    if label is None: label=psfstop
+    wdir = tmp_path / label
+    wdir.mkdir()
+    monkeypatch.chdir(wdir)
+    fake = FakeDAOPHOT(ratio)
+    monkeypatch.setattr(phot,'daopsf',fake.daopsf)
+    monkeypatch.setattr(phot,'subpsfnei',fake.subpsfnei)
+    with open('chip.fits','w') as f:
+        f.write('image')
+    writedaofile('chip.lst','lst',30,seed=2)
+    writedaofile('chip.ap','ap',30,seed=2)
+    optlines = ['XX = {:8.2f}'.format(i) for i in range(20)]
+    optlines[14] = 'AN = {:8.2f}'.format(-6)
+    with open('chip.opt','w') as f:
+        f.write('\n'.join(optlines)+'\n')
+    meta = fits.Header()
+    subiter = phot.createpsf('chip.fits','chip.ap','chip.lst',meta=meta,psfstop=psfstop,
+                             submaxit=6,subminit=2)
+    return fake,meta,subiter
+
+
+def test_createpsf_ab(tmp_path,monkeypatch):
+    fixed,fmeta,fsubiter = runcreatepsf(tmp_path,monkeypatch,'fixed')
+    predict,pmeta,psubiter = runcreatepsf(tmp_path,monkeypatch,'predict')
+    # The fixed rule: the sub fits with chi 0.0373, 0.0268, 0.0237, 0.0227 end after
+    #  the 4th cleaning iteration, with 2 rejection fits in the first one
+    assert fmeta['PSFSTOP']=='fixed'
+    assert fsubiter-1==4
+    assert fmeta['PSFNFIT']==len(fixed.fits)
+    # The prediction fires one cleaning iteration earlier and it skips the
+    #  refit of the same image and list at the start of each cleaning iteration
+    assert pmeta['PSFSTOP']=='predict'
+    assert psubiter-1==3
+    assert len(predict.fits)<len(fixed.fits)
+    assert np.abs(pmeta['PSFCHI']-fmeta['PSFCHI'])<0.002
+    # The final PSF star lists are the same
+    assert [s['list'] for s in predict.subs]==[s['list'] for s in fixed.subs[0:3]]
+
+
+@pytest.mark.parametrize("ratio",[0.2,0.4,0.6,0.85])
+def test_createpsf_ab_ratios(tmp_path,monkeypatch,ratio):
+    fixed,fmeta,fsubiter = runcreatepsf(tmp_path,monkeypatch,'fixed',ratio=ratio)
+    predict,pmeta,psubiter = runcreatepsf(tmp_path,monkeypatch,'predict',ratio=ratio)
+    assert len(predict.fits)<len(fixed.fits)
+    assert psubiter<=fsubiter
+    assert np.abs(pmeta['PSFCHI']-fmeta['PSFCHI'])<0.002
+
+
+def test_createpsf_fixed_ignores_prediction(tmp_path,monkeypatch):
+    # Even if the prediction always says converged, 'fixed' runs the same fits
+    fixed,fmeta,fsubiter = runcreatepsf(tmp_path,monkeypatch,'fixed')
+    monkeypatch.setattr(PSFConvergence,'converged',lambda self,kind: True)
+    always,ameta,asubiter = runcreatepsf(tmp_path,monkeypatch,'fixed',label='always')
+    assert asubiter==fsubiter
+    assert always.fits==fixed.fits
+    assert ameta['PSFSTOP']=='fixed'
+    assert ameta['PSFNFIT']==fmeta['PSFNFIT']
+
+
+def test_createpsf_predict_reuse(tmp_path,monkeypatch):
+    # In 'predict' the first fit of a cleaning iteration reuses the fit on the
+    #  subtracted image, so the .psf and .nei on disk come from that fit.
+    #  They must be the same files that 'fixed' gives subpsfnei.
+    fixed,fmeta,fsubiter = runcreatepsf(tmp_path,monkeypatch,'fixed')
+    predict,pmeta,psubiter = runcreatepsf(tmp_path,monkeypatch,'predict')
+    nsub = len(predict.subs)
+    assert nsub>=2
+    for psub,fsub in zip(predict.subs,fixed.subs[0:nsub]):
+        assert psub['psf']==fsub['psf']
+        assert psub['nei']==fsub['nei']
+    # Predict runs the same fits as fixed in its cleaning iterations, except
+    #  for the refit of the same image and list at the start of each one
+    nfixed = len([h for h in fmeta['HISTORY'] if int(h.split()[3][4:])<psubiter])
+    fkeys = [(f['image'],f['list']) for f in fixed.fits[0:nfixed]]
+    dedup = [k for i,k in enumerate(fkeys) if i==0 or k!=fkeys[i-1]]
+    assert [(f['image'],f['list']) for f in predict.fits]==dedup
+    assert len(predict.fits)==nfixed-(psubiter-2)
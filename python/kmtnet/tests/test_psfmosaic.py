@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from kmtnet import phot
+from kmtnet.tests.synthetic import DAOHEADER,DAOFORMATS,writeaprows
+
+NX,NY = 600,500
+RADIUS = 20
+
+
+@pytest.fixture(scope='module')
+def field(tmp_path_factory):
+    """ Image with PSF stars, two of them overlapping and some on the
+        edges, and an .ap and .lst."""
+    wdir = tmp_path_factory.mktemp('psfmosaic')
+    rng = np.random.default_rng(8)
+    im = rng.normal(1000,10,(NY,NX)).astype(np.float32)
+    fits.writeto(wdir/'im.fits',im)
+    # PSF stars, 1-based DAOPHOT positions
+    px = np.array([100.3,120.8,300.5,550.2,5.4,598.7,250.0,450.6])
+    py = np.array([100.1,110.6,250.2,60.9,300.3,495.2,420.4,400.8])
+    npsf = len(px)
+    # All of the sources
+    nstars = 400
+    x = np.concatenate((px,rng.uniform(1,NX,nstars-npsf)))
+    y = np.concatenate((py,rng.uniform(1,NY,nstars-npsf)))
+    ids = np.arange(nstars)+11
+    mag = rng.uniform(12,18,(nstars,3))
+    with open(wdir/'im.ap','w') as f:
+        f.write(DAOHEADER)
+        f.write("  2  %4d  %4d  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n" % (NX,NY))
+        writeaprows(f,ids,x,y,mag,np.zeros(nstars)+1000.0,np.zeros(nstars)+10.0,
+                    np.zeros(nstars),np.zeros((nstars,3))+0.01)
+    with open(wdir/'im.lst','w') as f:
+        f.write(DAOHEADER)
+        f.write("  3 %5d %5d  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n" % (NX,NY))
+        for i in range(npsf):
+            f.write(DAOFORMATS['lst'] % (ids[i],x[i],y[i],mag[i,0],0.01,1000.0))
+    mos = phot.PSFMosaic(str(wdir/'im.fits'),str(wdir/'im.lst'),RADIUS)
+    return {'dir':wdir,'im':im,'mos':mos,'x':x,'y':y,'ids':ids,'npsf':npsf}
+
+
+def test_psfmosaic_boxes(field):
+    mos = field['mos']
+    # The two close stars share a box
+    assert len(mos)==field['npsf']-1
+    bnx = mos.boxes[:,1]-mos.boxes[:,0]
+    bny = mos.boxes[:,3]-mos.boxes[:,2]
+    assert np.all(mos.boxes[:,0]>=0) and np.all(mos.boxes[:,1]<=NX)
+    assert np.all(mos.boxes[:,2]>=0) and np.all(mos.boxes[:,3]<=NY)
+    # Much smaller than the image
+    assert mos.nx*mos.ny<0.5*NX*NY
+    # The boxes do not overlap in the mosaic, and the rest is bad pixels
+    used = np.zeros((mos.ny,mos.nx),int)
+    for i in range(len(mos)):
+        used[mos.my0[i]:mos.my0[i]+bny[i],mos.mx0[i]:mos.mx0[i]+bnx[i]] += 1
+    assert np.max(used)==1
+    m = mos.mosaic(field['im'])
+    assert m.shape==(mos.ny,mos.nx) and m.dtype==field['im'].dtype
+    assert np.all(m[used==0]==6e4)
+    assert np.sum(used)==np.sum(bnx*bny)
+
+
+def test_psfmosaic_paste(field):
+    mos,im = field['mos'],field['im']
+    m = mos.mosaic(im)
+    # Round trip
+    assert np.array_equal(mos.paste(m,im.copy()),im)
+    # Only the boxes are changed
+    out = mos.paste(m-1,im.copy())
+    inbox = np.zeros(im.shape,bool)
+    for b in mos.boxes:
+        inbox[b[2]:b[3],b[0]:b[1]] = True
+    assert np.array_equal(out[inbox],im[inbox]-1)
+    assert np.array_equal(out[~inbox],im[~inbox])
+
+
+def test_psfmosaic_coords(field):
+    mos,im = field['mos'],field['im']
+    m = mos.mosaic(im)
+    # Every PSF star is in a box
+    mx,my = mos.tomosaic(field['x'][0:field['npsf']],field['y'][0:field['npsf']])
+    assert np.all(np.isfinite(mx)) and np.all(np.isfinite(my))
+    # Whole pixels have the same values
+    rng = np.random.default_rng(1)
+    x = rng.integers(1,NX+1,20000)
+    y = rng.integers(1,NY+1,20000)
+    ind = mos.box(x,y)
+    mx,my = mos.tomosaic(x,y)
+    good = ind>=0
+    assert np.sum(good)>100
+    assert np.all(np.isnan(mx[~good])) and np.all(np.isnan(my[~good]))
+    assert np.array_equal(m[my[good].astype(int)-1,mx[good].astype(int)-1],im[y[good]-1,x[good]-1])
+    # Fractional positions keep their offset in the box
+    mx,my = mos.tomosaic(field['x'][0]+0.25,field['y'][0]-0.3)
+    mx0,my0 = mos.tomosaic(field['x'][0],field['y'][0])
+    assert mx[0]-mx0[0]==pytest.approx(0.25) and my[0]-my0[0]==pytest.approx(-0.3)
+
+
+@pytest.mark.parametrize("ext",['ap','lst'])
+def test_psfmosaic_writefile(field,ext):
+    mos = field['mos']
+    infile = str(field['dir']/('im.'+ext))
+    outfile = str(field['dir']/('mos.'+ext))
+    nout = mos.writefile(infile,outfile)
+    cat = phot.daoread(infile)
+    mcat = phot.daoread(outfile)
+    mx,my = mos.tomosaic(cat['X'],cat['Y'])
+    inbox = np.isfinite(mx)
+    assert nout==len(mcat)==np.sum(inbox)
+    # Same sources and IDs, at the mosaic positions
+    assert np.array_equal(mcat['ID'],cat['ID'][inbox])
+    assert np.allclose(mcat['X'],mx[inbox],atol=6e-4)
+    assert np.allclose(mcat['Y'],my[inbox],atol=6e-4)
+    for c in cat.colnames:
+        if c not in ['ID','X','Y']:
+            assert np.array_equal(mcat[c],cat[c][inbox])
+    # The header has the size of the mosaic
+    lines = open(outfile).read().splitlines()
+    assert [int(v) for v in lines[1].split()[1:3]]==[mos.nx,mos.ny]
+    inhead = open(infile).read().splitlines()[1]
+    assert lines[1].split()[3:]==inhead.split()[3:] and len(lines[1])==len(inhead)
+    assert len(lines)==3+nout*(3 if ext=='ap' else 1)
+    if ext=='lst':
+        assert set(mcat['ID'])==set(field['ids'][0:field['npsf']])
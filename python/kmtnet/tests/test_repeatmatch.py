@@ -0,0 +1,91 @@
+import numpy as np
+from astropy.table import Table
+from kmtnet import phot
+
+
+def oldrepeat(newcat,prevcat,dpix=2):
+    """ The per-source loop that Chip.runsex used before repeatmatch."""
+    pairs = set()
+    for i,newsource in enumerate(newcat):
+        close, = np.where((prevcat['X_IMAGE']<(newsource['X_IMAGE']+dpix)) &
+                          (prevcat['X_IMAGE']>(newsource['X_IMAGE']-dpix)) &
+                          (prevcat['Y_IMAGE']<(newsource['Y_IMAGE']+dpix)) &
+                          (prevcat['Y_IMAGE']>(newsource['Y_IMAGE']-dpix)))
+        for j in close:
+            oldsource = prevcat[j]
+            d_btwn_centers = np.sqrt((newsource['X_IMAGE']-oldsource['X_IMAGE'])**2 +
+                                     (newsource['Y_IMAGE']-oldsource['Y_IMAGE'])**2)
+            if d_btwn_centers <= dpix:
+                pairs.add((i,int(j)))
+    return pairs
+
+
+def newrepeat(newcat,prevcat,dpix=2):
+    ind1,ind2 = phot.repeatmatch(newcat['X_IMAGE'],newcat['Y_IMAGE'],
+                                 prevcat['X_IMAGE'],prevcat['Y_IMAGE'],dpix=dpix)
+    return set(zip(ind1.tolist(),ind2.tolist()))
+
+
+def syncat(n,rng,size=300.0,grid=None):
+    cat = Table()
+    x = rng.uniform(1,size,n)
+    y = rng.uniform(1,size,n)
+    # Snap to a coarse grid so many separations fall exactly on the edges
+    if grid is not None:
+        x = np.round(x/grid)*grid
+        y = np.round(y/grid)*grid
+    cat['X_IMAGE'] = x
+    cat['Y_IMAGE'] = y
+    return cat
+
+
+def test_repeatmatch_random():
+    rng = np.random.default_rng(5)
+    prevcat = syncat(3000,rng)
+    # Half of the new sources are re-detections of old ones
+    newcat = syncat(3000,rng)
+    newcat['X_IMAGE'][0:1500] = prevcat['X_IMAGE'][0:1500]+rng.normal(0,1.0,1500)
+    newcat['Y_IMAGE'][0:1500] = prevcat['Y_IMAGE'][0:1500]+rng.normal(0,1.0,1500)
+    old = oldrepeat(newcat,prevcat)
+    new = newrepeat(newcat,prevcat)
+    assert len(old)>1000
+    assert new==old
+
+
+def test_repeatmatch_grid():
+    # On a 1/8 pixel grid the separations are exact, lots of ties at dpix
+    rng = np.random.default_rng(11)
+    prevcat = syncat(4000,rng,size=150.0,grid=0.125)
+    newcat = syncat(4000,rng,size=150.0,grid=0.125)
+    for dpix in [2,2.5]:
+        old = oldrepeat(newcat,prevcat,dpix=dpix)
+        new = newrepeat(newcat,prevcat,dpix=dpix)
+        assert new==old
+
+
+def test_repeatmatch_edges():
+    # Separations of exactly dpix
+    prevcat = Table({'X_IMAGE':np.array([10.0,10.0,10.0,50.0,80.0]),
+                     'Y_IMAGE':np.array([10.0,10.0,10.0,50.0,80.0])})
+    newcat = Table({'X_IMAGE':np.array([12.0,10.0,11.5,51.5,81.0]),
+                    'Y_IMAGE':np.array([10.0,8.0,12.0,52.0,81.0])})
+    # dpix=2: the axis-aligned ones fail the |dx|<dpix box, the diagonal one
+    #  at 2.5 is too far, only (1,1) offsets match
+    old = oldrepeat(newcat,prevcat,dpix=2)
+    assert newrepeat(newcat,prevcat,dpix=2)==old
+    assert old=={(4,4)}
+    # dpix=2.5: the 1.5/2.0 offsets are exactly 2.5 away and match
+    old = oldrepeat(newcat,prevcat,dpix=2.5)
+    assert newrepeat(newcat,prevcat,dpix=2.5)==old
+    assert old=={(0,0),(0,1),(0,2),(1,0),(1,1),(1,2),(2,0),(2,1),(2,2),(3,3),(4,4)}
+    
+
+def test_repeatmatch_empty():
+    prevcat = Table({'X_IMAGE':np.array([10.0]),'Y_IMAGE':np.array([10.0])})
+    newcat = Table({'X_IMAGE':np.zeros(0),'Y_IMAGE':np.zeros(0)})
+    ind1,ind2 = phot.repeatmatch(newcat['X_IMAGE'],newcat['Y_IMAGE'],
+                                 prevcat['X_IMAGE'],prevcat['Y_IMAGE'])
+    assert len(ind1)==0 and len(ind2)==0
+    # No pairs within dpix
+    ind1,ind2 = phot.repeatmatch([100.0],[100.0],[10.0],[10.0])
+    assert len(ind1)==0 and len(ind2)==0
@@ -0,0 +1,93 @@
+import os
+import json
+import numpy as np
+import pytest
+from astropy.table import Table
+from kmtnet.runner import Runner
+
+
+def maketasks(wdir,cmds,**columns):
+    n = len(cmds)
+    tab = Table({'cmd':cmds,'outfile':[str(wdir/('task%d.out' % (i+1))) for i in range(n)],
+                 'errfile':[str(wdir/('task%d.err' % (i+1))) for i in range(n)],
+                 'dir':[str(wdir)]*n})
+    for k,v in columns.items():
+        tab[k] = v
+    return tab
+
+
+def test_runner_stealing(tmp_path):
+    # The first worker is busy with the long task, the other one runs
+    #  all of the short ones, its own and then the ones of the first worker
+    cmds = ['sleep 1.5']+['sleep 0.1']*10
+    cost = [100.0]+list(np.arange(10,0,-1))
+    runner = Runner(maketasks(tmp_path,cmds,cost=cost),ncores=2,stagger=0.0,memory=None)
+    assert [len(q) for q in runner.queues]==[6,5]
+    status = runner.run()
+    assert status==['done']*11
+    assert runner.worker[0]==0
+    assert np.all(runner.worker[1:]==1)
+    assert [len(q) for q in runner.queues]==[0,0]
+    assert np.all(runner.attempts==1)
+    # Its own queue most expensive first, then from the back of the other queue
+    assert list(np.argsort(runner.start[1:])+1)==[1,3,5,7,9,10,8,6,4,2]
+
+
+def test_runner_retries(tmp_path):
+    cmds = ['exit 3',
+            'test -e again || { touch again; exit 1; }',
+            'true']
+    runner = Runner(maketasks(tmp_path,cmds),ncores=1,stagger=0.0,retries=2,memory=None)
+    status = runner.run()
+    # Failed on every attempt and then reported
+    assert status==['failed','done','done']
+    assert list(runner.attempts)==[3,2,1]
+    assert runner.retcode==[3,0,0]
+    assert runner.summary()=={'pending':0,'running':0,'done':2,'failed':1}
+    # No retries
+    runner = Runner(maketasks(tmp_path,cmds),ncores=1,stagger=0.0,retries=0,memory=None)
+    assert runner.run()==['failed','done','done']
+    assert list(runner.attempts)==[1,1,1]
+
+
+def test_runner_memory(tmp_path):
+    # Only two of the tasks fit in the memory at the same time
+    log = tmp_path/'times.log'
+    cmd = 'echo "$(date +%s.%N) 1" >> '+str(log)+'; sleep 0.3; echo "$(date +%s.%N) -1" >> '+str(log)
+    runner = Runner(maketasks(tmp_path,[cmd]*6,memory=[60.0]*6),ncores=6,stagger=0.0,memory=130.0)
+    assert runner.nworkers==6
+    assert runner.run()==['done']*6
+    times = np.array([[float(v) for v in l.split()] for l in open(log).read().splitlines()])
+    times = times[np.lexsort((times[:,1],times[:,0]))]
+    assert np.max(np.cumsum(times[:,1]))==2
+    assert runner._usedmemory==0.0
+    # A task that can never run
+    with pytest.raises(Exception,match='more than'):
+        Runner(maketasks(tmp_path,['true'],memory=[200.0]),memory=130.0)
+
+
+def test_runner_stagger(tmp_path):
+    runner = Runner(maketasks(tmp_path,['true']*3),ncores=3,stagger=0.3,memory=None)
+    runner.run()
+    assert np.all(np.diff(np.sort(runner.start))>=0.29)
+
+
+def test_runner_progress(tmp_path):
+    # The second task copies the progress file while it is running
+    progressfile = str(tmp_path/'progress.json')
+    cmds = ['true','cp '+progressfile+' snapshot.json','exit 1']
+    runner = Runner(maketasks(tmp_path,cmds),ncores=1,stagger=0.0,retries=0,memory=None,
+                    progressfile=progressfile)
+    runner.run()
+    snap = json.load(open(tmp_path/'snapshot.json'))
+    assert snap['summary']=={'pending':1,'running':1,'done':1,'failed':0}
+    assert [t['status'] for t in snap['tasks']]==['done','running','pending']
+    assert snap['tasks'][0]['retcode']==0 and snap['tasks'][1]['retcode'] is None
+    prog = json.load(open(progressfile))
+    assert prog['summary']=={'pending':0,'running':0,'done':2,'failed':1}
+    assert [t['status'] for t in prog['tasks']]==['done','done','failed']
+    assert [t['attempts'] for t in prog['tasks']]==[1,1,1]
+    assert prog['tasks'][2]['retcode']==1
+    assert prog['time']>=snap['time'] and prog['elapsed']>0
+    # The temporary files are gone
+    assert [f for f in os.listdir(tmp_path) if f.endswith('.tmp')]==[]
@@ -0,0 +1,114 @@
+import os
+import collections
+import pytest
+from kmtnet import utils
+
+GB = 10**9
+BASE = 'F1-00507801'
+
+DiskUsage = collections.namedtuple('DiskUsage',['total','used','free'])
+
+
+@pytest.fixture
+def roots(tmp_path,monkeypatch):
+    """ Shared tmproot and node-local scratch in tmp_path, with the free space
+        of every root set in the returned dictionary."""
+    shared = str(tmp_path/'shared')
+    local = str(tmp_path/'local')
+    os.makedirs(local)
+    monkeypatch.setattr(utils,'getdirs',lambda host=None: (str(tmp_path),shared))
+    monkeypatch.setenv('SLURM_TMPDIR',local)
+    monkeypatch.delenv('KMTNET_SCRATCH',raising=False)
+    free = {'/dev/shm':0,local:0}
+    def disk_usage(path):
+        return DiskUsage(100*GB,100*GB-free[path],free[path])
+    monkeypatch.setattr(utils.shutil,'disk_usage',disk_usage)
+    return {'shared':shared,'local':local,'free':free}
+
+
+def test_workingset():
+    # flux, weight, mask, DAOPHOT image, 5 subtractions and 4 SExtractor iterations
+    assert utils.workingset(2048,4096)==2048*4096*(4+4+2+4+4*5+8*4)
+    assert utils.workingset(2048,4096,nchips=4)==4*utils.workingset(2048,4096)
+    assert utils.workingset(2048,4096,nsexiter=1,submaxit=1)==2048*4096*26
+
+
+def test_scratchroots(roots,monkeypatch):
+    kinds = [r[0] for r in utils.scratchroots()]
+    assert kinds==['shm','local','shared']
+    shmroot,localroot,sharedroot = [r[1] for r in utils.scratchroots()]
+    assert shmroot.startswith('/dev/shm/') and shmroot.endswith('/kmtnet')
+    assert localroot.startswith(roots['local']+'/')
+    assert sharedroot==roots['shared']
+    # The shared tmproot is always the last one
+    monkeypatch.setenv('KMTNET_SCRATCH','/scratch/a: local')
+    assert [r[0] for r in utils.scratchroots()]==['/scratch/a','local','shared']
+    assert [r[0] for r in utils.scratchroots(scratch='shared:shm')]==['shared','shm']
+    assert [r[0] for r in utils.scratchroots(scratch='auto')]==['shm','local','shared']
+
+
+@pytest.mark.skipif(os.access('/dev/shm',os.W_OK)==False,reason='no writable /dev/shm')
+def test_scratchdir(roots,monkeypatch):
+    free = roots['free']
+    need = 10*GB
+    # Room on /dev/shm
+    free['/dev/shm'] = 20*GB
+    free[roots['local']] = 20*GB
+    assert utils.scratchdir(need=need)[0]=='shm'
+    # Not with the margin
+    free['/dev/shm'] = 11*GB
+    kind,root = utils.scratchdir(need=need)
+    assert kind=='local' and root.startswith(roots['local'])
+    assert utils.scratchdir(need=need,margin=1.0)[0]=='shm'
+    # Neither
+    free[roots['local']] = 5*GB
+    assert utils.scratchdir(need=need)==('shared',roots['shared'])
+    # Order from the environment
+    monkeypatch.setenv('KMTNET_SCRATCH','local:shm')
+    free[roots['local']] = 20*GB
+    free['/dev/shm'] = 20*GB
+    assert utils.scratchdir(need=need)[0]=='local'
+
+
+def test_scratchdir_missing(roots,tmp_path):
+    roots['free'][roots['local']] = 20*GB
+    # Directories that do not exist are skipped
+    kind,root = utils.scratchdir(need=GB,scratch=str(tmp_path/'none')+':local')
+    assert kind=='local'
+    assert utils.scratchdir(need=GB,scratch=str(tmp_path/'none'))==('shared',roots['shared'])
+
+
+def test_tempdirs(roots):
+    roots['free'][roots['local']] = 20*GB
+    kind,workdir,statedir = utils.tempdirs(BASE,need=GB,scratch='local')
+    assert kind=='local'
+    assert workdir.startswith(roots['local']) and os.path.basename(workdir)==BASE+'.1'
+    # The state is on the shared tmproot
+    assert statedir==os.path.join(roots['shared'],BASE+'.1')
+    os.makedirs(workdir)
+    os.makedirs(statedir)
+    # The next run takes the next number
+    kind,workdir2,statedir2 = utils.tempdirs(BASE,need=GB,scratch='local')
+    assert os.path.basename(workdir2)==os.path.basename(statedir2)==BASE+'.2'
+    # Or if only one of them is still there
+    os.makedirs(os.path.join(roots['shared'],BASE+'.2'))
+    assert os.path.basename(utils.tempdirs(BASE,need=GB,scratch='local')[1])==BASE+'.3'
+    # Shared scratch, they are the same
+    kind,workdir,statedir = utils.tempdirs(BASE,need=GB,scratch='shared')
+    assert kind=='shared' and workdir==statedir==os.path.join(roots['shared'],BASE+'.3')
+
+
+def test_tempdirs_resume(roots):
+    roots['free'][roots['local']] = 20*GB
+    kind,workdir,statedir = utils.tempdirs(BASE,need=GB,scratch='local')
+    os.makedirs(workdir)
+    os.makedirs(statedir)
+    # Same node, the working files are still there
+    assert utils.tempdirs(BASE,need=GB,scratch='local',resume=True)==('local',workdir,statedir)
+    # Another node, or the node-local scratch was cleaned up.  The checkpoints
+    #  are kept and the run works in the state directory
+    os.rmdir(workdir)
+    assert utils.tempdirs(BASE,need=GB,scratch='local',resume=True)==('shared',statedir,statedir)
+    # Nothing to resume
+    kind,workdir,statedir = utils.tempdirs('F1-00507802',need=GB,scratch='local',resume=True)
+    assert kind=='local' and os.path.basename(statedir)=='F1-00507802.1'
@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import pytest
+
+# Chip needs prometheus for the detection
+pytest.importorskip('prometheus')
+from kmtnet import kmtnet
+from kmtnet.tests.synthetic import starchip
+
+FWHM = 4.0
+PIXSCALE = 0.4
+
+
+@pytest.fixture(scope='module')
+def chip(tmp_path_factory):
+    wdir = tmp_path_factory.mktemp('seedfwhm')
+    curdir = os.getcwd()
+    os.chdir(wdir)
+    try:
+        im,head,cat = starchip('chip',fwhm=FWHM,pixscale=PIXSCALE)
+        # 'sex' is only the placeholder, so cheap to make the chip with
+        chip = kmtnet.Chip('flux.fits','chip','localhost',data=im,header=head,fwhmmode='sex')
+    finally:
+        os.chdir(curdir)
+    return chip
+
+
+def test_seedfwhm_modes(chip):
+    full = chip.seedfwhm('full')
+    tiled = chip.seedfwhm('tiled')
+    assert full==pytest.approx(FWHM*PIXSCALE,rel=0.15)
+    assert tiled==pytest.approx(full,rel=0.1)
+    assert chip._fwhm==tiled and chip.meta['fwhm']==tiled
+
+
+def test_seedfwhm_sex(chip):
+    # The header seeing or fwhm0 until runsex() measures it
+    assert chip.seedfwhm('sex',fwhm0=1.7)==1.7
+    chip.meta['SEEING'] = 1.5
+    assert chip.seedfwhm('sex')==1.5
+    del chip.meta['SEEING']
+    with pytest.raises(Exception):
+        chip.seedfwhm('bogus')
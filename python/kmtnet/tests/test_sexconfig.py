@@ -0,0 +1,130 @@
+import os
+import pytest
+from kmtnet import phot
+from kmtnet.tests.legacy import oldsexconfig
+
+# Part of a SExtractor default.config
+TEMPLATE = """# Default configuration file for SExtractor 2.5.0
+#-------------------------------- Catalog ------------------------------------
+CATALOG_NAME     test.cat       # name of the output catalog
+CATALOG_TYPE     FITS_1.0       # NONE,ASCII,ASCII_HEAD, ASCII_SKYCAT,
+PARAMETERS_NAME  default.param  # name of the file containing catalog contents
+#------------------------------- Extraction ----------------------------------
+DETECT_TYPE      CCD            # CCD (linear) or PHOTO (with gamma correction)
+DETECT_MINAREA   5              # minimum number of pixels above threshold
+DETECT_THRESH    1.5            # <sigmas> or <threshold>,<ZP> in mag.arcsec-2
+ANALYSIS_THRESH  1.5            # <sigmas> or <threshold>,<ZP> in mag.arcsec-2
+FILTER           Y              # apply filter for detection (Y or N)?
+FILTER_NAME      default.conv   # name of the file containing the filter
+DEBLEND_NTHRESH  32             # Number of deblending sub-thresholds
+DEBLEND_MINCONT  0.005          # Minimum contrast parameter for deblending
+FLAG_IMAGE       flag.fits      # filename for an input FLAG-image
+WEIGHT_TYPE      MAP_WEIGHT
+WEIGHT_IMAGE     weight.fits
+#------------------------------ Photometry -----------------------------------
+PHOT_APERTURES   5              # MAG_APER aperture diameter(s) in pixels
+PHOT_AUTOPARAMS  2.5, 3.5       # MAG_AUTO parameters: <Kron_fact>,<min_radius>
+SATUR_LEVEL      50000.0        # level (in ADUs) at which arises saturation
+MAG_ZEROPOINT    0.0            # magnitude zero-point
+GAIN             0.0            # detector gain in e-/ADU
+GAIN_KEY         GAIN           # keyword for detector gain in e-/ADU
+PIXEL_SCALE      1.0            # size of pixel in arcsec (0=use FITS WCS info)
+#------------------------- Star/Galaxy Separation ----------------------------
+SEEING_FWHM      1.2            # stellar FWHM in arcsec
+#------------------------------ Check Image ----------------------------------
+CHECKIMAGE_TYPE  NONE           # can be NONE, BACKGROUND, BACKGROUND_RMS,
+CHECKIMAGE_NAME  check.fits     # Filename for the check-image
+#--------------------- Memory (change with caution!) -------------------------
+MEMORY_PIXSTACK  300000         # number of pixels in stack
+"""
+
+META = {'saturate':38652.0,'gain':1.55,'fwhm':1.34,'pixscale':0.4}
+
+
+@pytest.fixture
+def configdir(tmp_path):
+    cdir = tmp_path/'config'
+    cdir.mkdir()
+    (cdir/'default.config').write_text(TEMPLATE)
+    (cdir/'default.conv').write_text("CONV NORM\n# 3x3 ``all-ground'' convolution mask with FWHM = 2 pixels.\n"
+                                     "1 2 1\n2 4 2\n1 2 1\n")
+    (cdir/'default.nnw').write_text("NNW\n")
+    (cdir/'default.param').write_text("NUMBER\nX_IMAGE\nY_IMAGE\nMAG_AUTO\n")
+    return str(cdir)+'/'
+
+
+def legacy(configdir,wdir,**kwargs):
+    curdir = os.getcwd()
+    os.chdir(wdir)
+    try:
+        filter_name = oldsexconfig(configdir,'flux_sex.cat','flux_mask.fits','flux_wt.fits',META,**kwargs)
+        text = open('default.config').read()
+    finally:
+        os.chdir(curdir)
+    return text,filter_name
+
+
+@pytest.mark.parametrize("sexiter,dthresh",[(1,1.7),(3,1.1)])
+def test_sexconfig_legacy(configdir,tmp_path,sexiter,dthresh):
+    old,filter_name = legacy(configdir,tmp_path,sexiter=sexiter,dthresh=dthresh)
+    sexconfig = phot.SexConfig.get(configdir)
+    new = sexconfig.render(outfile='flux_sex.cat',flagimage='flux_mask.fits',weightimage='flux_wt.fits',
+                           meta=META,sexiter=sexiter,dthresh=dthresh)
+    assert ''.join(new)==old
+    assert sexconfig.filter_name==filter_name=='default.conv'
+    assert sexconfig.kernel().shape==(5,5)
+    # The written file is the same too
+    filename = sexconfig.write(str(tmp_path/'new.config'),outfile='flux_sex.cat',flagimage='flux_mask.fits',
+                               weightimage='flux_wt.fits',meta=META,sexiter=sexiter,dthresh=dthresh)
+    assert open(filename).read()==open(tmp_path/'default.config').read()
+
+
+def test_sexconfig_overrides(configdir,tmp_path):
+    old,_ = legacy(configdir,tmp_path,sexiter=2,dthresh=1.1)
+    sexconfig = phot.SexConfig.get(configdir)
+    kwargs = dict(outfile='flux_sex.cat',flagimage='flux_mask.fits',weightimage='flux_wt.fits',
+                  meta=META,sexiter=2,dthresh=1.1)
+    base = sexconfig.render(**kwargs)
+    assert ''.join(base)==old
+    # Only the overridden lines and the apertures change
+    overrides = {'DEBLEND_MINCONT':0.001,'MEMORY_PIXSTACK':600000,'PHOT_AUTOPARAMS':'2.0, 3.0'}
+    new = sexconfig.render(overrides=overrides,apertures=[1.0,2.0],**kwargs)
+    assert len(new)==len(base)
+    for n,o in zip(new,base):
+        key = o.split()[0] if len(o.split())>0 else None
+        if key in overrides:
+            assert n==key+"  "+str(overrides[key])+"\n"
+        elif key=='PHOT_APERTURES':
+            assert n.split()[1:3]==['5.0,','10.0']
+        else:
+            assert n==o
+
+
+def test_sexconfig_cache(configdir,tmp_path):
+    sexconfig = phot.SexConfig.get(configdir)
+    assert phot.SexConfig.get(configdir) is sexconfig
+    # Touching the template reads it again
+    configfile = os.path.join(configdir,'default.config')
+    with open(configfile,'a') as f:
+        f.write("VERBOSE_TYPE     QUIET          # can be QUIET, NORMAL or FULL\n")
+    st = os.stat(configfile)
+    os.utime(configfile,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    newconfig = phot.SexConfig.get(configdir)
+    assert newconfig is not sexconfig
+    assert newconfig.lines[-1].startswith('VERBOSE_TYPE')
+    assert len(newconfig.lines)==len(sexconfig.lines)+1
+    # Same contents but a new modification time
+    os.utime(configfile,ns=(st.st_atime_ns,st.st_mtime_ns+2*10**9))
+    assert phot.SexConfig.get(configdir) is not newconfig
+
+
+def test_sexconfig_link(configdir,tmp_path):
+    wdir = tmp_path/'work'
+    wdir.mkdir()
+    # An old copy is replaced
+    (wdir/'default.param').write_text("NUMBER\n")
+    sexconfig = phot.SexConfig.get(configdir)
+    sexconfig.link(str(wdir))
+    sexconfig.link(str(wdir))
+    for f in sexconfig.support:
+        assert os.path.samefile(wdir/f,os.path.join(configdir,f))
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from kmtnet import phot
+from kmtnet.tests.legacy import oldsextodao
+from kmtnet.tests.synthetic import sexcat
+
+META = {'NAXIS1':2048,'NAXIS2':4096,'SATURATE':38652.0,'RDNOISE':6.1,'GAIN':3.91}
+
+
+@pytest.mark.parametrize("format",['coo','lst','als'])
+@pytest.mark.parametrize("nstars",[0,1,1000,120001])
+def test_sextodao_bytes(format,nstars,tmp_path):
+    cat = sexcat(nstars,seed=nstars)
+    newfile = str(tmp_path / ("new."+format))
+    oldfile = str(tmp_path / ("old."+format))
+    phot.sextodao(cat,META,newfile,format=format)
+    oldsextodao(cat,META,oldfile,format=format)
+    new = open(newfile,'rb').read()
+    assert new==open(oldfile,'rb').read()
+    assert new.count(b'\n')==nstars+3
+
+
+def test_sextodao_skymeta(tmp_path):
+    meta = dict(META)
+    meta['SKYMED'] = 1600.0
+    meta['SKYRMS'] = 21.5
+    cat = sexcat(50)
+    phot.sextodao(cat,meta,str(tmp_path / "new.lst"),format="lst")
+    oldsextodao(cat,meta,str(tmp_path / "old.lst"),format="lst")
+    assert open(str(tmp_path / "new.lst"),'rb').read()==open(str(tmp_path / "old.lst"),'rb').read()
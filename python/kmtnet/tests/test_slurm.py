@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from kmtnet import slurm
+
+# A few large exposures, that round-robin puts on the same node, and many small ones
+SKEWED = np.array([100.0,5.0,5.0,90.0,5.0,5.0,80.0,5.0,5.0]+[5.0]*21+[40.0,5.0,5.0])
+
+
+def roundrobin(cost,nodes,cpus):
+    return np.max([slurm.nodemakespan(cost[i::nodes],cpus) for i in range(nodes)])
+
+
+def test_nodemakespan():
+    assert slurm.nodemakespan([3.0,2.0,1.0],1)==6.0
+    assert slurm.nodemakespan([3.0,2.0,1.0],2)==3.0
+    assert slurm.nodemakespan([3.0,2.0,1.0],8)==3.0
+    assert slurm.nodemakespan([1.0,1.0,4.0],2)==5.0
+
+
+def test_packtasks():
+    nodes = 3
+    node,load = slurm.packtasks(SKEWED,nodes)
+    assert np.all((node>=1) & (node<=nodes))
+    assert np.sum(load)==pytest.approx(np.sum(SKEWED))
+    for i in range(nodes):
+        assert load[i]==pytest.approx(np.sum(SKEWED[node==i+1]))
+    # Longest-processing-time first beats round-robin
+    for cpus in [1,2]:
+        lpt = np.max([slurm.nodemakespan(np.sort(SKEWED[node==i+1])[::-1],cpus) for i in range(nodes)])
+        rr = roundrobin(SKEWED,nodes,cpus)
+        assert lpt<0.6*rr
+    # and is within 4/3 of the lower bound
+    assert np.max(load)<=4/3*np.maximum(np.sum(SKEWED)/nodes,np.max(SKEWED))
+
+
+def test_predictcost(tmp_path):
+    files = []
+    for i,n in enumerate([100,200,400]):
+        files.append(str(tmp_path/('exp%d.fits' % i)))
+        fits.writeto(files[-1],np.zeros((n,1000),np.float32))
+    tasks = Table({'cmd':['kmtnetdao '+f for f in files]+['kmtnetdao missing.fits']})
+    cost,units = slurm.predictcost(tasks)
+    assert units=='Mpix'
+    assert cost==pytest.approx([0.1,0.2,0.4,0.2])
+    # With the runtime of one of them
+    tab = Table({'stage':['total','total','runsex'],'kind':['stage','stage','stage'],'wall':[30.0,20.0,5.0]})
+    tab.meta['EXPOSURE'] = 'exp1'
+    tab.write(tmp_path/'exp1_timing.fits')
+    cost,units = slurm.predictcost(tasks,history=str(tmp_path/'*_timing.fits'))
+    assert units=='sec'
+    assert cost==pytest.approx([25.0,50.0,100.0,50.0])
+
+
+def submit(tmp_path,cost,nodes,balance):
+    files = []
+    for i,n in enumerate(cost):
+        files.append(str(tmp_path/('exp%02d.fits' % i)))
+        fits.writeto(files[-1],np.zeros((int(n),1000),np.float32))
+    tasks = Table({'cmd':['kmtnetdao '+f for f in files],
+                   'outfile':[f.replace('.fits','.log') for f in files],
+                   'errfile':[f.replace('.fits','.err') for f in files]})
+    slurmdir,key = slurm.submit(tasks,'test',nodes=nodes,cpus=2,nosubmit=True,balance=balance,
+                                slurmdir=str(tmp_path/'slurm'),verbose=False)
+    jobdir = os.path.join(slurmdir,'test',key)
+    return [Table.read(os.path.join(jobdir,'node%02d_tasks.fits' % (i+1))) for i in range(nodes)]
+
+
+def test_submit_balance(tmp_path):
+    nodetasks = submit(tmp_path,SKEWED,3,True)
+    assert sum([len(t) for t in nodetasks])==len(SKEWED)
+    node,load = slurm.packtasks(SKEWED/1000,3)
+    for i,t in enumerate(nodetasks):
+        assert np.all(t['node']==i+1)
+        assert sorted(t['task'])==sorted(np.where(node==i+1)[0]+1)
+        # most expensive first
+        assert np.all(np.diff(t['cost'])<=0)
+
+
+def test_submit_nobalance(tmp_path):
+    # Round-robin, and the tasks in their original order
+    nodetasks = submit(tmp_path,SKEWED,3,False)
+    for i,t in enumerate(nodetasks):
+        assert list(t['task'])==list(np.arange(i,len(SKEWED),3)+1)
+        assert np.all(t['node']==i+1)
+        assert list(t['cmd'])==['kmtnetdao '+str(tmp_path/('exp%02d.fits' % (k-1))) for k in t['task']]
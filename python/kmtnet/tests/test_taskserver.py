@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+import pytest
+from astropy.table import Table
+from kmtnet import taskserver, taskworker, utils
+from kmtnet.taskserver import TaskServer, TaskClient
+
+
+def freeport():
+    with socket.socket() as s:
+        s.bind(('localhost',0))
+        return s.getsockname()[1]
+
+
+def startserver(ntasks,statefile,**kwargs):
+    """ Run a TaskServer in a thread on a free port."""
+    server = TaskServer(ntasks,port=freeport(),statefile=statefile,**kwargs)
+    thread = threading.Thread(target=server.run,daemon=True)
+    thread.start()
+    # Wait until it is listening
+    for i in range(100):
+        try:
+            socket.create_connection(('localhost',server.port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return server,thread
+
+
+def waitfor(func,timeout=5):
+    """ Wait for the server to catch up."""
+    t0 = time.time()
+    while func()==False and time.time()-t0<timeout:
+        time.sleep(0.02)
+    return func()
+
+
+def test_claim_done_fail_relaunch(tmp_path):
+    statefile = str(tmp_path / "tasks.state")
+    server,thread = startserver(6,statefile)
+    with TaskClient('localhost',server.port) as client:
+        assert client.claim(2)==[0,1]
+        client.done([0])
+        client.fail([1],'bad')
+        # Report as done while claiming the next ones
+        assert client.claim(2)==[2,3]
+        assert client.claim(1,done=[2])==[4]
+        assert client.status()=={'pending':1,'claimed':2,'done':2,'failed':1}
+    # The connection closed with 3 and 4 still claimed
+    assert waitfor(lambda: list(server.status)==[2,3,2,3,3,0])
+    with TaskClient('localhost',server.port) as client:
+        assert client.claim(1)==[5]
+        assert client.claim(1,done=[5])==[]
+    thread.join(5)
+    assert thread.is_alive()==False   # all tasks finished, the server stopped
+
+    # Relaunch from the state file, only the failed tasks are handed out again
+    server,thread = startserver(6,statefile)
+    assert list(server.pending)==[1,3,4]
+    with TaskClient('localhost',server.port) as client:
+        assert client.claim(5)==[1,3,4]
+        client.done([1,3,4])
+    thread.join(5)
+    assert thread.is_alive()==False
+
+    # All done, the next relaunch has nothing to do
+    server = TaskServer(6,port=freeport(),statefile=statefile)
+    assert server.finished()
+    server.run()
+    # The state file is for a different task list
+    with pytest.raises(Exception):
+        TaskServer(7,statefile=statefile)
+
+
+def test_noretry(tmp_path):
+    statefile = str(tmp_path / "tasks.state")
+    server,thread = startserver(3,statefile)
+    with TaskClient('localhost',server.port) as client:
+        client.claim(3)
+        client.done([0])
+        client.fail([1])
+        client.shutdown()
+    thread.join(5)
+    assert thread.is_alive()==False
+    # Task 2 was still claimed so it is pending again, 1 stays failed
+    server = TaskServer(3,statefile=statefile,retryfailed=False)
+    assert list(server.pending)==[2]
+    server.close()
+
+
+def test_legacy_hostup(tmp_path):
+    statefile = str(tmp_path / "tasks.state")
+    server,thread = startserver(2,statefile,first=10)
+    nums = []
+    for i in range(2):
+        s = socket.create_connection(('localhost',server.port))
+        s.sendall(b'{"hostUp": true}\n')
+        nums.append(s.makefile('rb').read().decode().strip())
+        s.close()
+    assert nums==['10','11']
+    # The old clients never report back, the tasks count as done
+    thread.join(5)
+    assert thread.is_alive()==False
+    server = TaskServer(2,statefile=statefile,first=10)
+    assert server.finished()
+    server.close()
+
+
+def test_taskcount(tmp_path):
+    statefile = str(tmp_path / "tasks.state")
+    server,thread = startserver(3,statefile)
+    nums = []
+    while True:
+        num = utils.taskcount('localhost',server.port)
+        if num=='':
+            break
+        nums.append(num)
+    assert nums==['0','1','2']
+    thread.join(5)
+    assert thread.is_alive()==False
+    assert list(server.status)==[2,2,2]
+
+
+def test_taskcount_crash(tmp_path):
+    # A taskcount process that dies in the middle of a task
+    statefile = str(tmp_path / "tasks.state")
+    server,thread = startserver(2,statefile)
+    pypath = os.path.dirname(os.path.dirname(os.path.abspath(taskserver.__file__)))
+    code = "import os;from kmtnet import utils;print(utils.taskcount('localhost',"+str(server.port)+"),flush=True);os._exit(1)"
+    env = os.environ.copy()
+    env['PYTHONPATH'] = pypath+os.pathsep+env.get('PYTHONPATH','')
+    out = subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,env=env)
+    assert out.stdout.strip()=='0'
+    # Failed, not left claimed
+    assert waitfor(lambda: list(server.status)==[3,0])
+    with TaskClient('localhost',server.port) as client:
+        assert client.claim(1)==[1]
+        client.done([1])
+    thread.join(5)
+    assert thread.is_alive()==False
+
+
+def test_taskworker(tmp_path):
+    statefile = str(tmp_path / "tasks.state")
+    tasks = Table()
+    tasks['cmd'] = ['echo task0','echo task1 && exit 3','pwd']
+    tasks['outfile'] = [str(tmp_path / ('task'+str(i)+'.out')) for i in range(3)]
+    tasks['errfile'] = [str(tmp_path / ('task'+str(i)+'.err')) for i in range(3)]
+    tasks['dir'] = ['','',str(tmp_path)]
+    server,thread = startserver(3,statefile)
+    ndone,nfailed = taskworker.taskworker(tasks,'localhost',server.port)
+    assert (ndone,nfailed)==(2,1)
+    thread.join(5)
+    assert thread.is_alive()==False
+    assert list(server.status)==[2,3,2]
+    assert open(tasks['outfile'][0]).read()=='task0\n'
+    assert open(tasks['outfile'][2]).read().strip()==str(tmp_path)
+    # The state file has every change
+    lines = open(statefile).read().splitlines()
+    assert json.loads(lines[0])=={'ntasks':3,'first':0}
+    assert [json.loads(l)['status'] for l in lines[1:]]==['claimed','done','claimed','failed','claimed','done']
+
+
+def test_nsclauncher_scripts(tmp_path):
+    from kmtnet import slurm
+    tasks = Table()
+    tasks['cmd'] = ['echo '+str(i) for i in range(4)]
+    tasks['outfile'] = [str(tmp_path / ('task'+str(i)+'.out')) for i in range(4)]
+    tasks['errfile'] = [str(tmp_path / ('task'+str(i)+'.err')) for i in range(4)]
+    slurmdir,key = slurm.nsclauncher(tasks,'test',nodes=1,cpus=2,nosubmit=True,slurmdir=str(tmp_path),
+                                     logdir=str(tmp_path / 'logs'),verbose=False)
+    jobdir = os.path.join(slurmdir,'test',key)
+    master = open(os.path.join(jobdir,'test.slurm')).read()
+    assert 'python -m kmtnet.taskserver 4 ' in master
+    assert '--statefile '+os.path.join(jobdir,'test_tasks${SBATCH_NODE}.state') in master
+    node = open(os.path.join(jobdir,'node01.slurm')).read().splitlines()
+    workers = [l for l in node if 'kmtnet.taskworker' in l]
+    assert len(workers)==2
+    assert workers[0].startswith('python -m kmtnet.taskworker '+os.path.join(jobdir,'test_tasks.fits'))
+    assert len(Table.read(os.path.join(jobdir,'test_tasks.fits')))==4
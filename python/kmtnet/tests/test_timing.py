@@ -0,0 +1,66 @@
+import sys
+import time
+import numpy as np
+import pytest
+from kmtnet import timing
+
+# A subprocess that uses about 600 MB
+BIGCHILD = [sys.executable,'-c','import numpy as np; a = np.ones(75_000_000); print(a.sum())']
+
+
+def test_stage_rows():
+    timer = timing.StageTimer(chip=3)
+    with timer.stage('outer',iter=2):
+        time.sleep(0.05)
+        with timing.substage('inner',kind='step'):
+            time.sleep(0.05)
+        assert timing.call([sys.executable,'-c','import sys; sys.exit(3)'])==3
+    # No active timer, nothing is recorded
+    assert timing.call([sys.executable,'-c','pass'])==0
+    tab = timer.table()
+    assert tab.colnames==[c[0] for c in timing.COLUMNS]
+    assert list(tab['kind'])==['step','subprocess','stage']
+    assert list(tab['stage'])==['outer','outer','outer']
+    assert np.all(tab['chip']==3) and np.all(tab['iter']==2)
+    assert tab['wall'][2]>=0.1 and tab['wall'][0]>=0.05
+    assert tab['command'][1]==sys.executable.split('/')[-1]
+    assert timing.StageTimer().table().colnames==tab.colnames
+
+
+def test_call_signal():
+    timer = timing.StageTimer()
+    with timer.stage('kill'):
+        assert timing.call([sys.executable,'-c','import os,signal; os.kill(os.getpid(),signal.SIGKILL)'])==-9
+
+
+def test_child_peak():
+    timer = timing.StageTimer()
+    with timer.stage('big'):
+        timing.call(BIGCHILD)
+    with timer.stage('small'):
+        timing.call([sys.executable,'-c','pass'])
+    tab = timer.table()
+    big = tab[(tab['stage']=='big') & (tab['kind']=='stage')][0]
+    small = tab[(tab['stage']=='small') & (tab['kind']=='stage')][0]
+    # Measured in the child, not the high-water mark of all the children so far.
+    #  A forked child starts with the RSS of this process.
+    assert big['maxrsschild']>550
+    assert small['maxrsschild']<big['maxrsschild']-300
+    assert tab[(tab['stage']=='big') & (tab['kind']=='subprocess')][0]['maxrsschild']==big['maxrsschild']
+
+
+@pytest.mark.skipif(timing.resethwm()==False,reason='the peak RSS can not be reset here')
+def test_stage_peak():
+    timer = timing.StageTimer()
+    with timer.stage('total'):
+        with timer.stage('big'):
+            a = np.ones(40_000_000)    # 320 MB
+            a.sum()
+            del a
+        with timer.stage('small'):
+            b = np.ones(1000)
+    tab = timer.table()
+    maxrss = dict(zip(tab['stage'],tab['maxrss']))
+    assert maxrss['big']>maxrss['small']+250
+    # The outer stage still has the peak of the inner ones
+    assert maxrss['total']>=maxrss['big']
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# TIMING.PY - Stage timing and resource usage
+#
+
+from __future__ import print_function
+
+__authors__ = 'David Nidever <dnidever@noao.edu>'
+__version__ = '20261018'  # yyyymmdd
+
+import os
+import time
+import resource
+import subprocess
+import threading
+import numpy as np
+from contextlib import contextmanager
+from astropy.table import Table
+
+# The timer that subprocess calls are recorded to, if any
+_active = None
+_lock = threading.Lock()
+
+# The peak RSS measurements that are running
+_open = []
+
+# Columns of the timing table
+#  maxrss is the peak RSS of this process during the stage, and maxrsschild
+#  the largest peak RSS of the subprocesses run through call() in it (MB)
+COLUMNS = [('chip',int),('stage',str),('iter',int),('kind',str),('command',str),
+           ('wall',float),('cpu',float),('cpuchild',float),('maxrss',float),('maxrsschild',float),
+           ('readbytes',np.int64),('writebytes',np.int64),('inblock',np.int64),('oublock',np.int64)]
+
+
+def hwm():
+    """ Peak RSS of this process in MB since the last resethwm()."""
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1])/1024.0
+    except:
+        pass
+    # The peak of the whole run, ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+def resethwm():
+    """ Reset the peak RSS of this process to the current RSS (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except:
+        return False
+
+
+def peakstart():
+    """ Start measuring the peak RSS.  The measurements that are already
+        running get the peak so far, so they can be nested."""
+    with _lock:
+        peak = hwm()
+        for rec in _open:
+            rec['maxrss'] = max(rec['maxrss'],peak)
+        resethwm()
+        rec = {'maxrss':hwm(),'maxrsschild':0.0}
+        _open.append(rec)
+    return rec
+
+
+def peakend(rec):
+    """ Finish a peak RSS measurement."""
+    with _lock:
+        peak = hwm()
+        for r in _open:
+            r['maxrss'] = max(r['maxrss'],peak)
+        _open[:] = [r for r in _open if r is not rec]
+    return rec
+
+
+def childpeak(maxrss):
+    """ Record the peak RSS (MB) of a finished subprocess."""
+    with _lock:
+        for rec in _open:
+            rec['maxrsschild'] = max(rec['maxrsschild'],maxrss)
+
+
+def usage():
+    """ Current resource usage of this process and its children."""
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    out = {'time':time.time(),
+           'cpu':self.ru_utime+self.ru_stime,
+           'cpuchild':child.ru_utime+child.ru_stime,
+           'inblock':self.ru_inblock+child.ru_inblock,
+           'oublock':self.ru_oublock+child.ru_oublock,
+           'readbytes':0,'writebytes':0}
+    # Bytes actually read/written from storage, includes waited-for children
+    if os.path.exists('/proc/self/io'):
+        try:
+            with open('/proc/self/io','r') as f:
+                for line in f:
+                    key,val = line.split(':')
+                    if key=='read_bytes': out['readbytes']=int(val)
+                    if key=='write_bytes': out['writebytes']=int(val)
+        except:
+            pass
+    return out
+
+
+def diff(u0,u1,peak=None):
+    """ Resource usage between two usage() calls, with the peak RSS measurement."""
+    if peak is None: peak={'maxrss':np.nan,'maxrsschild':np.nan}
+    return {'wall':u1['time']-u0['time'],'cpu':u1['cpu']-u0['cpu'],
+            'cpuchild':u1['cpuchild']-u0['cpuchild'],
+            'maxrss':peak['maxrss'],'maxrsschild':peak['maxrsschild'],
+            'readbytes':u1['readbytes']-u0['readbytes'],'writebytes':u1['writebytes']-u0['writebytes'],
+            'inblock':u1['inblock']-u0['inblock'],'oublock':u1['oublock']-u0['oublock']}
+
+
+class StageTimer:
+    """
+    Record the wall time, CPU time (own and children), peak RSS and I/O of the
+    pipeline stages.  While a stage is running the timer is "active" and
+    the subprocesses run through call() or substage() are recorded as well.
+    The peak RSS of this process is measured per stage where the kernel
+    allows resetting it (/proc/self/clear_refs), otherwise it is the peak
+    so far.  The peak RSS of the subprocesses is measured for each one.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        timer = StageTimer(chip=1)
+        with timer.stage('runsex',iter=1):
+            chip.runsex()
+        tab = timer.table()
+
+    """
+
+    def __init__(self,chip=0,logger=None):
+        self.chip = chip
+        self.logger = logger
+        self.rows = []
+        self._stage = None
+        self._iter = 0
+
+    def __repr__(self):
+        return "StageTimer("+str(len(self.rows))+" rows)"
+
+    def add(self,stage,it,kind,command,res):
+        row = {'chip':self.chip,'stage':stage,'iter':it,'kind':kind,'command':command}
+        row.update(res)
+        with _lock:
+            self.rows.append(row)
+        return row
+
+    @contextmanager
+    def stage(self,name,iter=0):
+        """ Time one pipeline stage."""
+        global _active
+        last = (_active,self._stage,self._iter)
+        _active = self
+        self._stage = name
+        self._iter = iter
+        u0 = usage()
+        peak = peakstart()
+        try:
+            yield self
+        finally:
+            res = diff(u0,usage(),peakend(peak))
+            self.add(name,iter,'stage','',res)
+            _active,self._stage,self._iter = last
+            if self.logger is not None:
+                self.logger.info("%s: wall=%.2f sec cpu=%.2f sec (children %.2f sec) maxrss=%.1f MB (children %.1f MB)" %
+                                 (name,res['wall'],res['cpu'],res['cpuchild'],res['maxrss'],res['maxrsschild']))
+
+    def table(self):
+        """ The timing information as a table."""
+        names = [c[0] for c in COLUMNS]
+        if len(self.rows)==0:
+            return Table(names=names,dtype=[c[1] for c in COLUMNS])
+        return Table(rows=[[r[n] for n in names] for r in self.rows],names=names)
+
+
+@contextmanager
+def substage(command,kind='subprocess'):
+    """ Time a subprocess (or other step) inside the active stage, if there is one."""
+    timer = _active
+    if timer is None:
+        yield
+        return
+    stage,it = timer._stage,timer._iter
+    u0 = usage()
+    peak = peakstart()
+    try:
+        yield
+    finally:
+        timer.add(stage,it,kind,command,diff(u0,usage(),peakend(peak)))
+
+
+def call(args,**kwargs):
+    """ subprocess.call() that is recorded in the active stage, with the peak
+        RSS of the subprocess (and the ones it waited for) from wait4()."""
+    command = args[0] if isinstance(args,(list,tuple)) else args
+    with substage(os.path.basename(str(command))):
+        proc = subprocess.Popen(args,**kwargs)
+        try:
+            pid,status,ru = os.wait4(proc.pid,0)
+        except:
+            proc.kill()
+            proc.wait()
+            raise
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        childpeak(ru.ru_maxrss/1024.0)
+        return proc.returncode
@@ -38,8 +38,10 @@ from requests.adapters import HTTPAdapter, Retry
 #from scipy.ndimage.filters import convolve
 import subprocess
 import warnings
+from . import taskserver
 import traceback
 import shutil
+import tarfile
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -1902,7 +1904,189 @@ def file_isfits(filename):
     hdu.close()
     return True
 
-def concatmeas(expdir,base=None,deletetruncated=False):
+def tarext(compression='gz'):
+    """ Tar file extension for a compression type."""
+    if compression=='gz':
+        return '.tgz'
+    elif compression is None or compression=='':
+        return '.tar'
+    return '.tar.'+compression
+
+def checkcompression(compression):
+    """ Check that tarfile can write this compression, zst needs python 3.14."""
+    if compression is None: compression=''
+    if compression not in ['','gz','bz2','xz','zst']:
+        raise Exception("Compression "+str(compression)+" not supported")
+    if compression=='zst' and sys.version_info<(3,14):
+        raise Exception("zst compression needs python 3.14 or later, this is python "+
+                        '.'.join([str(v) for v in sys.version_info[0:3]]))
+    return compression
+
+def opentar(filename,mode='w',compression='gz',level=None):
+    """
+    Open a tar file for writing with the gz, bz2, xz or zst compression.
+    level is the compression level (the xz preset), or None for the default.
+    """
+    compression = checkcompression(compression)
+    kwargs = {}
+    if level is not None:
+        if compression=='xz':
+            kwargs['preset'] = level
+        elif compression=='zst':
+            kwargs['level'] = level
+        elif compression!='':
+            kwargs['compresslevel'] = level
+    try:
+        return tarfile.open(filename,mode+':'+compression,**kwargs)
+    except tarfile.CompressionError:
+        raise Exception(compression+" compression is not available in this python")
+
+def untar(filename,outdir):
+    """ Extract a tar file (any compression) into outdir."""
+    with tarfile.open(filename,'r:*') as tar:
+        # Don't let members write outside of outdir
+        if hasattr(tarfile,'data_filter'):
+            tar.extractall(outdir,filter='data')
+        else:
+            tar.extractall(outdir)
+
+class MeasBundler:
+    """
+    Bundle the chip-level measurement files of an exposure as the chips
+    finish.  Each chip catalog is appended as a table extension to
+    <base>_meas.fits and its primary header to <base>_header.fits, and the
+    other chip files are added to the <base>.tgz tar file.  The bundled
+    files are deleted by close() once all of the bundles are written.
+
+    Parameters
+    ----------
+    expdir : str
+       Directory with the chip files.
+    base : str, optional
+       Base name of the exposure.  Default is the name of the directory.
+    compression : str, optional
+       Compression of the tar file, 'gz', 'bz2', 'xz', 'zst' or '' for none.
+         Default is 'gz'.
+    level : int, optional
+       Compression level.  Default is the tarfile default.
+    logger : logging object, optional
+       Logger to use.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        bundler = MeasBundler(keepdir,base)
+        for ccdnum in range(1,5):
+            ...
+            bundler.addchip(ccdnum)
+        bundler.close()
+
+    """
+
+    def __init__(self,expdir,base=None,compression='gz',level=None,logger=None):
+        # Fail now and not when the first chip is done
+        checkcompression(compression)
+        self.dir = os.path.abspath(expdir)
+        if base is None:
+            base = os.path.basename(self.dir)
+        self.base = base
+        self.compression = compression
+        self.level = level
+        if logger is None: logger=basiclogger()
+        self.logger = logger
+        self.measfile = os.path.join(self.dir,base+'_meas.fits')
+        self.headfile = os.path.join(self.dir,base+'_header.fits')
+        self.logfile = os.path.join(self.dir,base+'.log')
+        self.tarfile = os.path.join(self.dir,base+tarext(compression))
+        self.nchips = 0
+        self.nrows = 0
+        self.fitsfiles = []     # chip catalogs in the _meas.fits file
+        self.tarred = []        # files in the tar file
+        self._tar = None
+
+    def __repr__(self):
+        return "MeasBundler("+self.base+", "+str(self.nchips)+" chips)"
+
+    def __getstate__(self):
+        # Don't pickle the open tar file, only the main process bundles
+        state = self.__dict__.copy()
+        state['_tar'] = None
+        return state
+
+    def open(self):
+        """ Start new bundle files."""
+        fits.PrimaryHDU().writeto(self.measfile,overwrite=True)
+        fits.PrimaryHDU().writeto(self.headfile,overwrite=True)
+        self._tar = opentar(self.tarfile,'w',self.compression,self.level)
+        self.nchips = 0
+        self.nrows = 0
+        self.fitsfiles = []
+        self.tarred = []
+
+    def addcat(self,filename):
+        """ Append a chip catalog to the _meas.fits and _header.fits files."""
+        if self._tar is None:
+            self.open()
+        base1 = os.path.basename(filename)
+        ccdnum = base1[:-5].split('_')[-1]
+        with fits.open(filename) as hdu1:
+            # The row count is in the header, no need to read the table
+            nrows = hdu1[1].header['NAXIS2']
+            newhdu = fits.BinTableHDU(hdu1[1].data)
+            newhdu.header['extname'] = ccdnum
+            newhdu.header['ccdnum'] = ccdnum
+            newhead = hdu1[0].header.copy()
+            newhead['extname'] = ccdnum
+            with fits.open(self.measfile,mode='append') as chdu:
+                chdu.append(newhdu)
+            with fits.open(self.headfile,mode='append') as hhdu:
+                hhdu.append(fits.ImageHDU(header=newhead))
+        self.nchips += 1
+        self.nrows += nrows
+        self.fitsfiles.append(os.path.abspath(filename))
+        self.logger.info('{:3d} {:s} {:8d}'.format(self.nchips,base1,nrows))
+
+    def addfiles(self,files):
+        """ Add files to the tar file."""
+        if self._tar is None:
+            self.open()
+        for f in files:
+            f = os.path.abspath(f)
+            if f in self.tarred: continue
+            self._tar.add(f,arcname=os.path.basename(f))
+            self.tarred.append(f)
+
+    def addchip(self,ccdnum):
+        """ Bundle all of the files of a chip."""
+        chipfiles = sorted(glob(os.path.join(self.dir,self.base+'_'+str(ccdnum)+'.*')))
+        catfile = os.path.join(self.dir,self.base+'_'+str(ccdnum)+'.fits')
+        if catfile in chipfiles:
+            self.addcat(catfile)
+            chipfiles.remove(catfile)
+        self.addfiles(chipfiles)
+
+    def close(self,delete=True):
+        """ Add the remaining files to the tar file, finish it and delete the bundled files."""
+        if self._tar is None:
+            self.open()
+        # Leave out the bundles and the log
+        skip = [self.measfile,self.headfile,self.logfile,self.tarfile]+self.fitsfiles
+        others = [f for f in sorted(glob(os.path.join(self.dir,'*'))) if os.path.isfile(f) and f not in skip]
+        self.addfiles(others)
+        self._tar.close()
+        self._tar = None
+        self.logger.info('Wrote '+str(self.nchips)+' chips and '+str(self.nrows)+' rows to '+self.measfile)
+        self.logger.info('Tarred '+str(len(self.tarred))+' files in '+self.tarfile)
+        # Confirm that they are there
+        if delete and os.path.exists(self.measfile) and os.path.exists(self.headfile) and \
+           os.path.exists(self.tarfile):
+            self.logger.info('Deleting '+str(len(self.fitsfiles)+len(self.tarred))+' bundled files')
+            for f in self.fitsfiles+self.tarred:
+                if os.path.exists(f): os.remove(f)
+
+def concatmeas(expdir,base=None,deletetruncated=False,compression='gz',level=None):
     """
     Combine multiple chip-level measurement files into a single multi-extension FITS file.
     """
@@ -1911,37 +2095,41 @@ def concatmeas(expdir,base=None,deletetruncated=False):
         return
 
     print('Concatenate FITS files for ',expdir)
+    expdir = os.path.abspath(expdir)
     
-    curdir = os.getcwd()
-    
-    # Is this a tar file
-    if os.path.isdir(expdir)==False and expdir.endswith('.tar.gz') or expdir.endswith('.tgz'):
+    # Is this a tar file, with any of the bundle compressions
+    tarexts = [tarext(c) for c in ['gz','bz2','xz','zst','']]+['.tar.gz']
+    ext = [e for e in tarexts if expdir.endswith(e)]
+    if os.path.isdir(expdir)==False and len(ext)>0:
         print('This is a tar file.  Uncompressing.')
-        tarfile = os.path.basename(expdir)
-        base = tarfile.replace('.tgz','').replace('.tar.gz','')
-        nightdir = os.path.abspath(os.path.dirname(expdir))
-        expdir = nightdir+'/'+base
-        os.chdir(nightdir)        
-        res = subprocess.run(['tar','xvf',tarfile],capture_output=True)
-        if res.returncode==0:
-            print('success: removing',tarfile)
-            os.remove(tarfile)
-        else:
-            print('problem untarring',tarfile)
-            #import pdb; pdb.set_trace()
+        tfile = expdir
+        base = os.path.basename(tfile)[:-len(ext[0])]
+        nightdir = os.path.dirname(tfile)
+        expdir = os.path.join(nightdir,base)
+        try:
+            # The bundles have the files without the exposure directory
+            with tarfile.open(tfile,'r:*') as tar:
+                names = tar.getnames()
+            outdir = nightdir
+            if len([n for n in names if n.split('/')[0]==base])<len(names):
+                outdir = expdir
+            untar(tfile,outdir)
+            print('success: removing',tfile)
+            os.remove(tfile)
+        except:
+            print('problem untarring',tfile)
+            traceback.print_exc()
             return
             
-    os.chdir(expdir)
     if base is None:
         base = os.path.basename(expdir)
-    outfile = base+'_meas.fits'
+    outfile = os.path.join(expdir,base+'_meas.fits')
     if os.path.exists(outfile):
         print(outfile,'already exists')
-        os.chdir(curdir)
         return
-    fitsfiles1 = glob('*_?.fits')
+    fitsfiles1 = glob(os.path.join(expdir,'*_?.fits'))
     fitsfiles1.sort()
-    fitsfiles2 = glob('*_??.fits')
+    fitsfiles2 = glob(os.path.join(expdir,'*_??.fits'))
     fitsfiles2.sort()
     fitsfiles = fitsfiles1+fitsfiles2
     # c4d, too few files
@@ -1949,68 +2137,16 @@ def concatmeas(expdir,base=None,deletetruncated=False):
         #print(len(fitsfiles),'fits files found. not enough.  skipping')
         print(len(fitsfiles),'fits files found.  Truncated.  Deleting')
         shutil.rmtree(expdir)
-        os.chdir(curdir)
         return
     # ksb/k4m, too few files
     if len(fitsfiles)<4 and (expdir.find('/k4m/')>-1 or expdir.find('/ksb/')>-1):
         print(len(fitsfiles),'fits files found.  Truncated.  Deleting')
         shutil.rmtree(expdir)
-        os.chdir(curdir)
         return
-    chdu = fits.HDUList()
-    hhdu = fits.HDUList()
-    hhdu.append(fits.PrimaryHDU())
-    for i in range(len(fitsfiles)):
-        hdu1 = fits.open(fitsfiles[i])
-        tab1 = Table.read(fitsfiles[i])
-        base1 = os.path.basename(fitsfiles[i])
-        print('{:3d} {:s} {:8d}'.format(i+1,base1,len(tab1)))
-        ccdnum = base1[:-5].split('_')[-1]
-        newhdu = fits.table_to_hdu(Table(hdu1[1].data))
-        newhdu.header['extname'] = ccdnum
-        newhdu.header['ccdnum'] = ccdnum
-        newhead = hdu1[0].header.copy()
-        newhead['extname'] = ccdnum
-        chdu.append(newhdu)
-        hhdu.append(fits.ImageHDU(header=newhead))
-        hdu1.close()
-    print('Writing',outfile)
-    chdu.writeto(outfile,overwrite=True)
-    chdu.close()
-    houtfile = base+'_header.fits'
-    print('Writing',houtfile)
-    hhdu.writeto(houtfile,overwrite=True)
-    hhdu.close()
-    # Confirm that it is there
-    if os.path.exists(outfile) and os.path.exists(houtfile):
-        # Delete fits files
-        print('Deleting',len(fitsfiles),'individual fits files')
-        for f in fitsfiles:
-            if os.path.exists(f): os.remove(f)
-        # Tar up the rest of the files
-        # leave out meas.fits, log
-        logfile = base+'.log'
-        tarfile = base+'.tgz'
-        allfiles = glob('*')
-        allfiles = [f for f in allfiles if os.path.isfile(f)]
-        allfiles.sort()
-        if outfile in allfiles:
-            allfiles.remove(outfile)
-        if houtfile in allfiles:
-            allfiles.remove(houtfile)
-        if logfile in allfiles:
-            allfiles.remove(logfile)
-        if tarfile in allfiles:
-            allfiles.remove(tarfile)
-        cmd = ['tar','cvzf',tarfile]+allfiles
-        print('tarring',len(allfiles),'files in',tarfile)
-        res = subprocess.run(cmd,capture_output=True)
-        if res.returncode==0:
-            print('tar success')
-            print('Deleting tarred files')
-            for f in allfiles:
-                if os.path.exists(f): os.remove(f)
-    os.chdir(curdir)
+    bundler = MeasBundler(expdir,base,compression=compression,level=level)
+    for f in fitsfiles:
+        bundler.addcat(f)
+    bundler.close()
 
 
 # Get NSC directories
@@ -2046,6 +2182,108 @@ def getdirs(host=None):
         tmproot = os.path.join(basedir,"tmp")
     return basedir,tmproot
 
+# Predicted size of the working files
+def workingset(naxis1,naxis2,nsexiter=4,submaxit=5,nchips=1):
+    """
+    Predicted size (bytes) of the working files of the chips that are processed
+    at the same time.  Every chip has the flux, weight, mask and DAOPHOT images,
+    the PSF neighbor-subtracted images of the createpsf iterations, and the
+    SExtractor input and ALLSTAR subtracted images of every SExtractor iteration.
+    """
+    npix = float(naxis1)*float(naxis2)
+    perpix = 4+4+2+4+4*submaxit+8*nsexiter
+    return int(npix*perpix*nchips)
+
+# Candidate roots of the temporary working directories
+def scratchroots(host=None,scratch=None):
+    """
+    Candidate roots of the temporary working directories, in order of preference.
+    `scratch` (or the KMTNET_SCRATCH environment variable) is a colon-separated
+    list of 'shm' (/dev/shm), 'local' (the node-local $SLURM_TMPDIR, $TMPDIR or /tmp),
+    'shared' (the tmp directory of getdirs()) or directories.  The default,
+    'auto', is shm:local:shared.  Returns a list of (kind, root, base) tuples,
+    where base is the directory that has to exist (e.g. /dev/shm).
+    """
+    if scratch is None:
+        scratch = os.environ.get('KMTNET_SCRATCH','auto')
+    if scratch.strip()=='' or scratch=='auto':
+        scratch = 'shm:local:shared'
+    try:
+        username = getpwuid(os.getuid())[0]
+    except:
+        username = 'defaultuser'
+    basedir,tmproot = getdirs(host)
+    roots = []
+    for kind in scratch.split(':'):
+        kind = kind.strip()
+        if kind=='shm':
+            roots.append(('shm',os.path.join('/dev/shm',username,'kmtnet'),'/dev/shm'))
+        elif kind=='local':
+            local = os.environ.get('SLURM_TMPDIR',os.environ.get('TMPDIR','/tmp'))
+            roots.append(('local',os.path.join(local,username,'kmtnet'),local))
+        elif kind=='shared':
+            roots.append(('shared',tmproot,tmproot))
+        elif kind!='':
+            roots.append((kind,kind,kind))
+    if 'shared' not in [r[0] for r in roots]:
+        roots.append(('shared',tmproot,tmproot))
+    return roots
+
+# Pick the root of the temporary working directories
+def scratchdir(host=None,need=0,scratch=None,margin=1.2):
+    """
+    Pick the root of the temporary working directories.  The first candidate
+    root of scratchroots() with room for `need` bytes (times `margin`) is used,
+    the shared tmp directory of getdirs() is the fallback.  Returns the kind and
+    the root directory.
+    """
+    roots = scratchroots(host,scratch)
+    for kind,root,base in roots:
+        if kind=='shared':
+            return kind,root
+        if os.path.isdir(base)==False or os.access(base,os.W_OK)==False:
+            print(kind+" scratch "+base+" does not exist or is not writable")
+            continue
+        free = shutil.disk_usage(base).free
+        if free>=need*margin:
+            return kind,root
+        print(kind+" scratch "+base+" has {:.1f} GB free, {:.1f} GB needed".format(free/1e9,need*margin/1e9))
+    return roots[-1][0:2]
+
+# Temporary directories of an exposure
+def tempdirs(base,host=None,need=0,scratch=None,resume=False):
+    """
+    Temporary directories of an exposure, named base.N.  The working directory
+    is on the scratch root picked by scratchdir().  The state directory with the
+    chip checkpoints and the keep/ files is always on the shared tmp directory of
+    getdirs(), so a run can be resumed on another node.  A new run takes the
+    first N that is not used on either root.  Resuming picks up the last state
+    directory and its working directory if it is still on one of the scratch
+    roots, otherwise it works in the state directory.  Returns the kind of
+    scratch, the working directory and the state directory.
+    """
+    kind,root = scratchdir(host,need,scratch)
+    sharedroot = getdirs(host)[1]
+    if resume:
+        cntrs = [int(os.path.splitext(d)[1][1:]) for d in glob(os.path.join(sharedroot,base+".*"))
+                 if os.path.isdir(d) and os.path.splitext(d)[1][1:].isdigit()]
+        if len(cntrs)>0:
+            name = base+"."+str(max(cntrs))
+            statedir = os.path.join(sharedroot,name)
+            for k,r,b in scratchroots(host,scratch):
+                if k!='shared' and os.path.isdir(os.path.join(r,name)):
+                    return k,os.path.join(r,name),statedir
+            return 'shared',statedir,statedir
+    tmpcntr = 1
+    while (os.path.exists(os.path.join(root,base+"."+str(tmpcntr))) or
+           os.path.exists(os.path.join(sharedroot,base+"."+str(tmpcntr)))):
+        tmpcntr = tmpcntr+1
+        if tmpcntr > 20:
+            print("Temporary Directory counter getting too high. Exiting")
+            sys.exit()
+    name = base+"."+str(tmpcntr)
+    return kind,os.path.join(root,name),os.path.join(sharedroot,name)
+
 def download_from_archive(md5sum,outdir='./'):
     """
     Download an image from the NOIRLAB Astro Science Archive
@@ -2104,14 +2342,27 @@ def download_from_archive(md5sum,outdir='./'):
     return status,filename
 
 
+_taskclient = None
+
 def taskcount(netcathost='localhost',netcatport=9471):
-    """ Get a new task number from the task server."""
-    cmd = 'echo \'{"hostUp": true}\' | nc '+netcathost+' '+str(netcatport)
-    res = subprocess.run(cmd,shell=True,capture_output=True)
-    val = res.stdout
-    if isinstance(val,bytes):
-        val = val.decode()
-    return val
+    """ Get a new task number from the task server.  The task this process got
+        last time is reported as done.  Returns '' when there are no tasks left.
+        Call it until it returns '', a task that is still claimed when the
+        process exits is marked as failed."""
+    global _taskclient
+    if _taskclient is None or _taskclient.host!=netcathost or _taskclient.port!=int(netcatport):
+        if _taskclient is not None: _taskclient.close()
+        _taskclient = taskserver.TaskClient(netcathost,int(netcatport))
+    try:
+        tasks = _taskclient.claim(1,done=_taskclient.claimed)
+    except (ConnectionError,OSError):
+        # The server stops once all of the tasks are finished
+        _taskclient.close()
+        return ''
+    if len(tasks)==0:
+        _taskclient.close()
+        return ''
+    return str(tasks[0])
 
 def fitscheck(filename):
     """ Check that all of the data looks okay."""